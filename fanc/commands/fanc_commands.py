@@ -554,8 +554,15 @@ def sort_sam_parser():
         '-t', '--threads', dest='threads',
         default=1,
         type=int,
-        help='Number of sorting threads (only when sambamba is available). '
-             'Default: %(default)d'
+        help='Number of sorting threads (only when sambamba is available, '
+             'or with --builtin). Default: %(default)d'
+    )
+
+    parser.add_argument(
+        '--builtin', dest='builtin',
+        action='store_true',
+        default=False,
+        help='Use the built-in external merge sort instead of sambamba or samtools.'
     )
 
     parser.add_argument(
@@ -575,6 +582,7 @@ def sort_sam(argv, **kwargs):
     sam_file = os.path.expanduser(args.sam)
     output_file = None if args.output is None else os.path.expanduser(args.output)
     threads = args.threads
+    builtin = args.builtin
     tmp = args.tmp
 
     from genomic_regions.files import create_temporary_copy
@@ -596,7 +604,7 @@ def sort_sam(argv, **kwargs):
             tmp = True
             logger.info("Working in tmp: {}, ".format(sam_file, output_file))
 
-        output_file = sort_natural_sam(sam_file, output_file, threads=threads)
+        output_file = sort_natural_sam(sam_file, output_file, threads=threads, builtin=builtin)
         success = True
     finally:
         if tmp:
@@ -752,6 +760,38 @@ def pairs_parser():
              'no PCR duplicates filter'
     )
 
+    parser.add_argument(
+        '--compact', dest='compact',
+        action='store_true',
+        default=False,
+        help='Create a compact Pairs object, which does not store fragment '
+             'coordinates for each read pair. Roughly halves the file size. '
+             'Existing Pairs objects can be converted with '
+             '"fanc upgrade --compact-pairs".'
+    )
+
+    parser.add_argument(
+        '--filter-on-import', dest='filter_on_import',
+        action='store_true',
+        default=False,
+        help='Apply inward, outward, restriction site distance, and '
+             'self-ligation filters while loading read pairs, rather '
+             'than in a separate pass afterwards. Does not apply to '
+             '--filter-ligation-auto and --filter-pcr-duplicates, '
+             'which require all pairs to be loaded first.'
+    )
+
+    parser.add_argument(
+        '--drop-filtered', dest='drop_filtered',
+        action='store_true',
+        default=False,
+        help='Do not store read pairs that are removed by filters '
+             'applied while loading read pairs (implies --filter-on-import). '
+             'Only their number is kept for filter statistics. '
+             'Saves disk space, but filtered pairs cannot be '
+             'restored with --reset-filters.'
+    )
+
     parser.add_argument(
         '-s', '--statistics', dest='stats',
         help='Path for saving filter statistics'
@@ -788,7 +828,8 @@ def pairs_parser():
         type=int,
         default=1,
         help='Number of threads to use for extracting fragment information. '
-             'Default: %(default)d'
+             'For bgzipped HiC-Pro or 4D Nucleome input, half of the threads '
+             'are used for parsing the file. Default: %(default)d'
     )
 
     parser.add_argument(
@@ -799,6 +840,24 @@ def pairs_parser():
              'Default: %(default)d'
     )
 
+    parser.add_argument(
+        '--decompression-threads', dest='decompression_threads',
+        type=int,
+        default=1,
+        help='Number of threads used for decompressing each BAM input file. '
+             'Only applies to SAM/BAM input! Default: %(default)d'
+    )
+
+    parser.add_argument(
+        '--sort', dest='sort',
+        action='store_true',
+        default=False,
+        help='Sort SAM/BAM files by read name while pairing reads, '
+             'using a built-in external merge sort. Use this if '
+             'your input files are not sorted by read name. '
+             'Only applies to SAM/BAM input!'
+    )
+
     parser.add_argument(
         '-S', '--no-check-sorted', dest='check_sorted',
         action='store_false',
@@ -815,6 +874,18 @@ def pairs_parser():
              'overwritten without warning.'
     )
 
+    parser.add_argument(
+        '--resume', dest='resume',
+        action='store_true',
+        default=False,
+        help='Record progress in the output file after every loaded '
+             'chunk, and continue loading read pairs from SAM/BAM files '
+             'into an existing output file after a run with --resume '
+             'was interrupted. Chunks that were completely loaded are '
+             'skipped. Requires the same input files and --batch-size '
+             'as the original run. Cannot be used with -tmp.'
+    )
+
     parser.add_argument(
         '--bwa', dest='bwa',
         action='store_true',
@@ -856,6 +927,9 @@ def pairs(argv, **kwargs):
     filter_re_distance = args.redist
     filter_self_ligations = args.self_ligated
     filter_pcr_duplicates = args.dup_thresh
+    drop_filtered = args.drop_filtered
+    compact = args.compact
+    filter_on_import = args.filter_on_import or drop_filtered
     statistics_file = os.path.expanduser(args.stats) if args.stats is not None else None
     statistics_plot_file = os.path.expanduser(args.stats_plot) if args.stats_plot is not None else None
     re_dist_plot_file = os.path.expanduser(args.re_dist_plot) if args.re_dist_plot is not None else None
@@ -863,13 +937,22 @@ def pairs(argv, **kwargs):
         if args.ligation_error_plot is not None else None
     threads = args.threads
     batch_size = args.batch_size
+    decompression_threads = args.decompression_threads
+    sort_sam_files = args.sort
     check_sam_sorted = args.check_sorted
     force_overwrite = args.force_overwrite
     reset_filters = args.reset_filters
+    resume = args.resume
     tmp = args.tmp
 
     from genomic_regions.files import create_temporary_copy, create_temporary_output
 
+    if resume and tmp:
+        parser.error("--resume cannot be used with -tmp, as loading must "
+                     "continue in the output file itself")
+    if resume and len(input_files) != 3:
+        parser.error("--resume is only supported when loading SAM/BAM files")
+
     if restriction_enzyme is not None:
         restriction_enzyme = restriction_enzyme.split(",")
 
@@ -879,8 +962,48 @@ def pairs(argv, **kwargs):
     pairs = None
     try:
         regions = None
+        pair_filters = []
+        if 2 <= len(input_files) <= 3 and filter_on_import:
+            from fanc.pairs import InwardPairsFilter, OutwardPairsFilter, \
+                ReDistanceFilter, SelfLigationFilter
+            from fanc.general import Mask
+
+            if not filter_le_auto:
+                if filter_inward:
+                    logger.info("Filtering inward-facing reads at %dbp while loading pairs" % filter_inward)
+                    pair_filters.append(InwardPairsFilter(minimum_distance=filter_inward, mask=Mask(
+                        name='inward ligation error',
+                        description='Mask read pairs that are inward facing and < {}bp apart'.format(filter_inward)
+                    )))
+                    filter_inward = None
+
+                if filter_outward:
+                    logger.info("Filtering outward-facing reads at %dbp while loading pairs" % filter_outward)
+                    pair_filters.append(OutwardPairsFilter(minimum_distance=filter_outward, mask=Mask(
+                        name='outward ligation error',
+                        description='Mask read pairs that are outward facing and < {}bp apart'.format(filter_outward)
+                    )))
+                    filter_outward = None
+
+            if filter_re_distance:
+                logger.info("Filtering reads with RE distance > %dbp while loading pairs" % filter_re_distance)
+                pair_filters.append(ReDistanceFilter(maximum_distance=filter_re_distance, mask=Mask(
+                    name='restriction site distance',
+                    description='Mask read pairs where the cumulative distance of reads to '
+                                'the nearest RE site exceeds {}'.format(filter_re_distance)
+                )))
+                filter_re_distance = None
+
+            if filter_self_ligations:
+                logger.info("Filtering self-ligated read pairs while loading pairs")
+                pair_filters.append(SelfLigationFilter(mask=Mask(
+                    name='self-ligations',
+                    description='Mask read pairs that represent a self-ligated fragment'
+                )))
+                filter_self_ligations = False
+
         if 2 <= len(input_files) <= 3:
-            if not force_overwrite and os.path.exists(input_files[-1]):
+            if not force_overwrite and not resume and os.path.exists(input_files[-1]):
                 parser.error("Output file {} exists! Use -f to force "
                              "overwriting it!".format(input_files[-1]))
 
@@ -959,7 +1082,10 @@ def pairs(argv, **kwargs):
                                    restriction_enzyme=restriction_enzyme,
                                    read_filters=read_filters, output_file=pairs_file,
                                    check_sorted=check_sam_sorted, threads=threads,
-                                   batch_size=batch_size)
+                                   batch_size=batch_size, decompression_threads=decompression_threads,
+                                   sort=sort_sam_files, pair_filters=pair_filters,
+                                   drop_filtered=drop_filtered, compact=compact,
+                                   resume=resume)
             pairs.close()
         elif len(input_files) == 2:
             logger.info("Two arguments detected, assuming HiC-Pro or 4D Nucleome input.")
@@ -979,20 +1105,24 @@ def pairs(argv, **kwargs):
                 pairs_file = create_temporary_output(pairs_file)
                 tmp = True
 
+            # parsing processes run alongside the fragment assignment
+            # workers, so both share the available threads
+            parse_threads = max(1, threads // 2)
             try:
                 logger.debug("Trying 4D nucleome format...")
-                sb = FourDNucleomePairGenerator(input_file)
+                sb = FourDNucleomePairGenerator(input_file, threads=parse_threads)
             except ValueError:
                 logger.debug("Trying HiC-Pro format...")
-                sb = HicProPairGenerator(input_file)
+                sb = HicProPairGenerator(input_file, threads=parse_threads)
 
-            pairs = ReadPairs(file_name=pairs_file, mode='w')
+            pairs = ReadPairs(file_name=pairs_file, mode='w', compact=compact)
 
             if isinstance(regions, gr.RegionBased):
                 pairs.add_regions(regions.regions, preserve_attributes=False)
             else:
                 pairs.add_regions(regions, preserve_attributes=False)
-            pairs.add_read_pairs(sb, threads=threads, batch_size=batch_size)
+            pairs.add_read_pairs(sb, threads=max(1, threads - parse_threads), batch_size=batch_size,
+                                 pair_filters=pair_filters, drop_filtered=drop_filtered)
             pairs.close()
         elif len(input_files) == 1:
             logger.info("One argument received, assuming existing Pairs object.")
@@ -1124,7 +1254,8 @@ def hic_parser():
              'Hic objects. Hic objects (also the ones converted '
              'from Pairs) will first be merged and the merged '
              'object will be binned, filtered and corrected as '
-             'specified in the remaining parameters.'
+             'specified in the remaining parameters. '
+             'With --from-sam, provide two SAM/BAM files and an output file.'
     )
 
     parser.add_argument(
@@ -1134,6 +1265,80 @@ def hic_parser():
              'end after the merging step.'
     )
 
+    parser.add_argument(
+        '--from-sam', dest='from_sam',
+        action='store_true',
+        default=False,
+        help='Bin read pairs from two SAM/BAM files (paired-end reads, '
+             'sorted by read name) directly into a Hic object, without '
+             'writing an intermediate Pairs file. Requires --bin-size '
+             'and --genome. Read pair filters are specified with the '
+             '--filter-* options below. Bins contacts by read position.'
+    )
+
+    parser.add_argument(
+        '--genome', dest='genome',
+        help='Only used with --from-sam. See "fanc pairs --genome".'
+    )
+
+    parser.add_argument(
+        '--restriction-enzyme', dest='restriction_enzyme',
+        help='Only used with --from-sam. See "fanc pairs --restriction-enzyme".'
+    )
+
+    parser.add_argument(
+        '--filter-multimapping', dest='filter_unique',
+        action='store_true',
+        default=False,
+        help='Only used with --from-sam. Filter reads that map multiple times. '
+             'See "fanc pairs --filter-multimapping".'
+    )
+
+    parser.add_argument(
+        '--filter-quality', dest='filter_quality',
+        type=float,
+        help='Only used with --from-sam. Cutoff for the minimum mapping quality '
+             'of a read. See "fanc pairs --filter-quality".'
+    )
+
+    parser.add_argument(
+        '--filter-inward', dest='filter_inward',
+        type=int,
+        help='Only used with --from-sam. Minimum distance for inward-facing read pairs.'
+    )
+
+    parser.add_argument(
+        '--filter-outward', dest='filter_outward',
+        type=int,
+        help='Only used with --from-sam. Minimum distance for outward-facing read pairs.'
+    )
+
+    parser.add_argument(
+        '--filter-re-distance', dest='filter_re_distance',
+        type=int,
+        help='Only used with --from-sam. Maximum distance for a read to the '
+             'nearest restriction site.'
+    )
+
+    parser.add_argument(
+        '--filter-self-ligations', dest='filter_self_ligations',
+        action='store_true',
+        default=False,
+        help='Only used with --from-sam. Remove read pairs representing '
+             'self-ligated fragments.'
+    )
+
+    parser.add_argument(
+        '--filter-pcr-duplicates', dest='filter_pcr_duplicates',
+        type=int,
+        help='Only used with --from-sam. Filter read pairs for PCR duplicates. '
+             'See "fanc pairs --filter-pcr-duplicates". Read positions are '
+             'written to temporary files by chromosome pair, and duplicates '
+             'are found one chromosome pair at a time. Memory use is bounded '
+             'by the number of read pairs in the largest chromosome pair '
+             '(roughly 40 bytes per pair).'
+    )
+
     parser.add_argument(
         '-l', '--filter-low-coverage', dest='filter_low_coverage',
         type=float,
@@ -1336,8 +1541,19 @@ def hic(argv, **kwargs):
     limit_chromosomes = args.chromosomes
     threads = args.threads
     deepcopy = args.deepcopy
+    from_sam = args.from_sam
+    genome_file = os.path.expanduser(args.genome) if args.genome is not None else None
+    restriction_enzyme = args.restriction_enzyme
     tmp = args.tmp
 
+    if from_sam:
+        if len(input_files) != 3:
+            parser.error("--from-sam requires two SAM/BAM files and an output file!")
+        if bin_size is None:
+            parser.error("--from-sam requires --bin-size!")
+        if genome_file is None:
+            parser.error("--from-sam requires --genome!")
+
     if kr or ice:
         warnings.warn("-k and -i have been deprecated in favor of -n and --norm-method. "
                       "-k and -i will be removed in a future version. "
@@ -1396,6 +1612,61 @@ def hic(argv, **kwargs):
     pairs_files = []
     tmp_input_files = []
     try:
+        if from_sam:
+            from fanc.regions import genome_regions
+            from fanc.tools.general import get_sam_mapper
+            from fanc.pairs import SamBamReadPairGenerator, BwaMemQualityFilter, BwaMemUniquenessFilter, \
+                UniquenessFilter, QualityFilter, InwardPairsFilter, OutwardPairsFilter, \
+                ReDistanceFilter, SelfLigationFilter
+            from fanc.general import Mask
+
+            sam1_file, sam2_file = input_files
+            if restriction_enzyme is not None:
+                restriction_enzyme = restriction_enzyme.split(",")
+            regions = genome_regions(genome_file, restriction_enzyme=restriction_enzyme)
+
+            bwa = get_sam_mapper(sam1_file) == 'bwa'
+            read_pairs = SamBamReadPairGenerator(sam1_file, sam2_file)
+            if args.filter_unique:
+                if bwa:
+                    read_pairs.add_filter(BwaMemUniquenessFilter(mask=Mask(ix=1, name='multi-mapping')))
+                else:
+                    read_pairs.add_filter(UniquenessFilter(mask=Mask(ix=1, name='multi-mapping')))
+
+            if args.filter_quality is not None:
+                if 0 < args.filter_quality < 1:
+                    read_pairs.add_filter(BwaMemQualityFilter(args.filter_quality,
+                                                              mask=Mask(ix=2, name='alignment score')))
+                else:
+                    read_pairs.add_filter(QualityFilter(int(args.filter_quality),
+                                                        mask=Mask(ix=2, name='MAPQ')))
+
+            pair_filters = []
+            if args.filter_inward:
+                pair_filters.append(InwardPairsFilter(minimum_distance=args.filter_inward,
+                                                      mask='inward ligation error'))
+            if args.filter_outward:
+                pair_filters.append(OutwardPairsFilter(minimum_distance=args.filter_outward,
+                                                       mask='outward ligation error'))
+            if args.filter_re_distance:
+                pair_filters.append(ReDistanceFilter(maximum_distance=args.filter_re_distance,
+                                                     mask='restriction site distance'))
+            if args.filter_self_ligations:
+                pair_filters.append(SelfLigationFilter(mask='self-ligations'))
+
+            tmp_output_file = tempfile.NamedTemporaryFile(suffix='.hic', delete=False)
+            tmp_input_files.append(tmp_output_file.name)
+            logger.info("Binning read pairs from {} and {} ({})".format(sam1_file, sam2_file, bin_size))
+            streamed_hic = read_pairs.to_hic(bin_size, regions, filters=pair_filters,
+                                             pcr_duplicate_threshold=args.filter_pcr_duplicates,
+                                             file_name=tmp_output_file.name)
+            streamed_hic.close()
+            if hasattr(regions, 'close'):
+                regions.close()
+
+            input_files = [tmp_output_file.name]
+            bin_size = None
+
         for input_file in input_files:
             original_input_file = input_file
             if tmp:
@@ -2581,6 +2852,16 @@ def loops_parser():
              'close to the diagonal.'
     )
 
+    parser.add_argument(
+        '--max-distance', dest='max_dist',
+        help='Maximum distance between two loci to be '
+             'considered as loops, e.g. 2mb. Only the '
+             'band of the matrix up to this distance from '
+             'the diagonal is loaded and scanned, which '
+             'greatly speeds up loop calling at high resolution. '
+             'Default: no limit.'
+    )
+
     parser.add_argument(
         '-m', '--mappability', dest='mappability_global_cutoff',
         type=float,
@@ -2775,6 +3056,18 @@ def loops_parser():
                         overwritten without warning.'''
     )
 
+    parser.add_argument(
+        '--resume', dest='resume',
+        action='store_true',
+        default=False,
+        help='Record progress in the output file after every '
+             'chromosome pair, and continue calling loops into an '
+             'existing output file after a run with --resume was '
+             'interrupted. Chromosome pairs that were completely '
+             'processed are skipped. Requires the same parameters '
+             'as the original run. Cannot be used with -tmp or --merge.'
+    )
+
     parser.add_argument(
         '-tmp', '--work-in-tmp', dest='tmp',
         action='store_true',
@@ -2799,6 +3092,7 @@ def loops(argv, **kwargs):
     width = args.width
     threads = args.threads
     min_dist = args.min_dist
+    max_dist = args.max_dist
 
     mappability_cutoff_global = args.mappability_global_cutoff
     mappability_cutoff_donut = args.mappability_donut_cutoff
@@ -2830,9 +3124,14 @@ def loops(argv, **kwargs):
     bedpe_file = os.path.expanduser(args.bedpe) if args.bedpe is not None else None
 
     force_overwrite = args.force_overwrite
+    resume = args.resume
     tmp = args.tmp
 
-    if not force_overwrite and output_file is not None and os.path.exists(output_file):
+    if resume and (tmp or merge):
+        parser.error("--resume cannot be used with -tmp or --merge, as loops must "
+                     "be called directly into the output file")
+
+    if not force_overwrite and not resume and output_file is not None and os.path.exists(output_file):
         parser.error("Output file {} exists! Use -f to force "
                      "overwriting it!".format(output_file))
 
@@ -2881,7 +3180,13 @@ def loops(argv, **kwargs):
                 o = create_temporary_output('test.peaks')
                 tmp_input_files.append(o)
 
-            peaks = pk.call_peaks(matrix, chromosome_pairs=chromosome_pairs, file_name=o)
+            max_distance = None
+            if max_dist is not None:
+                from fanc.tools.general import str_to_int
+                max_distance = str_to_int(max_dist)
+
+            peaks = pk.call_peaks(matrix, chromosome_pairs=chromosome_pairs, file_name=o,
+                                  max_distance=max_distance, resume=resume)
             matrix.close()
             matrix = peaks
             is_rh_peaks = True
@@ -5076,6 +5381,14 @@ def upgrade_parser():
         help='''Force upgrade even if object can be loaded.'''
     )
 
+    parser.add_argument(
+        '--compact-pairs', dest='compact_pairs',
+        action='store_true',
+        default=False,
+        help='''Convert a Pairs object to the compact format, which does not store
+                fragment coordinates for each read pair (see "fanc pairs --compact").'''
+    )
+
     parser.add_argument(
         '-tmp', '--work-in-tmp', dest='tmp',
         action='store_true',
@@ -5094,6 +5407,7 @@ def upgrade(argv, **kwargs):
     input_file = os.path.expanduser(args.hic)
     output_file = os.path.expanduser(args.output) if args.output is not None else None
     force = args.force
+    compact_pairs = args.compact_pairs
     tmp = args.tmp
 
     import fanc
@@ -5114,7 +5428,7 @@ def upgrade(argv, **kwargs):
             output_file = create_temporary_output(output_file)
             tmp = True
 
-        if not force:
+        if not force and not compact_pairs:
             try:
                 f = fanc.load(input_file)
                 f.close()
@@ -5152,6 +5466,23 @@ def upgrade(argv, **kwargs):
                 old_fanc.close()
                 new_hic.close()
                 return
+            elif isinstance(old_fanc, fanc.ReadPairs) and compact_pairs:
+                if old_fanc._compact:
+                    parser.error("Pairs object is already compact!")
+
+                in_place = output_file is None
+                if in_place:
+                    output_file = input_file + '.compact.tmp'
+
+                logger.info("Converting Pairs to compact format")
+                compact = old_fanc.to_compact(file_name=output_file)
+                compact.close()
+                old_fanc.close()
+
+                if in_place:
+                    shutil.move(output_file, input_file)
+                    output_file = None
+                return
             elif isinstance(old_fanc, fanc.ReadPairs) or isinstance(old_fanc, fanc.Hic):
                 if old_fanc._chromosomes_info is None:
                     if output_file is not None:
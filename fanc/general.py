@@ -885,15 +885,32 @@ class MaskedTable(t.Table):
     def _has_mask(self, row, mask):
         return mask in self._row_masks(row)
 
-    def _filter(self, mask_filters):
+    def _filter(self, mask_filters, _chunk_size=1000000):
         mask_filter_ixs = [2 ** mask_filter.mask_ix for mask_filter in mask_filters]
         n_rows = self._original_len()
         masks = self.col(self._mask_field)
 
-        for i, row in enumerate(self._iter_visible_and_masked()):
+        # filters that support it are run on chunks of rows at once
+        row_filters = []
+        for chunk_start in range(0, n_rows, _chunk_size):
+            chunk_end = min(n_rows, chunk_start + _chunk_size)
+            rows = self.read(chunk_start, chunk_end)
+            row_filters = []
             for j, mask_filter in enumerate(mask_filters):
-                if not mask_filter.valid(row):
-                    masks[i] = masks[i] | mask_filter_ixs[j]
+                valid = mask_filter.valid_rows(rows)
+                if valid is None:
+                    row_filters.append(j)
+                else:
+                    masks[chunk_start:chunk_end][~valid] |= mask_filter_ixs[j]
+
+            if len(row_filters) == len(mask_filters):
+                break
+
+        if len(row_filters) > 0:
+            for i, row in enumerate(self._iter_visible_and_masked()):
+                for j in row_filters:
+                    if not mask_filters[j].valid(row):
+                        masks[i] = masks[i] | mask_filter_ixs[j]
         mask_ixs, masked_length, stats = self._mask_ixs_and_stats_from_masks(masks)
 
         try:
@@ -1017,3 +1034,22 @@ class MaskFilter(with_metaclass(ABCMeta, object)):
             bool: True if row is valid, False otherwise
         """
         pass
+
+    def valid_rows(self, rows):
+        """
+        Test if multiple rows are valid according to this filter.
+
+        Filters that can be expressed on column arrays should override
+        this method, as it is much faster than calling valid on
+        every row. By default, returns None, which means that
+        valid is called for each row instead.
+
+        Args:
+            rows (numpy.ndarray):
+                A structured array of table rows
+
+        Returns:
+            numpy.ndarray: boolean array, True for valid rows,
+                or None if not supported by this filter
+        """
+        return None
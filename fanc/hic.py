@@ -4,7 +4,7 @@ from .matrix import RegionMatrixTable, RegionMatrixContainer, Edge, LazyEdge
 from abc import abstractmethod, ABCMeta
 from future.utils import with_metaclass, string_types, viewitems
 from .tools.load import load
-from .tools.general import distribute_integer, RareUpdateProgressBar
+from .tools.general import distribute_integer, RareUpdateProgressBar, human_format
 from .tools.matrix import restore_sparse_rows, remove_sparse_rows
 from .general import MaskFilter, MaskedTableView
 from collections import defaultdict
@@ -109,6 +109,179 @@ def _get_overlap_map(old_regions, new_regions):
     return old_to_new
 
 
+def _get_overlap_index_arrays(old_regions, new_regions):
+    """
+    Vectorised version of :func:`~_get_overlap_map` for the
+    Rao and Rowley et al. 2014 binning approach.
+
+    As :func:`~_edge_overlap_split_rao` only considers the first and the
+    last overlapping new region, these are returned as two index arrays.
+
+    :param old_regions: Iterable of regions, sorted by start within chromosomes
+    :param new_regions: Iterable of regions, sorted by start within chromosomes
+    :return: tuple of two numpy arrays with the index of the first and last
+             new region overlapping each old region, -1 if there is no overlap
+    """
+    new_region_map = defaultdict(list)
+    for i, new_region in enumerate(new_regions):
+        new_region_map[new_region.chromosome].append([new_region.start, new_region.end, i])
+
+    old_chromosomes, old_starts, old_ends = [], [], []
+    for old_region in old_regions:
+        old_chromosomes.append(old_region.chromosome)
+        old_starts.append(old_region.start)
+        old_ends.append(old_region.end)
+    old_chromosomes = np.array(old_chromosomes, dtype=object)
+    old_starts = np.array(old_starts, dtype=np.int64)
+    old_ends = np.array(old_ends, dtype=np.int64)
+
+    first_ix = np.full(len(old_starts), -1, dtype=np.int64)
+    last_ix = np.full(len(old_starts), -1, dtype=np.int64)
+    for chromosome, new_chromosome_regions in viewitems(new_region_map):
+        new_starts, new_ends, new_ixs = np.array(new_chromosome_regions, dtype=np.int64).T
+        old_ixs = np.where(old_chromosomes == chromosome)[0]
+
+        first = np.searchsorted(new_ends, old_starts[old_ixs], side='left')
+        last = np.searchsorted(new_starts, old_ends[old_ixs], side='right') - 1
+        overlapping = (first < len(new_ends)) & (last >= 0) & (first <= last)
+
+        first_ix[old_ixs[overlapping]] = new_ixs[first[overlapping]]
+        last_ix[old_ixs[overlapping]] = new_ixs[last[overlapping]]
+
+    return first_ix, last_ix
+
+
+def _edges_overlap_split_rao_arrays(sources, sinks, weights, first_ix, last_ix):
+    """
+    Vectorised version of :func:`~_edge_overlap_split_rao`.
+
+    Splits and aggregates many edges at once, using index arrays
+    from :func:`~_get_overlap_index_arrays`. Integer weights are
+    distributed with the same (randomised) integer split as
+    :func:`~distribute_integer`, non-integer weights fall back to
+    :func:`~_edge_overlap_split_rao` on an edge-by-edge basis.
+
+    :return: tuple of new source, sink, and weight arrays, with
+             unique (source, sink) pairs
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    sinks = np.asarray(sinks, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    first_source, last_source = first_ix[sources], last_ix[sources]
+    first_sink, last_sink = first_ix[sinks], last_ix[sinks]
+    mappable = (first_source >= 0) & (first_sink >= 0)
+    integer = weights == np.floor(weights)
+
+    # candidate new edges: (first, first), (first, last), (last, first), (last, last)
+    candidate_sources = np.stack([first_source, first_source, last_source, last_source], axis=1)
+    candidate_sinks = np.stack([first_sink, last_sink, first_sink, last_sink], axis=1)
+    lo = np.minimum(candidate_sources, candidate_sinks)
+    hi = np.maximum(candidate_sources, candidate_sinks)
+
+    valid = np.zeros(lo.shape, dtype=bool)
+    valid[:, 0] = True
+    valid[:, 1] = first_sink != last_sink
+    valid[:, 2] = first_source != last_source
+    valid[:, 3] = valid[:, 1] & valid[:, 2]
+    for k in range(1, 4):
+        for m in range(k):
+            valid[:, k] &= ~(valid[:, m] & (lo[:, m] == lo[:, k]) & (hi[:, m] == hi[:, k]))
+    valid &= (mappable & integer)[:, None]
+
+    # integer split: equal share, remainder assigned to random candidates
+    n_candidates = np.maximum(valid.sum(axis=1), 1)
+    base = np.trunc(weights / n_candidates)
+    remainder = weights - base * n_candidates
+    random_keys = np.where(valid, np.random.random(valid.shape), 2.)
+    ranks = np.argsort(np.argsort(random_keys, axis=1), axis=1)
+    new_weights = base[:, None] + (ranks < remainder[:, None])
+
+    keep = valid & (new_weights != 0)
+    new_sources = [lo[keep]]
+    new_sinks = [hi[keep]]
+    new_weight_list = [new_weights[keep]]
+
+    for ix in np.where(mappable & ~integer)[0]:
+        for new_source, new_sink, new_weight in _edge_overlap_split_rao(
+                [sources[ix], sinks[ix], weights[ix]],
+                {sources[ix]: [[first_source[ix]], [last_source[ix]]],
+                 sinks[ix]: [[first_sink[ix]], [last_sink[ix]]]}):
+            if new_weight != 0:
+                new_sources.append([new_source])
+                new_sinks.append([new_sink])
+                new_weight_list.append([new_weight])
+
+    new_sources = np.concatenate(new_sources).astype(np.int64)
+    new_sinks = np.concatenate(new_sinks).astype(np.int64)
+    new_weights = np.concatenate(new_weight_list).astype(np.float64)
+
+    n = max(int(last_ix.max()) + 1, 1) if len(last_ix) > 0 else 1
+    keys, inverse = np.unique(new_sources * n + new_sinks, return_inverse=True)
+    aggregated_weights = np.bincount(inverse, weights=new_weights, minlength=len(keys))
+    return keys // n, keys % n, aggregated_weights
+
+
+def _get_binning_partitions(hic, threads=1, regions_soft_max=50000):
+    """
+    Split the regions of a matrix into chromosome-aligned partitions for binning.
+
+    :return: list of [start, end) region index ranges
+    """
+    n_fragments = len(hic.regions)
+    thread_max = min(int(n_fragments/threads), regions_soft_max)
+    partitions = [[0, 0]]
+    previous_chromosome = None
+    for i, region in enumerate(hic.regions(lazy=True)):
+        if previous_chromosome is not None and (region.chromosome != previous_chromosome
+                                                or i == n_fragments - 1):
+            partition_size = partitions[-1][1] - partitions[-1][0]
+            current_size = i - partitions[-1][1]
+            partition_empty = thread_max - partition_size
+
+            if partition_size == 0 or partition_empty > current_size/2:
+                partitions[-1][1] = i
+            else:
+                partitions.append([partitions[-1][1], i])
+        previous_chromosome = region.chromosome
+    partitions[-1][1] = n_fragments
+    return partitions
+
+
+def _bin_hic_partition_worker_arrays(hic_file, qin, qout, first_ix, last_ix, access_lock):
+    try:
+        while True:
+            worker_input = qin.get()
+            if worker_input is None:
+                logger.debug("Received stop signal, worker terminating.")
+                break
+
+            partition1, partition2 = worker_input
+            logger.debug("Received {}-{}".format(partition1, partition2))
+
+            with access_lock:
+                hic = None
+                try:
+                    hic = load(hic_file)
+                    weight_field = hic._default_score_field
+                    if weight_field is None or weight_field not in hic.field_names:
+                        weight_field = 'weight'
+                    edges = hic._edge_subset_arrays(partition1, partition2,
+                                                    fields=['source', 'sink', weight_field])
+                finally:
+                    if hic is not None:
+                        hic.close()
+
+            if len(edges['source']) == 0:
+                qout.put(None)
+                continue
+
+            qout.put(_edges_overlap_split_rao_arrays(edges['source'], edges['sink'], edges[weight_field],
+                                                     first_ix, last_ix))
+    except Exception as e:
+        qout.put(e)
+
+
 def _bin_hic_partition_worker(hic_file, qin, qout,
                               overlap_map, _edges_by_overlap_method,
                               access_lock):
@@ -156,6 +329,22 @@ def _bin_hic_partition_worker(hic_file, qin, qout,
         qout.put(e)
 
 
+def _exact_bin_size_format(bin_size):
+    """
+    Format a bin size without rounding, e.g. 5000 as "5k" and 1500 as "1.5k".
+    """
+    return human_format(bin_size, precision=9, lowercase=True)
+
+
+def _binned_file_name(file_prefix, bin_size):
+    """
+    Name of the file for a matrix binned at bin_size, e.g. <file_prefix>_5kb.hic.
+
+    Bin sizes are not rounded, so different bin sizes never share a file.
+    """
+    return '{}_{}b.hic'.format(file_prefix, _exact_bin_size_format(bin_size))
+
+
 class Hic(RegionMatrixTable):
     """
     Central class for working with Hi-C data.
@@ -215,8 +404,20 @@ class Hic(RegionMatrixTable):
         else:
             logger.info("Binning Hi-C contacts")
 
+            # the default Rao et al. (2014) method can be run on arrays of edges
+            vectorised = (isinstance(hic, RegionMatrixTable) and
+                          _edges_by_overlap_method is _edge_overlap_split_rao)
+
             # create region "overlap map"
-            overlap_map = _get_overlap_map(hic.regions(lazy=False), self.regions(lazy=False))
+            if vectorised:
+                first_ix, last_ix = _get_overlap_index_arrays(hic.regions(lazy=True),
+                                                              self.regions(lazy=True))
+                worker_args = (first_ix, last_ix)
+                worker = _bin_hic_partition_worker_arrays
+            else:
+                overlap_map = _get_overlap_map(hic.regions(lazy=False), self.regions(lazy=False))
+                worker_args = (msgpack.dumps(overlap_map), _edges_by_overlap_method)
+                worker = _bin_hic_partition_worker
 
             file_name = hic.file.filename
             m = mp.Manager()
@@ -255,30 +456,11 @@ class Hic(RegionMatrixTable):
                 pool = None
                 try:
                     logger.info("Launching processes")
-                    with mp.get_context("spawn").Pool(threads, _bin_hic_partition_worker,
-                                                      (file_name,
-                                                       qin, qout,
-                                                       msgpack.dumps(overlap_map),
-                                                       _edges_by_overlap_method,
-                                                       access_lock)) as pool:
-
-                        n_fragments = len(hic.regions)
-                        thread_max = min(int(n_fragments/threads), _regions_soft_max)
-                        partitions = [[0, 0]]
-                        previous_chromosome = None
-                        for i, region in enumerate(hic.regions(lazy=True)):
-                            if previous_chromosome is not None and (region.chromosome != previous_chromosome
-                                                                    or i == n_fragments - 1):
-                                partition_size = partitions[-1][1] - partitions[-1][0]
-                                current_size = i - partitions[-1][1]
-                                partition_empty = thread_max - partition_size
-
-                                if partition_size == 0 or partition_empty > current_size/2:
-                                    partitions[-1][1] = i
-                                else:
-                                    partitions.append([partitions[-1][1], i])
-                            previous_chromosome = region.chromosome
-                        partitions[-1][1] = n_fragments
+                    with mp.get_context("spawn").Pool(threads, worker,
+                                                      (file_name, qin, qout) +
+                                                      worker_args + (access_lock,)) as pool:
+
+                        partitions = _get_binning_partitions(hic, threads, _regions_soft_max)
 
                         logger.info("Submitting partitions")
 
@@ -303,9 +485,15 @@ class Hic(RegionMatrixTable):
                                 out = qout.get(block=True)
                                 if isinstance(out, Exception):
                                     raise out
-                                edges = msgpack.loads(out, use_list=False, strict_map_key=False)
-                                for (source, sink), weight in edges.items():
-                                    self.add_edge_simple(source, sink, weight=weight)
+                                if vectorised:
+                                    if out is not None:
+                                        sources, sinks, weights = out
+                                        self._add_edge_arrays({'source': sources, 'sink': sinks,
+                                                               self._default_score_field: weights})
+                                else:
+                                    edges = msgpack.loads(out, use_list=False, strict_map_key=False)
+                                    for (source, sink), weight in edges.items():
+                                        self.add_edge_simple(source, sink, weight=weight)
                                 pb.update(i)
                 finally:
                     for i in range(threads):
@@ -324,17 +512,24 @@ class Hic(RegionMatrixTable):
         :param threads: Number of threads used for binning
         :return: :class:`~Hic` object
         """
-        # find chromosome lengths
-        logger.info("Constructing binned genome...")
         if chromosomes is None:
             chromosomes = self.chromosomes()
-        chromosome_sizes = {chromosome: 0 for chromosome in chromosomes}
-        for region in self.regions():
-            if region.chromosome not in chromosome_sizes:
-                continue
-            if chromosome_sizes[region.chromosome] < region.end:
-                chromosome_sizes[region.chromosome] = region.end
 
+        logger.info("Binning edges...")
+        if 'mode' not in kwargs:
+            kwargs['mode'] = 'w'
+        hic = self.__class__(*args, **kwargs)
+        self._add_binned_regions(hic, bin_size, chromosomes)
+        hic.load_from_hic(self, threads=threads, chromosomes=chromosomes)
+
+        return hic
+
+    def _add_binned_regions(self, hic, bin_size, chromosomes):
+        """
+        Add equidistant bins along the chromosomes of this object to another object.
+        """
+        # find chromosome lengths
+        logger.info("Constructing binned genome...")
         chromosome_list = []
         for chromosome in chromosomes:
             chromosome_list.append(Chromosome(name=chromosome, length=self.chromosome_lengths[chromosome]))
@@ -343,15 +538,93 @@ class Hic(RegionMatrixTable):
         regions = genome.get_regions(bin_size)
         genome.close()
 
-        logger.info("Binning edges...")
-        if 'mode' not in kwargs:
-            kwargs['mode'] = 'w'
-        hic = self.__class__(*args, **kwargs)
         hic.add_regions(regions.regions(lazy=True), preserve_attributes=False)
         regions.close()
-        hic.load_from_hic(self, threads=threads, chromosomes=chromosomes)
 
-        return hic
+    def _load_from_hic_in_process(self, hic, _regions_soft_max=50000):
+        """
+        Bin the contacts of another :class:`~Hic` into the regions of this object.
+
+        Uses the vectorised Rao et al. (2014) approach in the current
+        process, which is efficient for already binned, small matrices.
+        """
+        first_ix, last_ix = _get_overlap_index_arrays(hic.regions(lazy=True), self.regions(lazy=True))
+        partitions = _get_binning_partitions(hic, regions_soft_max=_regions_soft_max)
+        weight_field = hic._default_score_field
+
+        with RareUpdateProgressBar(max_value=int(len(partitions) * (len(partitions) + 1) / 2),
+                                   silent=config.hide_progressbars, prefix="Binning") as pb:
+            n_chunks = 0
+            for cix1, partition1 in enumerate(partitions):
+                for partition2 in partitions[cix1:]:
+                    edges = hic._edge_subset_arrays(partition1, partition2,
+                                                    fields=['source', 'sink', weight_field])
+                    if len(edges['source']) > 0:
+                        sources, sinks, weights = _edges_overlap_split_rao_arrays(
+                            edges['source'], edges['sink'], edges[weight_field], first_ix, last_ix)
+                        self._add_edge_arrays({'source': sources, 'sink': sinks,
+                                               self._default_score_field: weights})
+                    n_chunks += 1
+                    pb.update(n_chunks)
+        self.flush()
+
+    def bin_pyramid(self, resolutions, file_prefix=None, threads=1, chromosomes=None,
+                    normalise=False, norm_method='KR', tmpdir=None, **norm_kwargs):
+        """
+        Map edges in this object to multiple bin sizes.
+
+        Only the smallest bin size is derived from this object directly.
+        Every larger bin size is obtained by aggregating the largest
+        smaller bin size it is a multiple of, so that the (fragment-level)
+        original matrix is only scanned once. Bin sizes that are not
+        a multiple of any smaller bin size are binned from this object.
+
+        :param resolutions: List of bin sizes in base pairs
+        :param file_prefix: If provided, each binned matrix is saved to
+                            <file_prefix>_<bin size>.hic, e.g.
+                            "sample_5kb.hic" or "sample_2.5kb.hic".
+                            Otherwise, objects are kept in memory.
+        :param threads: Number of threads used for binning this object.
+                        Bin sizes derived from a smaller bin size are
+                        aggregated in the current process, as the binned
+                        source matrices are comparatively small and may
+                        only exist in memory, where worker processes
+                        cannot access them
+        :param chromosomes: Optional list of chromosomes to bin
+        :param normalise: If True, normalise each binned matrix using
+                          :func:`~Hic.normalise`
+        :param norm_method: Normalisation method, see :func:`~Hic.normalise`
+        :param tmpdir: Optional temporary directory for output files
+        :param norm_kwargs: Keyword arguments passed to :func:`~Hic.normalise`
+        :return: dict of bin size: :class:`~Hic`
+        """
+        binned = dict()
+        for bin_size in sorted(set(resolutions)):
+            kwargs = {'mode': 'w', 'tmpdir': tmpdir}
+            if file_prefix is not None:
+                kwargs['file_name'] = _binned_file_name(file_prefix, bin_size)
+
+            source = self
+            for previous_bin_size in sorted(binned.keys(), reverse=True):
+                if bin_size % previous_bin_size == 0:
+                    source = binned[previous_bin_size]
+                    break
+
+            source_name = 'original matrix' if source is self else \
+                '{}b matrix'.format(_exact_bin_size_format(source.bin_size))
+            logger.info("Binning to {}b ({})".format(_exact_bin_size_format(bin_size), source_name))
+            if source is self:
+                hic = self.bin(bin_size, threads=threads, chromosomes=chromosomes, **kwargs)
+            else:
+                hic = self.__class__(**kwargs)
+                source._add_binned_regions(hic, bin_size, source.chromosomes())
+                hic._load_from_hic_in_process(source)
+
+            if normalise:
+                hic.normalise(method=norm_method, **norm_kwargs)
+            binned[bin_size] = hic
+
+        return binned
 
     def bias_vector(self, vector=None):
         """
@@ -616,6 +889,12 @@ class DiagonalFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which edges in an array of rows are on (or near) the diagonal.
+        """
+        return np.abs(rows['source'].astype(np.int64) - rows['sink']) > self.distance
+
 
 class LowCoverageFilter(HicEdgeFilter):
     """
@@ -650,7 +929,10 @@ class LowCoverageFilter(HicEdgeFilter):
         HicEdgeFilter.__init__(self, mask=mask)
         self.set_hic_object(hic_object)
 
-        self._marginals = hic_object.marginals(norm=False, masked=False)
+        if isinstance(hic_object, RegionMatrixTable):
+            self._marginals = _uncorrected_marginals(hic_object)
+        else:
+            self._marginals = hic_object.marginals(norm=False, masked=False)
         if cutoff is None and rel_cutoff is None:
             rel_cutoff = 0.1
             logger.info("Using default 10 percent relative coverage as cutoff")
@@ -662,10 +944,8 @@ class LowCoverageFilter(HicEdgeFilter):
             cutoff = self.calculate_cutoffs(rel_cutoff)[0]
         logger.info("Final absolute cutoff threshold is {:.4}".format(float(cutoff)))
 
-        self._regions_to_mask = set()
-        for i, contacts in enumerate(self._marginals):
-            if contacts < cutoff:
-                self._regions_to_mask.add(i)
+        self._region_mask = np.asarray(self._marginals) < cutoff
+        self._regions_to_mask = set(np.where(self._region_mask)[0])
         logger.info("Selected a total of {} ({:.1%}) regions to be masked".format(
             len(self._regions_to_mask), len(self._regions_to_mask)/len(hic_object.regions)))
 
@@ -684,6 +964,36 @@ class LowCoverageFilter(HicEdgeFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which edges in an array of rows fall into low-coverage regions.
+        """
+        return ~(self._region_mask[rows['source']] | self._region_mask[rows['sink']])
+
+
+def _uncorrected_marginals(hic, _chunk_size=1000000):
+    """
+    Calculate the uncorrected marginals of a :class:`~RegionMatrixTable`.
+
+    Equivalent to :code:`hic.marginals(norm=False, masked=False)`, but
+    sums up edge weights from column arrays rather than edge by edge.
+
+    :param hic: :class:`~RegionMatrixTable`
+    :return: numpy array of marginals, one entry per region
+    """
+    weight_field = hic._default_score_field
+    n_regions = len(hic.regions)
+    marginals = np.zeros(n_regions)
+    for _, edge_table in hic._iter_edge_tables():
+        for chunk_start in range(0, edge_table._original_len(), _chunk_size):
+            rows = edge_table.read(chunk_start, chunk_start + _chunk_size)
+            rows = rows[rows[edge_table._mask_field] == 0]
+            sources, sinks, weights = rows['source'], rows['sink'], rows[weight_field]
+            marginals += np.bincount(sources, weights=weights, minlength=n_regions)
+            off_diagonal = sources != sinks
+            marginals += np.bincount(sinks[off_diagonal], weights=weights[off_diagonal], minlength=n_regions)
+    return marginals
+
 
 def ice_balancing(hic, tolerance=1e-2, max_iterations=500, whole_matrix=True,
                   inter_chromosomal=True, intra_chromosomal=True, restore_coverage=False,
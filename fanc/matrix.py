@@ -1839,6 +1839,115 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
             self._enable_edge_indexes()
             self._flush_edges()
 
+    def _add_edge_arrays(self, edge_arrays):
+        """
+        Bulk-append edges provided as column arrays.
+
+        Edges are grouped by partition and appended to the respective
+        edge tables directly, bypassing the row-wise edge buffer.
+        Columns not provided are filled with their default value.
+
+        :param edge_arrays: dict of column name: numpy array. Must
+                            contain at least 'source' and 'sink'
+        """
+        if self._regions_dirty:
+            self._flush_regions()
+
+        source = np.asarray(edge_arrays['source'])
+        sink = np.asarray(edge_arrays['sink'])
+        if source.shape[0] == 0:
+            return
+
+        flip = source > sink
+        if np.any(flip):
+            source, sink = np.where(flip, sink, source), np.where(flip, source, sink)
+        edge_arrays = dict(edge_arrays, source=source, sink=sink)
+
+        if not self._edges_dirty:
+            self._edges_dirty = True
+            self._disable_edge_indexes()
+
+        template_table = self._edge_table(0, 0)
+        dtypes = [(name, template_table.coldtypes[name]) for name in template_table.colnames]
+
+        partition_breaks = np.array(self._partition_breaks, dtype=np.int64)
+        source_partitions = np.searchsorted(partition_breaks, source, side='right')
+        sink_partitions = np.searchsorted(partition_breaks, sink, side='right')
+        partition_keys = source_partitions * (len(partition_breaks) + 1) + sink_partitions
+        order = np.argsort(partition_keys, kind='stable')
+        keys, starts = np.unique(partition_keys[order], return_index=True)
+        ends = np.append(starts[1:], order.shape[0])
+
+        for key, start, end in zip(keys, starts, ends):
+            ixs = order[start:end]
+            source_partition, sink_partition = divmod(int(key), len(partition_breaks) + 1)
+            edge_table = self._edge_table(source_partition, sink_partition, create_index=False)
+
+            rows = np.empty(ixs.shape[0], dtype=dtypes)
+            for name in template_table.colnames:
+                try:
+                    rows[name] = np.asarray(edge_arrays[name])[ixs]
+                except KeyError:
+                    rows[name] = template_table.coldflts[name]
+            edge_table.append(rows)
+            edge_table.flush(update_index=False)
+
+    def _edge_subset_arrays(self, row_range, col_range, fields=None, excluded_filters=0):
+        """
+        Read edges between two ranges of region indexes as column arrays.
+
+        :param row_range: tuple (start, end) of region indexes, end exclusive
+        :param col_range: tuple (start, end) of region indexes, end exclusive
+        :param fields: list of column names to return. Defaults to source,
+                       sink and the default score field
+        :param excluded_filters: Binary mask of filters that should be ignored,
+                                 i.e. edges masked only by these filters are
+                                 still returned
+        :return: dict of column name: numpy array
+        """
+        if fields is None:
+            fields = ['source', 'sink']
+            if self._default_score_field is not None:
+                fields.append(self._default_score_field)
+
+        row_start, row_end = row_range
+        col_start, col_end = col_range
+        if row_end <= row_start or col_end <= col_start:
+            return {field: np.array([]) for field in fields}
+
+        # indexed queries combining several ranges with "|" can miss rows
+        # in PyTables, so only query (disjoint) source ranges on disk
+        source_ranges = sorted([(row_start, row_end), (col_start, col_end)])
+        if source_ranges[1][0] <= source_ranges[0][1]:
+            source_ranges = [(source_ranges[0][0], max(source_ranges[0][1], source_ranges[1][1]))]
+
+        partitions = set()
+        for a in range(self._get_partition_ix(row_start), self._get_partition_ix(row_end - 1) + 1):
+            for b in range(self._get_partition_ix(col_start), self._get_partition_ix(col_end - 1) + 1):
+                partitions.add((min(a, b), max(a, b)))
+
+        results = []
+        for i, j in sorted(partitions):
+            try:
+                edge_table = self._edge_table(i, j, create_if_missing=False)
+            except ValueError:
+                continue
+
+            rows = np.concatenate([edge_table.read_where("({} <= source) & (source < {})".format(start, end))
+                                   for start, end in source_ranges])
+            source, sink = rows['source'], rows['sink']
+            rows = rows[np.logical_or(
+                (row_start <= source) & (source < row_end) & (col_start <= sink) & (sink < col_end),
+                (col_start <= source) & (source < col_end) & (row_start <= sink) & (sink < row_end)
+            )]
+            masks = rows[edge_table._mask_field]
+            rows = rows[masks | excluded_filters == excluded_filters]
+            results.append({field: rows[field] for field in fields})
+
+        if len(results) == 0:
+            return {field: np.array([]) for field in fields}
+        return {field: np.concatenate([result[field] for result in results]) for field in fields}
+
     def _get_partition_ix(self, region_ix):
         """
         Bisect the partition table to get the partition index for a region index.
@@ -1928,6 +2037,80 @@ class RegionPairsTable(RegionPairsContainer, Maskable, RegionsTable):
 
                         yield edge_row
 
+    def _edge_subset_row_chunks(self, row_range, col_range, excluded_filters=0, chunk_size=100000):
+        """
+        Read edges between two ranges of region indexes as chunks of table rows.
+
+        Returns the same rows in the same order as
+        :func:`~RegionPairsTable._edge_subset_rows_from_regions`, but as
+        structured numpy arrays of at most chunk_size rows.
+
+        :param row_range: tuple (start, end) of region indexes, end inclusive
+        :param col_range: tuple (start, end) of region indexes, end inclusive
+        :param excluded_filters: Binary mask of filters that should be ignored,
+                                 i.e. edges masked only by these filters are
+                                 still returned
+        :param chunk_size: Maximum number of rows read from disk at once
+        :return: iterator over structured numpy arrays
+        """
+        row_start, row_end = row_range
+        col_start, col_end = col_range
+
+        row_partition_start = self._get_partition_ix(row_start)
+        row_partition_end = self._get_partition_ix(row_end)
+        col_partition_start = self._get_partition_ix(col_start)
+        col_partition_end = self._get_partition_ix(col_end)
+
+        partition_extracted = set()
+        for a in range(row_partition_start, row_partition_end + 1):
+            for b in range(col_partition_start, col_partition_end + 1):
+                i, j = (b, a) if b < a else (a, b)
+
+                if (i, j) in partition_extracted:
+                    continue
+                partition_extracted.add((i, j))
+
+                try:
+                    edge_table = self._edge_table(i, j, create_if_missing=False)
+                except ValueError:
+                    continue
+
+                if self._is_partition_covered(a, row_start, row_end) and \
+                        self._is_partition_covered(b, col_start, col_end):
+                    conditions = [None]
+                    overlap = None
+                else:
+                    condition = "({} <= source) & (source <= {}) & ({} <= sink) & (sink <= {})"
+                    conditions = [condition.format(row_start, row_end, col_start, col_end),
+                                  condition.format(col_start, col_end, row_start, row_end)]
+                    if row_start > col_start:
+                        conditions.reverse()
+                    overlap = range_overlap(row_start, row_end, col_start, col_end)
+
+                for condition_ix, condition in enumerate(conditions):
+                    if condition is None:
+                        coordinates = None
+                        n_rows = edge_table.nrows
+                    else:
+                        coordinates = edge_table.get_where_list(condition, sort=True)
+                        n_rows = len(coordinates)
+
+                    for chunk_start in range(0, n_rows, chunk_size):
+                        chunk_end = min(n_rows, chunk_start + chunk_size)
+                        if coordinates is None:
+                            rows = edge_table.read(chunk_start, chunk_end)
+                        else:
+                            rows = edge_table.read_coordinates(coordinates[chunk_start:chunk_end])
+
+                        keep = rows[edge_table._mask_field] | excluded_filters == excluded_filters
+                        if condition_ix > 0 and overlap is not None:
+                            keep &= ~((overlap[0] <= rows['source']) & (rows['source'] <= overlap[1]) &
+                                      (overlap[0] <= rows['sink']) & (rows['sink'] <= overlap[1]))
+                        rows = rows[keep]
+
+                        if len(rows) > 0:
+                            yield rows
+
     def _matrix_entries(self, key, row_regions, col_regions,
                         score_field=None, *args, **kwargs):
         if score_field is None:
@@ -2,13 +2,15 @@ from __future__ import division
 
 import copy
 import gzip
+import io
 import logging
 import multiprocessing as mp
 import os
+import struct
 import threading
 import uuid
+import zlib
 from abc import abstractmethod, ABCMeta
-from bisect import bisect_right
 from builtins import object
 from collections import defaultdict
 from queue import Empty
@@ -26,9 +28,9 @@ from future.utils import with_metaclass, viewitems, string_types
 from genomic_regions import GenomicRegion, RegionBased
 from .config import config
 from .general import MaskFilter, Mask
-from .hic import Hic
+from .hic import Hic, _binned_file_name, _exact_bin_size_format
 from .matrix import Edge, RegionPairsTable
-from .regions import genome_regions
+from .regions import genome_regions, Chromosome, Genome
 from .tools.general import RareUpdateProgressBar, add_dict, find_alignment_match_positions, WorkerMonitor
 from .tools.sambam import natural_cmp
 from .tools.files import split_sam_pairs
@@ -40,7 +42,8 @@ logger = logging.getLogger(__name__)
 def generate_pairs(sam1_file, sam2_file, regions,
                    restriction_enzyme=None, output_file=None,
                    read_filters=(), check_sorted=True,
-                   threads=1, batch_size=10000000):
+                   threads=1, batch_size=10000000, decompression_threads=1,
+                   pair_filters=None, drop_filtered=False, compact=False):
     """
     Generate Pairs object from SAM/BAM files.
 
@@ -62,21 +65,31 @@ def generate_pairs(sam1_file, sam2_file, regions,
                     fragments for read pairs
     :param batch_size: Number of read pairs sent to each restriction
                        fragment worker
+    :param decompression_threads: Number of threads used for decompressing
+                                  each BAM file
+    :param pair_filters: List of :class:`~FragmentReadPairFilter` applied
+                         while loading read pairs
+                         (see :func:`~ReadPairs.add_read_pairs_from_sam`)
+    :param drop_filtered: If True, read pairs filtered by pair_filters
+                          are not stored
+    :param compact: If True, create :class:`~ReadPairs` with compact schema
     :return: :class:`~ReadPairs`
     """
     regions = genome_regions(regions, restriction_enzyme=restriction_enzyme)
 
-    sb = SamBamReadPairGenerator(sam1_file, sam2_file, check_sorted=check_sorted)
+    sb = SamBamReadPairGenerator(sam1_file, sam2_file, check_sorted=check_sorted,
+                                 decompression_threads=decompression_threads)
     for f in read_filters:
         sb.add_filter(f)
 
-    pairs = ReadPairs(file_name=output_file, mode='w')
+    pairs = ReadPairs(file_name=output_file, mode='w', compact=compact)
 
     if isinstance(regions, RegionBased):
         pairs.add_regions(regions.regions, preserve_attributes=False)
     else:
         pairs.add_regions(regions, preserve_attributes=False)
-    pairs.add_read_pairs(sb, threads=threads, batch_size=batch_size)
+    pairs.add_read_pairs(sb, threads=threads, batch_size=batch_size,
+                         pair_filters=pair_filters, drop_filtered=drop_filtered)
 
     return pairs
 
@@ -84,7 +97,9 @@ def generate_pairs(sam1_file, sam2_file, regions,
 def generate_pairs_split(sam1_file, sam2_file, regions,
                          restriction_enzyme=None,
                          output_file=None, read_filters=(), check_sorted=True,
-                         threads=1, batch_size=1000000):
+                         threads=1, batch_size=1000000, decompression_threads=1,
+                         sort=False, pair_filters=None, drop_filtered=False, compact=False,
+                         resume=False):
     """
     Generate Pairs object from SAM/BAM files.
 
@@ -106,24 +121,52 @@ def generate_pairs_split(sam1_file, sam2_file, regions,
                     fragments for read pairs
     :param batch_size: Number of read pairs sent to each restriction
                        fragment worker
+    :param decompression_threads: Number of threads used for decompressing
+                                  each BAM file
+    :param sort: If True, SAM/BAM files do not need to be sorted by read
+                 name, and are sorted on the fly
+    :param pair_filters: List of :class:`~FragmentReadPairFilter` applied
+                         while loading read pairs
+                         (see :func:`~ReadPairs.add_read_pairs_from_sam`)
+    :param drop_filtered: If True, read pairs filtered by pair_filters
+                          are not stored
+    :param compact: If True, create :class:`~ReadPairs` with compact schema
+    :param resume: If True, record loading progress in output_file, and if
+                   output_file contains a loading checkpoint from an interrupted
+                   run, continue loading into the existing file
+                   (see :func:`~ReadPairs.add_read_pairs_from_sam`)
     :return: :class:`~ReadPairs`
     """
-    regions = genome_regions(regions, restriction_enzyme=restriction_enzyme)
+    pairs = None
+    if resume and output_file is not None and os.path.exists(output_file):
+        pairs = ReadPairs(file_name=output_file, mode='a')
+        if not pairs._has_sam_checkpoint():
+            logger.info("No loading checkpoint found in {}, starting from scratch".format(output_file))
+            pairs.close()
+            pairs = None
+        else:
+            logger.info("Resuming read pair loading into {}".format(output_file))
 
-    pairs = ReadPairs(file_name=output_file, mode='w')
+    if pairs is None:
+        regions = genome_regions(regions, restriction_enzyme=restriction_enzyme)
 
-    logger.debug("Adding regions")
-    if isinstance(regions, RegionBased):
-        for i, region in enumerate(regions.regions(lazy=True)):
-            if i % 100000 == 0:
-                logger.debug("{} regions".format(i))
-            pairs._add_region(region, preserve_attributes=False)
-        pairs.flush()
-    else:
-        pairs.add_regions(regions, preserve_attributes=False)
+        pairs = ReadPairs(file_name=output_file, mode='w', compact=compact)
+
+        logger.debug("Adding regions")
+        if isinstance(regions, RegionBased):
+            for i, region in enumerate(regions.regions(lazy=True)):
+                if i % 100000 == 0:
+                    logger.debug("{} regions".format(i))
+                pairs._add_region(region, preserve_attributes=False)
+            pairs.flush()
+        else:
+            pairs.add_regions(regions, preserve_attributes=False)
 
     pairs.add_read_pairs_from_sam(sam1_file, sam2_file, threads=threads, batch_size=batch_size,
-                                  read_filters=read_filters, check_sorted=check_sorted)
+                                  read_filters=read_filters, check_sorted=check_sorted,
+                                  decompression_threads=decompression_threads, sort=sort,
+                                  pair_filters=pair_filters, drop_filtered=drop_filtered,
+                                  resume=resume)
 
     return pairs
 
@@ -156,8 +199,248 @@ class Monitor(WorkerMonitor):
             return self.generating_pairs
 
 
+def _fragment_info_arrays(regions, chromosome_to_ix):
+    """
+    Build per-chromosome arrays of restriction fragment information.
+
+    :param regions: Iterable of restriction fragments, sorted by
+                    start within each chromosome
+    :param chromosome_to_ix: dict of chromosome name: chromosome index
+    :return: dict of chromosome name: (4, n) array with rows fragment
+             index, chromosome index, fragment start, and fragment end
+    """
+    fragment_infos = defaultdict(list)
+    for region in regions:
+        chromosome = region.chromosome
+        fragment_infos[chromosome].append((region.ix, chromosome_to_ix[chromosome],
+                                           region.start, region.end))
+    return {chromosome: np.array(infos, dtype=np.int64).T
+            for chromosome, infos in viewitems(fragment_infos)}
+
+
+def _assign_fragments(fragment_infos, chromosomes, positions, side='right'):
+    """
+    Find the restriction fragments for a batch of reads.
+
+    :param fragment_infos: dict from :func:`~_fragment_info_arrays`
+    :param chromosomes: List or array of read chromosome names
+    :param positions: List or array of read positions
+    :param side: 'right' assigns a read to the first fragment ending
+                 after its position, 'left' to the fragment containing
+                 its position (start <= position <= end)
+    :return: tuple of boolean array (True if a fragment was found)
+             and (4, n) array with fragment index, chromosome index,
+             start, and end for each read
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    found = np.zeros(positions.shape[0], dtype=bool)
+    infos = np.zeros((4, positions.shape[0]), dtype=np.int64)
+    if positions.shape[0] == 0:
+        return found, infos
+
+    chromosomes = np.array(chromosomes, dtype=object)
+    chromosomes[np.equal(chromosomes, None)] = ''
+    names, inverse = np.unique(chromosomes, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(names) + 1))
+
+    for i, name in enumerate(names):
+        name = name.decode() if isinstance(name, bytes) else name
+        try:
+            chromosome_infos = fragment_infos[name]
+        except KeyError:
+            continue
+
+        ixs = order[bounds[i]:bounds[i + 1]]
+        chromosome_positions = positions[ixs]
+        fragment_ixs = np.searchsorted(chromosome_infos[3], chromosome_positions, side=side)
+        valid = fragment_ixs < chromosome_infos.shape[1]
+        if side == 'left':
+            valid[valid] = chromosome_infos[2][fragment_ixs[valid]] <= chromosome_positions[valid]
+
+        found[ixs[valid]] = True
+        infos[:, ixs[valid]] = chromosome_infos[:, fragment_ixs[valid]]
+
+    return found, infos
+
+
+def _read_pair_fragment_info_array(fragment_infos, chromosomes1, positions1, flags1,
+                                   chromosomes2, positions2, flags2):
+    """
+    Find the restriction fragments for a batch of read pairs.
+
+    Read pairs where either read cannot be assigned to a fragment are skipped.
+
+    :return: tuple of (n, 12) array with read position, read strand,
+             fragment index, fragment chromosome index, fragment start, and
+             fragment end of the first and then the second read, and
+             the number of skipped read pairs
+    """
+    found1, infos1 = _assign_fragments(fragment_infos, chromosomes1, positions1)
+    found2, infos2 = _assign_fragments(fragment_infos, chromosomes2, positions2)
+    strands1 = np.where(np.asarray(flags1, dtype=np.int64) & 16, -1, 1)
+    strands2 = np.where(np.asarray(flags2, dtype=np.int64) & 16, -1, 1)
+
+    infos = np.vstack([np.asarray(positions1, dtype=np.int64), strands1, infos1,
+                       np.asarray(positions2, dtype=np.int64), strands2, infos2]).T
+    valid = found1 & found2
+    return infos[valid], int(np.sum(~valid))
+
+
+def _fragment_gap_sizes(fragment_infos):
+    """
+    Gap sizes between the fragments of read pairs.
+
+    Equivalent to :func:`~FragmentReadPair.get_gap_size` for
+    intra-chromosomal pairs.
+
+    :param fragment_infos: (n, 12) array as returned by
+                           :func:`~_read_pair_fragment_info_array`,
+                           with the lower fragment index on the left
+    :return: array of gap sizes
+    """
+    gaps = fragment_infos[:, 10] - fragment_infos[:, 5]
+    gaps[(fragment_infos[:, 4] == fragment_infos[:, 10]) | (gaps == 1)] = 0
+    return gaps
+
+
+def _pcr_duplicates(chromosomes1, chromosomes2, positions1, positions2, threshold=2):
+    """
+    Find PCR duplicates among read pairs.
+
+    Pairs are sorted by chromosomes and left read position, keeping
+    their original order for identical positions. A pair is considered
+    a duplicate if both of its read positions are within threshold of
+    the first pair of the current group of duplicates on the same
+    chromosomes. Otherwise it starts a new group. The first pair of each
+    group is kept.
+
+    :param chromosomes1: Array of chromosome indexes of the left reads
+    :param chromosomes2: Array of chromosome indexes of the right reads
+    :param positions1: Array of positions of the left reads
+    :param positions2: Array of positions of the right reads
+    :param threshold: Maximum distance between read positions of duplicates
+    :return: tuple of boolean array, True for duplicates, and array with
+             the number of pairs in each group of duplicates
+    """
+    n = len(positions1)
+    duplicates = np.zeros(n, dtype=bool)
+    if n < 2:
+        return duplicates, np.zeros(0, dtype=np.int64)
+
+    order = np.lexsort((np.arange(n), positions1, chromosomes2, chromosomes1))
+    chromosomes1 = np.asarray(chromosomes1)[order]
+    chromosomes2 = np.asarray(chromosomes2)[order]
+    positions1 = np.asarray(positions1)[order]
+    positions2 = np.asarray(positions2)[order]
+
+    # candidates have an earlier pair within threshold on both reads,
+    # found by comparing each pair to the pairs k positions before it
+    # for as long as they are inside the left read position window
+    candidates = np.zeros(n, dtype=bool)
+    active = np.arange(1, n)
+    k = 1
+    while active.shape[0] > 0:
+        active = active[active >= k]
+        previous = active - k
+        in_window = np.logical_and.reduce([
+            chromosomes1[active] == chromosomes1[previous],
+            chromosomes2[active] == chromosomes2[previous],
+            positions1[active] - positions1[previous] <= threshold,
+        ])
+        active, previous = active[in_window], previous[in_window]
+        close = np.abs(positions2[active] - positions2[previous]) <= threshold
+        candidates[active[close]] = True
+        active = active[~close]
+        k += 1
+
+    # a pair that is not a candidate always starts a new group, so each
+    # run of candidates only depends on the pair right before it
+    candidate_ixs = np.flatnonzero(candidates)
+    if candidate_ixs.shape[0] == 0:
+        return duplicates, np.zeros(0, dtype=np.int64)
+    new_run = np.concatenate([[True], np.diff(candidate_ixs) > 1])
+    run_starts = candidate_ixs[new_run]
+    run_ends = np.append(candidate_ixs[np.flatnonzero(new_run)[1:] - 1], candidate_ixs[-1]) + 1
+
+    # in most runs, all candidates are duplicates of the pair before the run
+    anchors = np.repeat(run_starts - 1, run_ends - run_starts)
+    close_to_anchor = np.logical_and(
+        positions1[candidate_ixs] - positions1[anchors] <= threshold,
+        np.abs(positions2[candidate_ixs] - positions2[anchors]) <= threshold,
+    )
+    simple_runs = np.logical_and.reduceat(close_to_anchor, np.flatnonzero(new_run))
+
+    sorted_duplicates = np.zeros(n, dtype=bool)
+    sorted_duplicates[candidate_ixs[np.repeat(simple_runs, run_ends - run_starts)]] = True
+    group_sizes = list(run_ends[simple_runs] - run_starts[simple_runs] + 1)
+
+    for start, end in zip(run_starts[~simple_runs], run_ends[~simple_runs]):
+        first, size = start - 1, 1
+        for i in range(start, end):
+            if (positions1[i] - positions1[first] <= threshold and
+                    abs(positions2[i] - positions2[first]) <= threshold):
+                sorted_duplicates[i] = True
+                size += 1
+                continue
+
+            if size > 1:
+                group_sizes.append(size)
+            first, size = i, 1
+        if size > 1:
+            group_sizes.append(size)
+
+    duplicates[order] = sorted_duplicates
+    return duplicates, np.array(group_sizes, dtype=np.int64)
+
+
+def _filter_fragment_infos(fragment_infos, pair_filters, drop_filtered=False):
+    """
+    Apply pair filters to an array of read pair fragment infos.
+
+    :param fragment_infos: (n, 12) array as returned by
+                           :func:`~_read_pair_fragment_info_array`,
+                           with the lower fragment index on the left
+    :param pair_filters: List of :class:`~FragmentReadPairFilter` that
+                         implement :func:`~FragmentReadPairFilter.valid_fragment_infos`
+    :param drop_filtered: If True, remove filtered pairs from the array
+                          instead of returning their masks
+    :return: tuple of fragment infos, binary masks (None if drop_filtered)
+             and a dict with the number of pairs filtered by each mask name.
+             If drop_filtered is True, the dict also contains the total
+             number of removed pairs under 'total'
+    """
+    masks = np.zeros(fragment_infos.shape[0], dtype=np.int32)
+    stats = defaultdict(int)
+    for pair_filter in pair_filters:
+        invalid = ~pair_filter.valid_fragment_infos(fragment_infos)
+        masks[invalid] |= 2 ** pair_filter.mask_ix
+        stats[pair_filter.mask_name] += int(np.sum(invalid))
+
+    if drop_filtered:
+        stats['total'] += int(np.sum(masks != 0))
+        return fragment_infos[masks == 0], None, stats
+    return fragment_infos, masks, stats
+
+
+def _fragment_info_pair(fragment_info, ix_to_chromosome):
+    """
+    Convert a row of read pair fragment infos to a :class:`~FragmentReadPair`.
+    """
+    reads = []
+    for offset in (0, 6):
+        position, strand, ix, chromosome_ix, start, end = (int(v) for v in fragment_info[offset:offset + 6])
+        fragment = GenomicRegion(chromosome=ix_to_chromosome[chromosome_ix], start=start, end=end, ix=ix)
+        reads.append(FragmentRead(fragment, position=position, strand=strand))
+    return FragmentReadPair(left_read=reads[0], right_read=reads[1])
+
+
 def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=10000000,
-                      tmpdir=None, check_sorted=True):
+                      tmpdir=None, check_sorted=True, decompression_threads=1,
+                      sort=False, sort_threads=1, completed_chunks=None):
+    if completed_chunks is None:
+        completed_chunks = dict()
+
     monitor.set_generating_pairs(True)
     try:
         if tmpdir is None:
@@ -166,11 +449,24 @@ def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=100
         output_prefix = os.path.join(tmpdir, 'split_pairs')
         try:
             logger.debug("Splitting and pairing SAM files")
-            for pairs_file, chunk_size, unmappable in split_sam_pairs(sam_file1, sam_file2, output_prefix,
-                                                                      chunk_size=batch_size,
-                                                                      check_sorted=check_sorted):
+            offset = 0
+            for chunk_id, (pairs_file, chunk_size, unmappable) in enumerate(
+                    split_sam_pairs(sam_file1, sam_file2, output_prefix,
+                                    chunk_size=batch_size,
+                                    check_sorted=check_sorted,
+                                    decompression_threads=decompression_threads,
+                                    sort=sort, sort_threads=sort_threads,
+                                    tmpdir=tmpdir, skip_chunks=set(completed_chunks.keys()))):
+                chunk_offset = offset
+                offset += chunk_size + unmappable
+                if chunk_id in completed_chunks:
+                    if completed_chunks[chunk_id] != (chunk_offset, chunk_size + unmappable):
+                        raise ValueError("Input files do not match the loading checkpoint "
+                                         "(chunk {} offset differs). Cannot resume!".format(chunk_id))
+                    logger.debug("Skipping completed pairs batch {}".format(chunk_id))
+                    continue
                 logger.debug("Split pairs batch {}".format(pairs_file))
-                input_queue.put([pairs_file, chunk_size, unmappable])
+                input_queue.put([pairs_file, chunk_size, unmappable, chunk_id, chunk_offset])
                 monitor.increment()
         except ValueError as e:
             logger.error(e)
@@ -180,9 +476,9 @@ def _split_sam_worker(sam_file1, sam_file2, input_queue, monitor, batch_size=100
         monitor.set_generating_pairs(False)
 
 
-def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe,
-                            partition_breaks, read_filters=None,
-                            tmpdir=None, buffer_size=1000000):
+def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fragment_infos,
+                            read_filters=None, tmpdir=None, pair_filters=None,
+                            drop_filtered=False, buffer_size=1000000):
     logger.debug("Launching SAM worker")
     worker_uuid = uuid.uuid4()
     monitor.set_worker_busy(worker_uuid)
@@ -191,6 +487,21 @@ def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe
     if tmpdir is None:
         tmpdir = tempfile.mkdtemp()
 
+    def _fragment_info(batch):
+        infos, skipped = _read_pair_fragment_info_array(fragment_infos, *batch)
+        # left read always maps to the fragment with the lower index
+        swap = infos[:, 2] > infos[:, 8]
+        infos[swap] = np.hstack([infos[swap, 6:], infos[swap, :6]])
+        if pair_filters:
+            infos, masks, stats = _filter_fragment_infos(infos, pair_filters,
+                                                         drop_filtered=drop_filtered)
+            for key, value in stats.items():
+                pair_filter_stats[key] += value
+            if masks is not None:
+                mask_batches.append(masks)
+        fragment_info_batches.append(infos)
+        return skipped
+
     file_counter = 0
     cumulative_wait_time = 0
     while True:
@@ -202,7 +513,7 @@ def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe
         if isinstance(input_data, Exception):
             output_file_queue.put(input_data)
             break
-        read_pairs_file, chunk_size, unmappable = input_data
+        read_pairs_file, chunk_size, unmappable, chunk_id, chunk_offset = input_data
         w = datetime.now() - s
         logger.debug("Worker {} wait time: {}".format(worker_uuid, w))
         cumulative_wait_time += w.total_seconds()
@@ -211,11 +522,11 @@ def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe
         monitor.set_worker_busy(worker_uuid)
         logger.debug('Worker {} received input!'.format(worker_uuid))
 
-        output_file = os.path.join(tmpdir, 'fragment_info_{}_{}.txt'.format(worker_uuid, file_counter))
+        output_file = os.path.join(tmpdir, 'fragment_info_{}_{}.{}'.format(
+            worker_uuid, file_counter, 'npz' if pair_filters and not drop_filtered else 'npy'))
         logger.debug("Writing fragment info to output file {}".format(output_file))
         file_counter += 1
 
-        lines = []
         skipped_counter = 0
         pair_generator = PairedSamBamReadPairGenerator(read_pairs_file)
         if read_filters is not None:
@@ -223,69 +534,57 @@ def _load_paired_sam_worker(monitor, input_file_queue, output_file_queue, fi, fe
                 pair_generator.add_filter(f)
         pair_generator._unmappable_count = unmappable
 
+        fragment_info_batches = []
+        mask_batches = []
+        pair_filter_stats = defaultdict(int)
+        batch = ([], [], [], [], [], [])
         for read1, read2 in pair_generator:
-            chrom1, pos1, flag1 = read1.reference_name, read1.pos, read1.flag
-            chrom2, pos2, flag2 = read2.reference_name, read2.pos, read2.flag
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
-
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
-
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
-
-                p_ix1 = bisect_right(partition_breaks, f_ix1)
-                p_ix2 = bisect_right(partition_breaks, f_ix2)
-
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
-
-                if p_ix1 > p_ix2:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2,
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1
-                    )
-                else:
-                    line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                        p_ix1, pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1,
-                        p_ix2, pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2
-                    )
-                lines.append(line)
-
-                if len(lines) > buffer_size:
-                    with open(output_file, 'a') as o:
-                        for line in lines:
-                            o.write(line)
-                    lines = []
-            except (KeyError, IndexError):
-                skipped_counter += 1
-
-        with open(output_file, 'a') as o:
-            for line in lines:
-                o.write(line)
+            batch[0].append(read1.reference_name)
+            batch[1].append(read1.pos)
+            batch[2].append(read1.flag)
+            batch[3].append(read2.reference_name)
+            batch[4].append(read2.pos)
+            batch[5].append(read2.flag)
+
+            if len(batch[0]) > buffer_size:
+                skipped_counter += _fragment_info(batch)
+                batch = ([], [], [], [], [], [])
+        skipped_counter += _fragment_info(batch)
+        if len(mask_batches) > 0:
+            np.savez(output_file, fragment_infos=np.vstack(fragment_info_batches),
+                     masks=np.concatenate(mask_batches))
+        else:
+            np.save(output_file, np.vstack(fragment_info_batches))
+        del fragment_info_batches, mask_batches
 
         logger.debug("Done obtaining fragment info for {} in {}".format(read_pairs_file, output_file))
-        output_file_queue.put((read_pairs_file, output_file, pair_generator.stats()))
+        logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped_counter))
+        output_file_queue.put((read_pairs_file, output_file, pair_generator.stats(),
+                               dict(pair_filter_stats),
+                               (chunk_id, chunk_offset, chunk_size + unmappable)))
 
         l = datetime.now() - s
         logger.debug("Worker {} load time: {}".format(worker_uuid, l))
 
 
-def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
+def _fragment_info_worker(monitor, input_queue, output_queue, fragment_infos,
+                          pair_filters=None, drop_filtered=False):
     """
     Worker that finds the restriction fragment info for read pairs.
 
     Finds the restriction fragment each read maps to, and returns the
     coordinates of the read and fragment pairs for each read pair.
+    The left read of each pair maps to the fragment with the lower index.
 
     :param monitor: :class:`~Monitor`
     :param input_queue: Queue for input read_pairs
     :param output_queue: Queue for output fragment infos
-    :param fi: Fragment info dictionary by chromosome and fragment index
-    :param fe: Fragment end coordinates by chromosome
-    :return: list of fragment infos
+    :param fragment_infos: Fragment info arrays by chromosome,
+                           see :func:`~_fragment_info_arrays`
+    :param pair_filters: Optional list of :class:`~FragmentReadPairFilter`
+                         to apply to read pairs, see :func:`~_filter_fragment_infos`
+    :param drop_filtered: If True, filtered read pairs are not returned
+    :return: tuple of fragment infos, masks and pair filter statistics
     """
     worker_uuid = uuid.uuid4()
     logger.debug("Starting fragment info worker {}".format(worker_uuid))
@@ -299,31 +598,44 @@ def _fragment_info_worker(monitor, input_queue, output_queue, fi, fe):
         logger.debug('Worker {} reveived input!'.format(worker_uuid))
         read_pairs = msgpack.loads(read_pairs, strict_map_key=False)
 
-        fragment_infos = []
-        skipped_counter = 0
-        for (chrom1, pos1, flag1), (chrom2, pos2, flag2) in read_pairs:
-            chrom1 = chrom1.decode() if isinstance(chrom1, bytes) else chrom1
-            chrom2 = chrom2.decode() if isinstance(chrom2, bytes) else chrom2
-
-            try:
-                pos_ix1 = bisect_right(fe[chrom1], pos1)
-                pos_ix2 = bisect_right(fe[chrom2], pos2)
+        fragment_infos_array, skipped_counter = _read_pair_fragment_info_array(fragment_infos, *read_pairs)
+        logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped_counter))
+        swap = fragment_infos_array[:, 2] > fragment_infos_array[:, 8]
+        fragment_infos_array[swap] = np.hstack([fragment_infos_array[swap, 6:],
+                                                fragment_infos_array[swap, :6]])
+
+        masks, pair_filter_stats = None, {}
+        if pair_filters:
+            fragment_infos_array, masks, pair_filter_stats = _filter_fragment_infos(
+                fragment_infos_array, pair_filters, drop_filtered=drop_filtered
+            )
+        output_queue.put((fragment_infos_array, masks, dict(pair_filter_stats)))
+        del read_pairs
 
-                f_ix1, f_chromosome_ix1, f_start1, f_end1 = fi[chrom1][pos_ix1]
-                f_ix2, f_chromosome_ix2, f_start2, f_end2 = fi[chrom2][pos_ix2]
 
-                r_strand1 = -1 if flag1 & 16 else 1
-                r_strand2 = -1 if flag2 & 16 else 1
+def _read_pair_batches(read_pairs, batch_size=1000000):
+    """
+    Group read pairs into column batches.
 
-                fragment_infos.append(
-                    ((pos1, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1),
-                     (pos2, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2))
-                )
-            except (KeyError, IndexError):
-                skipped_counter += 1
-        logger.debug("Worker {} skipped {} pairs".format(worker_uuid, skipped_counter))
-        output_queue.put(msgpack.dumps(fragment_infos))
-        del read_pairs
+    :param read_pairs: Iterator of read tuples (read1, read2)
+    :param batch_size: Maximum number of read pairs per batch
+    :return: iterator over tuples of lists with chromosomes,
+             positions, and flags of the first and then
+             the second read
+    """
+    batch = ([], [], [], [], [], [])
+    for read1, read2 in read_pairs:
+        batch[0].append(read1.reference_name)
+        batch[1].append(read1.pos)
+        batch[2].append(read1.flag)
+        batch[3].append(read2.reference_name)
+        batch[4].append(read2.pos)
+        batch[5].append(read2.flag)
+        if len(batch[0]) >= batch_size:
+            yield batch
+            batch = ([], [], [], [], [], [])
+    if len(batch[0]) > 0:
+        yield batch
 
 
 def _read_pairs_worker(read_pairs, input_queue, monitor, batch_size=100000):
@@ -337,26 +649,24 @@ def _read_pairs_worker(read_pairs, input_queue, monitor, batch_size=100000):
     """
     logger.debug("Starting read pairs worker")
     try:
-        read_pairs_batch = []
-        for read1, read2 in read_pairs:
-            read_pairs_batch.append((
-                (read1.reference_name, read1.pos, read1.flag),
-                (read2.reference_name, read2.pos, read2.flag)
-            ))
-            if len(read_pairs_batch) >= batch_size:
-                logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
-                input_queue.put(msgpack.dumps(read_pairs_batch))
-                read_pairs_batch = []
-                monitor.increment()
-        if len(read_pairs_batch) > 0:
-            logger.debug("Submitting read pair batch ({}) to input queue".format(batch_size))
-            input_queue.put(msgpack.dumps(read_pairs_batch))
+        if isinstance(read_pairs, ReadPairGenerator):
+            batches = read_pairs.batches(batch_size)
+        else:
+            batches = _read_pair_batches(read_pairs, batch_size)
+
+        for read_pairs_batch in batches:
+            logger.debug("Submitting read pair batch ({}) to input queue".format(len(read_pairs_batch[0])))
+            input_queue.put(msgpack.dumps([c.tolist() if isinstance(c, np.ndarray) else c
+                                           for c in read_pairs_batch]))
             monitor.increment()
     finally:
         monitor.set_generating_pairs(False)
     logger.debug("Terminating read pairs worker")
 
 
+_plus_strands = {'+', '+1', '1', 1}
+
+
 class MinimalRead(object):
     """
     Minimal class representing an aligned read.
@@ -394,7 +704,7 @@ class MinimalRead(object):
         self.reference_name = chromosome
         self.position = position
         self.strand = strand
-        self.flag = 0 if strand == '+' or strand == 1 else -1
+        self.flag = 0 if strand in _plus_strands else -1
         self.pos = position
         self.tags = {}
 
@@ -496,6 +806,380 @@ class ReadPairGenerator(object):
             self._total_pairs += 1
 
 
+    def batches(self, batch_size=1000000):
+        """
+        Iterate over batches of filtered read pairs.
+
+        Subclasses may override this to read batches directly
+        from their input.
+
+        :param batch_size: Maximum number of read pairs per batch
+        :return: iterator over tuples of lists (or arrays) with
+                 chromosomes, positions, and flags (16 for reads
+                 on the minus strand) of the first and then the
+                 second read in each pair
+        """
+        return _read_pair_batches(self, batch_size)
+
+    def to_hic(self, bin_size, regions, filters=None, pcr_duplicate_threshold=None,
+               file_name=None, tmpdir=None, batch_size=1000000, _hic_class=Hic):
+        """
+        Bin read pairs directly into a :class:`~fanc.Hic` object.
+
+        This is a shortcut for loading read pairs into a :class:`~ReadPairs`
+        object, filtering them, and converting them to a binned
+        :class:`~fanc.Hic` object. Read pairs are only assigned to
+        restriction fragments for filtering, and contacts are counted in
+        memory, so no intermediate pairs file is written. Note that read pairs
+        are binned by the positions of their reads, rather than by splitting
+        fragment-level contacts across overlapping bins as in :func:`~fanc.Hic.bin`.
+
+        .. code::
+
+            import fanc
+
+            re_fragments = fanc.genome_regions("hg19_chr18_19.fa", "HindIII")
+            rp_generator = fanc.SamBamReadPairGenerator("output/sam/SRR4271982_chr18_19_1_sort.bam",
+                                                        "output/sam/SRR4271982_chr18_19_2_sort.bam")
+            hic = rp_generator.to_hic(100000, re_fragments,
+                                      filters=[fanc.pairs.SelfLigationFilter(mask='self-ligations')],
+                                      pcr_duplicate_threshold=2)
+
+        :param bin_size: Bin size in base pairs, or list of bin sizes
+        :param regions: Restriction fragments, either a
+                        :class:`~genomic_regions.RegionBased` object or a
+                        list of :class:`~genomic_regions.GenomicRegion`
+        :param filters: List of :class:`~FragmentReadPairFilter`, which are
+                        applied to each read pair.
+        :param pcr_duplicate_threshold: If not None, filter PCR duplicates
+                                        with this threshold (see
+                                        :class:`~PCRDuplicateFilter`). Read
+                                        positions are spilled to temporary
+                                        files by chromosome pair, and duplicates
+                                        are found one chromosome pair at a time.
+                                        Memory use is then bounded by the
+                                        number of pairs in the largest
+                                        chromosome pair (roughly 40 bytes
+                                        per pair).
+        :param file_name: Path to the output file. If multiple bin sizes are
+                          provided, output files are named
+                          <file_name>_<bin size>.hic, e.g. "sample_5kb.hic"
+        :param tmpdir: If True (or path to temporary directory) will
+                       work in temporary directory until closed. If a path,
+                       read positions for PCR duplicate detection are also
+                       spilled there
+        :param batch_size: Number of read pairs processed at once
+        :return: :class:`~fanc.Hic`, or dict of bin size: :class:`~fanc.Hic`
+                 if multiple bin sizes are provided
+        """
+        if filters is None:
+            filters = []
+
+        if isinstance(bin_size, (list, tuple)):
+            bin_sizes = sorted(set(bin_size))
+        else:
+            bin_sizes = [bin_size]
+
+        if isinstance(regions, RegionBased):
+            regions = regions.regions(lazy=True)
+
+        chromosome_to_ix = dict()
+        chromosome_lengths = dict()
+        fragment_infos = defaultdict(list)
+        for i, region in enumerate(regions):
+            chromosome = region.chromosome
+            if chromosome not in chromosome_to_ix:
+                chromosome_to_ix[chromosome] = len(chromosome_to_ix)
+            fragment_infos[chromosome].append((i, chromosome_to_ix[chromosome], region.start, region.end))
+            chromosome_lengths[chromosome] = max(region.end, chromosome_lengths.get(chromosome, 0))
+        fragment_infos = {chromosome: np.array(infos, dtype=np.int64).T
+                          for chromosome, infos in viewitems(fragment_infos)}
+        ix_to_chromosome = {ix: chromosome for chromosome, ix in viewitems(chromosome_to_ix)}
+
+        hics = dict()
+        bin_offsets = dict()
+        bin_counts = dict()
+        genome = Genome(chromosomes=[Chromosome(name=ix_to_chromosome[ix],
+                                                length=chromosome_lengths[ix_to_chromosome[ix]])
+                                     for ix in range(len(ix_to_chromosome))])
+        for size in bin_sizes:
+            hic_file_name = file_name
+            if file_name is not None and len(bin_sizes) > 1:
+                hic_file_name = _binned_file_name(file_name, size)
+            hic = _hic_class(file_name=hic_file_name, mode='w', tmpdir=tmpdir)
+            bins = genome.get_regions(size)
+            hic.add_regions(bins.regions(lazy=True), preserve_attributes=False)
+            bins.close()
+
+            chromosome_bins = hic.chromosome_bins
+            bin_offsets[size] = np.array([chromosome_bins[ix_to_chromosome[ix]][0]
+                                          for ix in range(len(ix_to_chromosome))], dtype=np.int64)
+            bin_counts[size] = np.array([chromosome_bins[ix_to_chromosome[ix]][1]
+                                         for ix in range(len(ix_to_chromosome))], dtype=np.int64) - \
+                bin_offsets[size]
+            hics[size] = hic
+        genome.close()
+
+        filter_names = [f.mask_name if f.mask_name != 'default' else 'filter_{}'.format(i)
+                        for i, f in enumerate(filters)]
+        pair_stats = defaultdict(int)
+        batch_counts = {size: [] for size in bin_sizes}
+        n_chromosomes = len(chromosome_to_ix)
+        spill_dtype = np.dtype([('position1', np.int32), ('position2', np.int32), ('valid', bool)])
+        spill_dir = None
+        if pcr_duplicate_threshold is not None:
+            spill_dir = tempfile.mkdtemp(dir=tmpdir if isinstance(tmpdir, string_types) else None)
+        spill_keys = set()
+
+        def _spill(chromosomes1, positions1, chromosomes2, positions2, valid):
+            # duplicates can only occur within a chromosome pair, so pairs are
+            # stored in one file per chromosome pair and processed separately
+            keys = chromosomes1 * n_chromosomes + chromosomes2
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            records = np.empty(order.shape[0], dtype=spill_dtype)
+            records['position1'] = positions1[order]
+            records['position2'] = positions2[order]
+            records['valid'] = valid[order]
+            boundaries = np.flatnonzero(np.diff(keys)) + 1
+            for start, end in zip(np.concatenate([[0], boundaries]),
+                                  np.append(boundaries, keys.shape[0])):
+                key = int(keys[start])
+                spill_keys.add(key)
+                with open(os.path.join(spill_dir, '{}.bin'.format(key)), 'ab') as f:
+                    records[start:end].tofile(f)
+
+        def _count(chromosomes1, positions1, chromosomes2, positions2):
+            # read positions are 0-based
+            for size in bin_sizes:
+                bins1 = bin_offsets[size][chromosomes1] + np.clip(positions1 // size, 0,
+                                                                  bin_counts[size][chromosomes1] - 1)
+                bins2 = bin_offsets[size][chromosomes2] + np.clip(positions2 // size, 0,
+                                                                  bin_counts[size][chromosomes2] - 1)
+                n_bins = int(np.sum(bin_counts[size]))
+                keys = np.minimum(bins1, bins2) * n_bins + np.maximum(bins1, bins2)
+                batch_counts[size].append(np.unique(keys, return_counts=True))
+
+        def _process(batch):
+            infos, skipped = _read_pair_fragment_info_array(fragment_infos, *batch)
+            pair_stats['unmappable'] += skipped
+
+            swap = infos[:, 2] > infos[:, 8]
+            infos[swap] = np.hstack([infos[swap, 6:], infos[swap, :6]])
+
+            valid = np.ones(infos.shape[0], dtype=bool)
+            for f, name in zip(filters, filter_names):
+                valid_filter = f.valid_fragment_infos(infos)
+                if valid_filter is None:
+                    valid_filter = np.array([f.valid_pair(_fragment_info_pair(info, ix_to_chromosome))
+                                             for info in infos], dtype=bool)
+                pair_stats[name] += int(np.sum(~valid_filter))
+                valid &= valid_filter
+
+            if pcr_duplicate_threshold is None:
+                _count(infos[valid, 3], infos[valid, 0], infos[valid, 9], infos[valid, 6])
+            else:
+                # filtered pairs are kept, as they can still be the first
+                # pair of a group of duplicates (see PCRDuplicateFilter)
+                _spill(infos[:, 3], infos[:, 0], infos[:, 9], infos[:, 6], valid)
+
+        try:
+            for batch in self.batches(batch_size):
+                _process(batch)
+
+            if pcr_duplicate_threshold is not None:
+                logger.info("Finding PCR duplicates")
+                with RareUpdateProgressBar(max_value=len(spill_keys), silent=config.hide_progressbars,
+                                           prefix="Duplicates") as pb:
+                    for i, key in enumerate(sorted(spill_keys)):
+                        records = np.fromfile(os.path.join(spill_dir, '{}.bin'.format(key)),
+                                              dtype=spill_dtype)
+                        same_chromosomes = np.zeros(records.shape[0], dtype=np.int8)
+                        duplicates, _ = _pcr_duplicates(same_chromosomes, same_chromosomes,
+                                                        records['position1'], records['position2'],
+                                                        threshold=pcr_duplicate_threshold)
+                        pair_stats['PCR duplicates'] += int(np.sum(duplicates))
+                        valid = records['valid'] & ~duplicates
+                        n_valid = int(np.sum(valid))
+                        _count(np.full(n_valid, key // n_chromosomes, dtype=np.int64),
+                               records['position1'][valid].astype(np.int64),
+                               np.full(n_valid, key % n_chromosomes, dtype=np.int64),
+                               records['position2'][valid].astype(np.int64))
+                        pb.update(i + 1)
+        finally:
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir)
+
+        stats = self.stats()
+        stats['unmappable'] += pair_stats.pop('unmappable', 0)
+        stats.update(pair_stats)
+
+        for size in bin_sizes:
+            hic = hics[size]
+            keys, weights = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            if len(batch_counts[size]) > 0:
+                keys, inverse = np.unique(np.concatenate([k for k, _ in batch_counts[size]]),
+                                          return_inverse=True)
+                weights = np.bincount(inverse, weights=np.concatenate([c for _, c in batch_counts[size]]))
+                weights = weights.astype(np.int64)
+            del batch_counts[size][:]
+            n_bins = int(np.sum(bin_counts[size]))
+            hic._add_edge_arrays({'source': keys // n_bins, 'sink': keys % n_bins,
+                                  hic._default_score_field: weights.astype(np.float64)})
+            hic.flush()
+            stats['valid'] = int(np.sum(weights))
+            hic.meta.read_filter_stats = stats
+            logger.info("Added {} contacts to {}b matrix".format(stats['valid'],
+                                                                 _exact_bin_size_format(size)))
+
+        if len(bin_sizes) == 1:
+            return hics[bin_sizes[0]]
+        return hics
+
+
+def _bgzf_buffer_block_size(data, offset=0):
+    """
+    Size of the BGZF block starting at offset in data, or None if there is no valid block.
+    """
+    if len(data) < offset + 12 or bytes(data[offset:offset + 4]) != b'\x1f\x8b\x08\x04':
+        return None
+    extra_length = struct.unpack('<H', data[offset + 10:offset + 12])[0]
+    i, extra_end = offset + 12, min(offset + 12 + extra_length, len(data))
+    while i + 4 <= extra_end:
+        subfield_length = struct.unpack('<H', data[i + 2:i + 4])[0]
+        if bytes(data[i:i + 2]) == b'BC' and subfield_length == 2 and i + 6 <= extra_end:
+            return struct.unpack('<H', data[i + 4:i + 6])[0] + 1
+        i += 4 + subfield_length
+    return None
+
+
+def _bgzf_block_size(f, offset):
+    """
+    Size of the BGZF block starting at offset in file f, or None if there is no valid block.
+    """
+    f.seek(offset)
+    header = f.read(12)
+    if len(header) == 12:
+        header += f.read(struct.unpack('<H', header[10:12])[0])
+    return _bgzf_buffer_block_size(header)
+
+
+def _bgzf_decompress(data):
+    """
+    Decompress consecutive BGZF blocks.
+
+    Faster than :func:`gzip.decompress` for many small gzip members.
+    """
+    view = memoryview(data)
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_size = _bgzf_buffer_block_size(view, offset)
+        if block_size is None:
+            raise ValueError("Invalid BGZF block at offset {}".format(offset))
+        blocks.append(zlib.decompress(view[offset:offset + block_size], 31))
+        offset += block_size
+    return b''.join(blocks)
+
+
+def _bgzf_block_offsets(file_name):
+    """
+    Get the compressed offsets of all blocks in a BGZF file.
+
+    Offsets are read from a "<file_name>.gzi" index if it exists,
+    otherwise they are found by reading every block header.
+
+    :param file_name: Path to a (possibly) bgzipped file
+    :return: list of block offsets, or None if the file is not
+             BGZF compressed
+    """
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        if _bgzf_block_size(f, 0) is None:
+            return None
+
+        index_file = file_name + '.gzi'
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as index:
+                n_blocks = struct.unpack('<Q', index.read(8))[0]
+                entries = np.frombuffer(index.read(16 * n_blocks), dtype='<u8').reshape(-1, 2)
+            offsets = [0] + [int(offset) for offset in entries[:, 0]]
+            if all(offset < file_size and _bgzf_block_size(f, offset) is not None for offset in offsets):
+                return offsets
+            logger.warning("BGZF index {} does not match file, scanning blocks instead".format(index_file))
+
+        offsets = []
+        offset = 0
+        while offset < file_size:
+            block_size = _bgzf_block_size(f, offset)
+            if block_size is None:
+                return None
+            offsets.append(offset)
+            offset += block_size
+    if offset != file_size:
+        return None
+    return offsets
+
+
+def _parse_pairs_bgzf_range(file_name, start, end, read_csv_kwargs, fields, batch_size=1000000):
+    """
+    Parse the lines of a bgzipped text pairs file that start in a range of blocks.
+
+    Except for the first range, lines up to and including the first newline
+    belong to the previous range, which in turn reads into the following
+    blocks until its last line is complete.
+
+    :return: list of batches with chromosome categories and codes, positions,
+             and flags of the first and then the second read
+    """
+    import pandas as pd
+
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        data = _bgzf_decompress(f.read(end - start))
+        if start > 0:
+            data = data[data.find(b'\n') + 1:] if b'\n' in data else b''
+
+        offset = end
+        while offset < file_size:
+            block_size = _bgzf_block_size(f, offset)
+            f.seek(offset)
+            block = zlib.decompress(f.read(block_size), 31)
+            offset += block_size
+            if b'\n' in block:
+                data += block[:block.find(b'\n') + 1]
+                break
+            data += block
+
+    # header lines only occur at the start of the file
+    while data.startswith(b'#'):
+        data = data[data.find(b'\n') + 1:] if b'\n' in data else b''
+    if data.strip() == b'':
+        return []
+
+    chr1_field, pos1_field, strand1_field, chr2_field, pos2_field, strand2_field = fields
+    # chromosomes are returned as categories and codes, which are much
+    # faster to send back to the main process than arrays of strings
+    dtype = dict(read_csv_kwargs['dtype'])
+    dtype[chr1_field] = dtype[chr2_field] = 'category'
+    read_csv_kwargs = dict(read_csv_kwargs, dtype=dtype)
+    batches = []
+    for chunk in pd.read_csv(io.BytesIO(data), chunksize=batch_size, **read_csv_kwargs):
+        batch = []
+        for chromosome_field, position_field, strand_field in ((chr1_field, pos1_field, strand1_field),
+                                                               (chr2_field, pos2_field, strand2_field)):
+            chromosomes = chunk[chromosome_field]
+            batch += [np.array(chromosomes.cat.categories, dtype=object), chromosomes.cat.codes.values,
+                      chunk[position_field].values]
+            if strand_field is None:
+                batch.append(np.zeros(len(chunk), dtype=np.int64))
+            else:
+                batch.append(np.where(chunk[strand_field].isin(_plus_strands), 0, 16))
+        batches.append(batch)
+    return batches
+
+
 class TxtReadPairGenerator(ReadPairGenerator):
     """
     Generate read pairs from a plain text file.
@@ -512,10 +1196,16 @@ class TxtReadPairGenerator(ReadPairGenerator):
     "pos<1|2>_field", and "strand<1|2>_field". If your file does not
     have strand fields, or if you don't want to load them, you can
     simply set them to "None".
+
+    Bgzipped files can be parsed by multiple processes by setting
+    "threads". Each process parses a separate range of BGZF blocks.
     """
+    # compressed bytes per range of BGZF blocks parsed by one process
+    _bgzf_range_size = 16 * 1024 ** 2
+
     def __init__(self, valid_pairs_file, sep=None,
                  chr1_field=1, pos1_field=2, strand1_field=3,
-                 chr2_field=4, pos2_field=5, strand2_field=6):
+                 chr2_field=4, pos2_field=5, strand2_field=6, threads=1):
         """
         Initialise read pair generator.
 
@@ -535,9 +1225,12 @@ class TxtReadPairGenerator(ReadPairGenerator):
                            for the second mate's position on the reference in bp
         :param strand2_field: int, index of the field which has the information
                               for the second mate's strand (+/-)
+        :param threads: Number of processes used for parsing bgzipped files
+                        (see :func:`~TxtReadPairGenerator.batches`)
         """
         ReadPairGenerator.__init__(self)
         self._file_name = valid_pairs_file
+        self.threads = threads
         self.sep = sep
         self.chr1_field = chr1_field
         self.pos1_field = pos1_field
@@ -611,6 +1304,118 @@ class TxtReadPairGenerator(ReadPairGenerator):
                                     strand=strand2)
                 yield (read1, read2)
 
+    def _header_lines(self):
+        """
+        Number of comment lines at the start of the file.
+        """
+        n = 0
+        with self._open_file(self._file_name, 'rt') as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                n += 1
+        return n
+
+    def batches(self, batch_size=1000000):
+        """
+        Iterate over batches of read pairs parsed directly from the txt file.
+
+        Uses the pandas C parser to read the file in chunks, which is
+        much faster than parsing it line by line. Falls back to
+        :func:`~ReadPairGenerator.batches` if read filters have been added.
+
+        If the file is bgzipped and threads is larger than 1, it is split
+        into ranges of BGZF blocks, which are decompressed and parsed in
+        separate processes. Block offsets are read from a "<file>.gzi"
+        index (bgzip -i) if available, otherwise from the block headers.
+        Batches are returned in file order.
+
+        :param batch_size: Maximum number of read pairs per batch
+        :return: iterator over tuples of arrays with chromosomes,
+                 positions, and flags of the first and then the
+                 second read in each pair
+        """
+        if len(self.filters) > 0:
+            for batch in ReadPairGenerator.batches(self, batch_size):
+                yield batch
+            return
+
+        import pandas as pd
+
+        fields = [self.chr1_field, self.pos1_field, self.strand1_field,
+                  self.chr2_field, self.pos2_field, self.strand2_field]
+        dtypes = [str, np.int64, str, str, np.int64, str]
+        dtype = {field: field_dtype for field, field_dtype in zip(fields, dtypes) if field is not None}
+
+        self._filter_stats = defaultdict(int)
+        self._total_pairs = 0
+        self._valid_pairs = 0
+        read_csv_kwargs = dict(sep=r'\s+' if self.sep is None else self.sep, header=None,
+                               usecols=sorted(dtype.keys()), dtype=dtype)
+
+        block_offsets = None
+        if self.threads > 1 and self._open_file is gzip.open:
+            block_offsets = _bgzf_block_offsets(self._file_name)
+            if block_offsets is None:
+                logger.info("{} is not bgzipped, parsing it in a single process".format(self._file_name))
+
+        if block_offsets is not None:
+            for batch in self._bgzf_batches(block_offsets, read_csv_kwargs, fields, batch_size):
+                yield batch
+                self._total_pairs += len(batch[1])
+                self._valid_pairs += len(batch[1])
+            return
+
+        reader = pd.read_csv(self._file_name, skiprows=self._header_lines(), chunksize=batch_size,
+                             compression='gzip' if self._open_file is gzip.open else None,
+                             **read_csv_kwargs)
+        for chunk in reader:
+            flags = []
+            for field in (self.strand1_field, self.strand2_field):
+                if field is None:
+                    flags.append(np.zeros(len(chunk), dtype=np.int64))
+                else:
+                    flags.append(np.where(chunk[field].isin(_plus_strands), 0, 16))
+
+            yield (chunk[self.chr1_field].values, chunk[self.pos1_field].values, flags[0],
+                   chunk[self.chr2_field].values, chunk[self.pos2_field].values, flags[1])
+            self._total_pairs += len(chunk)
+            self._valid_pairs += len(chunk)
+
+    def _bgzf_batches(self, block_offsets, read_csv_kwargs, fields, batch_size):
+        """
+        Parse ranges of BGZF blocks in parallel, see :func:`~TxtReadPairGenerator.batches`.
+        """
+        file_size = os.path.getsize(self._file_name)
+        range_starts = [0]
+        for offset in block_offsets[1:]:
+            if offset - range_starts[-1] >= self._bgzf_range_size:
+                range_starts.append(offset)
+        range_ends = range_starts[1:] + [file_size]
+        logger.debug("Parsing {} in {} ranges of BGZF blocks".format(self._file_name, len(range_starts)))
+
+        # only a limited number of parsed ranges is held in memory
+        pool = mp.get_context("spawn").Pool(self.threads)
+        try:
+            pending = []
+            ranges = iter(zip(range_starts, range_ends))
+            while True:
+                for start, end in ranges:
+                    pending.append(pool.apply_async(_parse_pairs_bgzf_range,
+                                                    (self._file_name, start, end, read_csv_kwargs,
+                                                     fields, batch_size)))
+                    if len(pending) >= 2 * self.threads:
+                        break
+                if len(pending) == 0:
+                    break
+
+                for (categories1, codes1, positions1, flags1,
+                     categories2, codes2, positions2, flags2) in pending.pop(0).get():
+                    yield (categories1[codes1], positions1, flags1,
+                           categories2[codes2], positions2, flags2)
+        finally:
+            pool.terminate()
+
 
 class HicProPairGenerator(TxtReadPairGenerator):
     """
@@ -619,15 +1424,17 @@ class HicProPairGenerator(TxtReadPairGenerator):
     This generator is a subclass of :class:`~TxtReadPairGenerator`
     with presets for fields in HiC-Pro validPairs files.
     """
-    def __init__(self, file_name):
+    def __init__(self, file_name, threads=1):
         """
         Inititalise this HiC-Pro read pair generator.
 
         :param file_name: Path to HiC-Pro ".validPairs" file
+        :param threads: Number of processes used for parsing bgzipped files
         """
         TxtReadPairGenerator.__init__(self, file_name, sep="\t",
                                       chr1_field=1, pos1_field=2, strand1_field=3,
-                                      chr2_field=4, pos2_field=5, strand2_field=6)
+                                      chr2_field=4, pos2_field=5, strand2_field=6,
+                                      threads=threads)
 
 
 class FourDNucleomePairGenerator(TxtReadPairGenerator):
@@ -638,7 +1445,14 @@ class FourDNucleomePairGenerator(TxtReadPairGenerator):
     https://github.com/4dn-dcic/pairix/blob/master/pairs_format_specification.md
 
     """
-    def __init__(self, pairs_file):
+    def __init__(self, pairs_file, threads=1):
+        """
+        Inititalise this 4D Nucleome read pair generator.
+
+        :param pairs_file: Path to 4D Nucleome ".pairs" file, which may be
+                           gzipped or bgzipped (e.g. ".pairs.gz")
+        :param threads: Number of processes used for parsing bgzipped files
+        """
         if pairs_file.endswith('.gz') or pairs_file.endswith('gzip'):
             open_file = gzip.open
         else:
@@ -655,6 +1469,9 @@ class FourDNucleomePairGenerator(TxtReadPairGenerator):
                 if line.startswith('#columns:'):
                     columns_line = line
 
+                if not line.startswith('#'):
+                    break
+
             if columns_line is None:
                 raise ValueError("Pairs file does not contain a "
                                  "'#columns' entry in the header")
@@ -673,7 +1490,7 @@ class FourDNucleomePairGenerator(TxtReadPairGenerator):
                                       chr2_field=columns[chromosome2_field_id],
                                       pos2_field=columns['pos2'],
                                       strand2_field=columns['strand2'] if 'strand2' in columns else None,
-                                      )
+                                      threads=threads)
 
 
 class PairedSamBamReadPairGenerator(ReadPairGenerator):
@@ -688,10 +1505,14 @@ class PairedSamBamReadPairGenerator(ReadPairGenerator):
     of the chimeric alignment maps within 100bp of the regular alignment,
     the read pair is kept and returned. In all other cases, the pair is
     removed.
+
+    BAM input can be decompressed using multiple threads by
+    setting "decompression_threads".
     """
-    def __init__(self, sam_file):
+    def __init__(self, sam_file, decompression_threads=1):
         ReadPairGenerator.__init__(self)
         self.sam_file = sam_file
+        self.decompression_threads = decompression_threads
 
     @staticmethod
     def resolve_chimeric(reads, max_dist_same_locus=500):
@@ -745,7 +1566,7 @@ class PairedSamBamReadPairGenerator(ReadPairGenerator):
         if isinstance(self.sam_file, pysam.AlignmentFile):
             sam = self.sam_file
         else:
-            sam = pysam.AlignmentFile(self.sam_file)
+            sam = pysam.AlignmentFile(self.sam_file, threads=self.decompression_threads)
 
         chimeric_pairs = 0
         normal_pairs = 0
@@ -805,12 +1626,16 @@ class SamBamReadPairGenerator(ReadPairGenerator):
     of the chimeric alignment maps within 100bp of the regular alignment,
     the read pair is kept and returned. In all other cases, the pair is
     removed.
+
+    BAM input can be decompressed using multiple threads by
+    setting "decompression_threads".
     """
-    def __init__(self, sam_file1, sam_file2, check_sorted=True):
+    def __init__(self, sam_file1, sam_file2, check_sorted=True, decompression_threads=1):
         ReadPairGenerator.__init__(self)
         self.sam_file1 = sam_file1
         self.sam_file2 = sam_file2
         self._check_sorted = check_sorted
+        self.decompression_threads = decompression_threads
         if not os.path.exists(self.sam_file1):
             raise ValueError("File {} does not exist!".format(self.sam_file1))
         if not os.path.exists(self.sam_file2):
@@ -829,11 +1654,14 @@ class SamBamReadPairGenerator(ReadPairGenerator):
                     reads.append(last_read)
 
             next_read = None
+            qname = reads[0].qname.encode() if len(reads) > 0 else None
             try:
                 next_read = next(iterator)
-                while len(reads) == 0 or natural_cmp(next_read.qname.encode(), reads[0].qname.encode()) == 0:
+                while qname is None or natural_cmp(next_read.qname.encode(), qname) == 0:
                     if not next_read.is_unmapped:
                         reads.append(next_read)
+                        if qname is None:
+                            qname = next_read.qname.encode()
                     else:
                         self._unmappable_count += 1
                     next_read = next(iterator)
@@ -877,8 +1705,8 @@ class SamBamReadPairGenerator(ReadPairGenerator):
                     return read1, read2, True
             return None, None, False
 
-        with pysam.AlignmentFile(self.sam_file1) as sam1:
-            with pysam.AlignmentFile(self.sam_file2) as sam2:
+        with pysam.AlignmentFile(self.sam_file1, threads=self.decompression_threads) as sam1:
+            with pysam.AlignmentFile(self.sam_file2, threads=self.decompression_threads) as sam2:
                 normal_pairs = 0
                 chimeric_pairs = 0
                 abnormal_pairs = 0
@@ -1086,17 +1914,22 @@ class LazyFragment(GenomicRegion):
         self._side = side
         self._static_ix = ix
 
+    def _coordinate(self, field, coordinate_ix):
+        if getattr(self._pairs, '_compact', False):
+            return self._pairs._fragment_coordinates()[coordinate_ix, self.ix]
+        return self._row[self._side + field]
+
     @property
     def chromosome(self):
-        return self._pairs._ix_to_chromosome[self._row[self._side + "_fragment_chromosome"]]
+        return self._pairs._ix_to_chromosome[self._coordinate("_fragment_chromosome", 0)]
 
     @property
     def start(self):
-        return self._row[self._side + "_fragment_start"]
+        return self._coordinate("_fragment_start", 1)
 
     @property
     def end(self):
-        return self._row[self._side + "_fragment_end"]
+        return self._coordinate("_fragment_end", 2)
 
     @property
     def strand(self):
@@ -1163,7 +1996,7 @@ class ReadPairs(RegionPairsTable):
                  _group_name='fragment_map',
                  _table_name_fragments='fragments',
                  _table_name_pairs='pairs',
-                 tmpdir=None):
+                 tmpdir=None, compact=False):
         """
         Initialize empty FragmentMappedReadPairs object.
 
@@ -1173,21 +2006,37 @@ class ReadPairs(RegionPairsTable):
         :param mode: File mode. Defaults to 'a' (append). Use 'w' to overwrite
                      an existing file in the same location, and 'r' for safe
                      read-only access.
-        """
+        :param compact: If True, new objects only store fragment indexes,
+                        read positions and strands for each read pair.
+                        Fragment coordinates are looked up from the regions
+                        of this object instead, which roughly halves the
+                        file size. Ignored for existing files.
+        """
+        if compact:
+            edge_fields = {
+                'ix': t.Int32Col(pos=0),
+                'left_read_position': t.Int64Col(pos=1),
+                'left_read_strand': t.Int8Col(pos=2),
+                'right_read_position': t.Int64Col(pos=3),
+                'right_read_strand': t.Int8Col(pos=4),
+            }
+        else:
+            edge_fields = {
+                'ix': t.Int32Col(pos=0),
+                'left_read_position': t.Int64Col(pos=1),
+                'left_read_strand': t.Int8Col(pos=2),
+                'left_fragment_start': t.Int64Col(pos=3),
+                'left_fragment_end': t.Int64Col(pos=4),
+                'left_fragment_chromosome': t.Int32Col(pos=5),
+                'right_read_position': t.Int64Col(pos=6),
+                'right_read_strand': t.Int8Col(pos=7),
+                'right_fragment_start': t.Int64Col(pos=8),
+                'right_fragment_end': t.Int64Col(pos=9),
+                'right_fragment_chromosome': t.Int32Col(pos=10)
+            }
+
         RegionPairsTable.__init__(self, file_name=file_name, mode=mode, tmpdir=tmpdir,
-                                  additional_edge_fields={
-                                      'ix': t.Int32Col(pos=0),
-                                      'left_read_position': t.Int64Col(pos=1),
-                                      'left_read_strand': t.Int8Col(pos=2),
-                                      'left_fragment_start': t.Int64Col(pos=3),
-                                      'left_fragment_end': t.Int64Col(pos=4),
-                                      'left_fragment_chromosome': t.Int32Col(pos=5),
-                                      'right_read_position': t.Int64Col(pos=6),
-                                      'right_read_strand': t.Int8Col(pos=7),
-                                      'right_fragment_start': t.Int64Col(pos=8),
-                                      'right_fragment_end': t.Int64Col(pos=9),
-                                      'right_fragment_chromosome': t.Int32Col(pos=10)
-                                  },
+                                  additional_edge_fields=edge_fields,
                                   partition_strategy=partition_strategy,
                                   _table_name_regions=_table_name_fragments,
                                   _table_name_edges=_table_name_pairs)
@@ -1198,14 +2047,21 @@ class ReadPairs(RegionPairsTable):
         else:
             self._pair_count = None
 
+        # compact pairs do not store fragment coordinates
+        self._compact = 'left_fragment_start' not in self._field_names_dict
+
         self._ix_to_chromosome = dict()
         self._chromosome_to_ix = dict()
+        self._fragment_infos = None
+        self._fragment_coordinates_array = None
         self._update_references()
 
     def _update_references(self):
         """
         Update internal chromosome index dictionaries.
         """
+        self._fragment_infos = None
+        self._fragment_coordinates_array = None
         if self._chromosomes_info is not None:
             for row in self._chromosomes_info.iterrows():
                 ix, chromosome = row['ix'], row['name'].decode()
@@ -1237,17 +2093,131 @@ class ReadPairs(RegionPairsTable):
         """
         RegionPairsTable.flush(self, silent=silent)
 
+    def _fragment_info_arrays(self):
+        """
+        Get (cached) per-chromosome fragment info arrays.
+
+        See :func:`~_fragment_info_arrays` for details.
+        """
+        if self._fragment_infos is None:
+            self._fragment_infos = _fragment_info_arrays(self.regions(lazy=True), self._chromosome_to_ix)
+        return self._fragment_infos
+
+    def _fragment_coordinates(self):
+        """
+        Get (cached) chromosome index, start, and end of all fragments.
+
+        :return: (3, n) array with chromosome index, start, and
+                 end for each fragment, indexed by fragment ix
+        """
+        if self._fragment_coordinates_array is None:
+            fragment_infos = self._fragment_info_arrays()
+            n_fragments = max([int(infos[0].max()) + 1 for infos in fragment_infos.values()
+                               if infos.shape[1] > 0] + [0])
+            coordinates = np.zeros((3, n_fragments), dtype=np.int64)
+            for infos in fragment_infos.values():
+                coordinates[:, infos[0]] = infos[1:]
+            self._fragment_coordinates_array = coordinates
+        return self._fragment_coordinates_array
+
+    def _rows_fragment_infos(self, rows):
+        """
+        Convert read pair rows to an array of fragment infos.
+
+        Works for both compact and regular pair tables.
+
+        :param rows: Structured array of read pair rows
+        :return: (n, 12) array, see :func:`~_read_pair_fragment_info_array`
+        """
+        if self._compact:
+            coordinates = self._fragment_coordinates()
+            left = coordinates[:, rows['source']]
+            right = coordinates[:, rows['sink']]
+        else:
+            left = [rows['left_fragment_chromosome'], rows['left_fragment_start'], rows['left_fragment_end']]
+            right = [rows['right_fragment_chromosome'], rows['right_fragment_start'], rows['right_fragment_end']]
+
+        return np.vstack([rows['left_read_position'], rows['left_read_strand'], rows['source'],
+                          left[0], left[1], left[2],
+                          rows['right_read_position'], rows['right_read_strand'], rows['sink'],
+                          right[0], right[1], right[2]]).T.astype(np.int64)
+
+    def _pairs_fragment_infos(self, excluded_filters=0, sample=None, random_seed=0,
+                              chunk_size=1000000):
+        """
+        Get fragment infos for (a random sample of) all read pairs.
+
+        :param excluded_filters: Binary mask or list of masks (or 'all') of
+                                 filters that should be ignored, i.e. pairs
+                                 masked only by these filters are still returned
+        :param sample: If an integer, return fragment infos for a random
+                       sample of this many read pairs
+        :param random_seed: Seed for drawing a reproducible sample
+        :param chunk_size: Number of rows read at once from each table
+        :return: (n, 12) array, see :func:`~_read_pair_fragment_info_array`
+        """
+        if not isinstance(excluded_filters, int):
+            if excluded_filters == 'all':
+                excluded_filters = list(self.masks())
+            excluded_filters = self.get_binary_mask_from_masks(excluded_filters)
+
+        edge_tables = [edge_table for _, edge_table in self._iter_edge_tables()
+                       if edge_table._original_len() > 0]
+
+        results = []
+        if sample is None:
+            for edge_table in edge_tables:
+                for start in range(0, edge_table._original_len(), chunk_size):
+                    rows = edge_table.read(start, start + chunk_size)
+                    masks = rows[edge_table._mask_field]
+                    rows = rows[masks | excluded_filters == excluded_filters]
+                    results.append(self._rows_fragment_infos(rows))
+        else:
+            valid_coordinates = []
+            for edge_table in edge_tables:
+                masks = edge_table.col(edge_table._mask_field)
+                valid_coordinates.append(np.nonzero(masks | excluded_filters == excluded_filters)[0])
+            n_valid = np.cumsum([0] + [coordinates.shape[0] for coordinates in valid_coordinates])
+
+            sample = min(sample, int(n_valid[-1]))
+            random_state = np.random.RandomState(random_seed)
+            sample_ixs = np.sort(random_state.choice(n_valid[-1], sample, replace=False))
+            table_ixs = np.searchsorted(n_valid, sample_ixs, side='right') - 1
+            for i, edge_table in enumerate(edge_tables):
+                ixs = sample_ixs[table_ixs == i] - n_valid[i]
+                if ixs.shape[0] > 0:
+                    rows = edge_table.read_coordinates(valid_coordinates[i][ixs])
+                    results.append(self._rows_fragment_infos(rows))
+
+        if len(results) == 0:
+            return np.zeros((0, 12), dtype=np.int64)
+        return np.vstack(results)
+
+    def restriction_site_distances(self, sample=None, random_seed=0, excluded_filters=0):
+        """
+        Get the sum of distances to the nearest restriction site of both reads.
+
+        :param sample: If an integer, only return distances for a random
+                       sample of this many read pairs
+        :param random_seed: Seed for drawing a reproducible sample
+        :param excluded_filters: Masks of filters to ignore,
+                                 see :func:`~ReadPairs._pairs_fragment_infos`
+        :return: numpy array of distances
+        """
+        infos = self._pairs_fragment_infos(excluded_filters=excluded_filters, sample=sample,
+                                           random_seed=random_seed)
+        left_distances = np.minimum(np.abs(infos[:, 0] - infos[:, 4]), np.abs(infos[:, 0] - infos[:, 5]))
+        right_distances = np.minimum(np.abs(infos[:, 6] - infos[:, 10]), np.abs(infos[:, 6] - infos[:, 11]))
+        return left_distances + right_distances
+
     def _read_fragment_info(self, read):
-        chromosome = read.reference_name
-        fragment_info = None
-        for row in self._regions.where(
-                        "(start <= %d) & (end >= %d) & (chromosome == b'%s')" % (read.pos, read.pos, chromosome)):
-            fragment_info = [row['ix'], self._chromosome_to_ix[chromosome], row['start'], row['end']]
+        found, infos = _assign_fragments(self._fragment_info_arrays(), [read.reference_name], [read.pos],
+                                         side='left')
 
-        if fragment_info is None:
+        if not found[0]:
             raise ValueError("No matching region can be found for {}".format(read))
 
-        return fragment_info
+        return infos[:, 0].tolist()
 
     def _read_pair_fragment_info(self, read_pair):
         read1, read2 = read_pair
@@ -1258,7 +2228,8 @@ class ReadPairs(RegionPairsTable):
         return ((read1.pos, r_strand1, f_ix1, f_chromosome_ix1, f_start1, f_end1),
                 (read2.pos, r_strand2, f_ix2, f_chromosome_ix2, f_start2, f_end2))
 
-    def _read_pairs_fragment_info(self, read_pairs, threads=4, batch_size=1000000, timeout=600):
+    def _read_pairs_fragment_info(self, read_pairs, threads=4, batch_size=1000000, timeout=600,
+                                  pair_filters=None, drop_filtered=False):
         """
         Parallel loading of read pairs along with mapping to restriction fragments.
 
@@ -1270,14 +2241,15 @@ class ReadPairs(RegionPairsTable):
         :param timeout: Time to wait for reply of first worker. If this
                         threshold is exceeded before any read pairs have been
                         returned, a warning is displayed.
+        :param pair_filters: Optional list of :class:`~FragmentReadPairFilter`
+                             evaluated in the workers
+        :param drop_filtered: If True, read pairs filtered by pair_filters
+                              are not returned
+        :return: iterator over tuples of (n, 12) fragment info arrays (see
+                 :func:`~_read_pair_fragment_info_array`), binary masks
+                 (or None) and dicts of pair filter statistics
         """
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        fragment_infos = self._fragment_info_arrays()
 
         worker_pool = None
         t_pairs = None
@@ -1296,16 +2268,13 @@ class ReadPairs(RegionPairsTable):
             logger.debug("Launching fragment info workers")
             with mp.get_context("spawn").Pool(threads, _fragment_info_worker,
                                               (monitor, input_queue, output_queue,
-                                               fragment_infos, fragment_ends)) as worker_pool:
+                                               fragment_infos, pair_filters,
+                                               drop_filtered)) as worker_pool:
                 output_counter = 0
                 while output_counter < monitor.value() or not monitor.workers_idle() or monitor.is_generating_pairs():
                     try:
-                        read_pair_infos = output_queue.get(block=True, timeout=timeout)
-
-                        for read1_info, read2_info in msgpack.loads(read_pair_infos, strict_map_key=False):
-                            yield read1_info, read2_info
+                        yield output_queue.get(block=True, timeout=timeout)
                         output_counter += 1
-                        del read_pair_infos
                     except Empty:
                         logger.warning("Reached SAM pair generator timeout. This could mean that no "
                                        "valid read pairs were found after filtering. "
@@ -1348,6 +2317,14 @@ class ReadPairs(RegionPairsTable):
             self.flush()
 
     def load_read_pairs_fragment_info_file(self, read_pairs_file):
+        if read_pairs_file.endswith('.npy'):
+            return self._load_read_pairs_fragment_info_array(np.load(read_pairs_file))
+
+        if read_pairs_file.endswith('.npz'):
+            with np.load(read_pairs_file) as data:
+                return self._load_read_pairs_fragment_info_array(data['fragment_infos'],
+                                                                 masks=data['masks'])
+
         if read_pairs_file.endswith('.gz') or read_pairs_file.endswith('.gzip'):
             open_ = gzip.open
         else:
@@ -1381,18 +2358,251 @@ class ReadPairs(RegionPairsTable):
                 self._edge_buffer.add_dict(edge, partition=(int(info1[0]), int(info2[0])))
                 self._pair_count += 1
 
+    def _load_read_pairs_fragment_info_array(self, fragment_infos, masks=None):
+        """
+        Bulk-add read pairs from an array of fragment infos.
+
+        :param fragment_infos: (n, 12) array with read position, read strand,
+                               fragment index, fragment chromosome index,
+                               fragment start, and fragment end for the left
+                               and then the right read. The left read must
+                               map to the fragment with the lower index.
+        :param masks: Optional array of binary masks for each read pair,
+                      e.g. from pair filters applied during import
+        """
+        if self._pair_count is None:
+            self._pair_count = sum(edge_table._original_len()
+                                   for _, edge_table in self._iter_edge_tables())
+
+        n_pairs = fragment_infos.shape[0]
+        edge_arrays = {}
+        if masks is not None:
+            edge_arrays[self._edge_table(0, 0)._mask_field] = masks
+        edge_arrays.update({
+            'ix': np.arange(self._pair_count, self._pair_count + n_pairs),
+            'source': fragment_infos[:, 2], 'sink': fragment_infos[:, 8],
+            'left_read_position': fragment_infos[:, 0], 'right_read_position': fragment_infos[:, 6],
+            'left_read_strand': fragment_infos[:, 1], 'right_read_strand': fragment_infos[:, 7],
+            'left_fragment_start': fragment_infos[:, 4], 'right_fragment_start': fragment_infos[:, 10],
+            'left_fragment_end': fragment_infos[:, 5], 'right_fragment_end': fragment_infos[:, 11],
+            'left_fragment_chromosome': fragment_infos[:, 3], 'right_fragment_chromosome': fragment_infos[:, 9],
+        })
+        self._add_edge_arrays(edge_arrays)
+        self._pair_count += n_pairs
+
+    def _import_filters(self, pair_filters):
+        """
+        Prepare pair filters for evaluation while read pairs are added.
+
+        Masks of the filters are added to this object, unless a mask
+        with the same name already exists.
+
+        :param pair_filters: List of :class:`~FragmentReadPairFilter`
+        :return: list of filters
+        """
+        if pair_filters is None:
+            return []
+
+        mask_ixs = {mask.name: mask.ix for mask in self.masks()}
+        for pair_filter in pair_filters:
+            if pair_filter.valid_fragment_infos(np.zeros((0, 12), dtype=np.int64)) is None:
+                raise ValueError("{} cannot be applied while adding read pairs, use "
+                                 "ReadPairs.filter after import instead".format(type(pair_filter).__name__))
+            if pair_filter.mask_name not in mask_ixs:
+                mask = self.add_mask_description(pair_filter.mask_name, pair_filter.mask_description)
+                mask_ixs[mask.name] = mask.ix
+            pair_filter.mask_ix = mask_ixs[pair_filter.mask_name]
+        return list(pair_filters)
+
+    def _add_pair_filter_stats(self, stats):
+        """
+        Record the number of read pairs dropped by pair filters in meta.
+        """
+        if 'pair_filter_stats' not in self.meta:
+            self.meta.pair_filter_stats = dict(stats)
+        else:
+            self.meta.pair_filter_stats = add_dict(self.meta.pair_filter_stats, stats)
+
+    class SamCheckpointChunkDescription(t.IsDescription):
+        """
+        Chunks of read pairs completely loaded from SAM/BAM files.
+        """
+        chunk = t.Int64Col(pos=0)
+        offset = t.Int64Col(pos=1)
+        pairs = t.Int64Col(pos=2)
+        loaded = t.Int64Col(pos=3)
+
+    class SamCheckpointStatsDescription(t.IsDescription):
+        """
+        Read filter ('read') and pair filter ('pair') statistics of loaded chunks.
+        """
+        chunk = t.Int64Col(pos=0)
+        type = t.StringCol(4, pos=1)
+        name = t.StringCol(255, pos=2)
+        count = t.Int64Col(pos=3)
+
+    _sam_checkpoint_group_name = 'sam_load_checkpoint'
+
+    def _has_sam_checkpoint(self):
+        return '/' + self._sam_checkpoint_group_name in self.file
+
+    @staticmethod
+    def _sam_checkpoint_inputs(sam_file1, sam_file2, batch_size, sort):
+        inputs = []
+        for sam_file in (sam_file1, sam_file2):
+            if isinstance(sam_file, string_types) and os.path.exists(sam_file):
+                inputs.append((os.path.abspath(sam_file), os.path.getsize(sam_file)))
+            else:
+                inputs.append(None)
+        return inputs + [batch_size, sort]
+
+    def _init_sam_checkpoint(self, inputs):
+        """
+        Create a new, empty loading checkpoint in this object.
+
+        :param inputs: list describing input files and batch size,
+                       which must be identical when resuming
+        """
+        if self._has_sam_checkpoint():
+            self.file.remove_node('/', self._sam_checkpoint_group_name, recursive=True)
+
+        group = self.file.create_group('/', self._sam_checkpoint_group_name)
+        self.file.create_table(group, 'chunks', ReadPairs.SamCheckpointChunkDescription)
+        self.file.create_table(group, 'stats', ReadPairs.SamCheckpointStatsDescription)
+        group._v_attrs.inputs = inputs
+        group._v_attrs.pair_count = self._pair_count
+        group._v_attrs.complete = False
+        self.file.flush()
+
+    def _sam_checkpoint(self, inputs):
+        """
+        Load the loading checkpoint of this object.
+
+        Pairs added after the last completed chunk are removed.
+
+        :param inputs: list describing input files and batch size,
+                       which must be identical to those of the checkpoint
+        :return: tuple (dict <chunk>: (<offset>, <pairs>) of completed chunks,
+                 dict of read filter stats, dict of pair filter stats,
+                 True if all chunks have been loaded)
+        """
+        group = self.file.get_node('/', self._sam_checkpoint_group_name)
+        if group._v_attrs.inputs != inputs:
+            raise ValueError("Loading checkpoint was created for different input files "
+                             "or batch size ({}), cannot resume!".format(group._v_attrs.inputs))
+
+        pair_count = group._v_attrs.pair_count
+        if self._pair_count > pair_count:
+            logger.info("Removing {} read pairs from incomplete chunks".format(self._pair_count - pair_count))
+            self._remove_pairs_from(pair_count)
+
+        chunks = {chunk: (offset, pairs) for chunk, offset, pairs, _ in group.chunks.read().tolist()}
+        stats = {'read': defaultdict(int), 'pair': defaultdict(int)}
+        for _, stats_type, name, count in group.stats.read().tolist():
+            stats[stats_type.decode()][name.decode()] += count
+        return chunks, stats['read'], stats['pair'], bool(group._v_attrs.complete)
+
+    def _save_sam_checkpoint_chunk(self, chunk_id, offset, chunk_pairs, loaded, stats, pair_filter_stats):
+        """
+        Record a completely loaded chunk in the loading checkpoint.
+        """
+        group = self.file.get_node('/', self._sam_checkpoint_group_name)
+        group.chunks.append([(chunk_id, offset, chunk_pairs, loaded)])
+        stats_rows = [(chunk_id, 'read', name, count) for name, count in stats.items()] + \
+                     [(chunk_id, 'pair', name, count) for name, count in pair_filter_stats.items()]
+        if len(stats_rows) > 0:
+            group.stats.append(stats_rows)
+        group._v_attrs.pair_count = self._pair_count
+        self.file.flush()
+
+    def _complete_sam_checkpoint(self):
+        group = self.file.get_node('/', self._sam_checkpoint_group_name)
+        group._v_attrs.complete = True
+        self.file.flush()
+
+    def _remove_pairs_from(self, pair_ix):
+        """
+        Remove all read pairs with index pair_ix or higher.
+
+        Relies on pairs being appended to each edge table
+        in order of their index.
+        """
+        for _, edge_table in self._iter_edge_tables():
+            n_rows = edge_table._original_len()
+            if n_rows == 0:
+                continue
+            ixs = edge_table.col('ix')
+            first = int(np.searchsorted(ixs, pair_ix))
+            if first < n_rows:
+                edge_table.remove_rows(first, n_rows)
+                edge_table.flush()
+        self._pair_count = pair_ix
+        self._edges_dirty = True
+
     def add_read_pairs_from_sam(self, sam_file1, sam_file2, batch_size=1000000, threads=1,
-                                read_filters=None, check_sorted=True, tmpdir=None):
+                                read_filters=None, check_sorted=True, tmpdir=None,
+                                decompression_threads=1, sort=False, pair_filters=None,
+                                drop_filtered=False, resume=False):
+        """
+        Add read pairs from two SAM/BAM files to this object.
+
+        SAM/BAM files are split into chunks of read pairs, which are
+        assigned to restriction fragments in parallel.
+
+        :param sam_file1: Path to a SAM/BAM file (1st mate)
+        :param sam_file2: Path to a SAM/BAM file (2nd mate)
+        :param batch_size: Number of read pairs in each chunk
+        :param threads: Number of worker processes
+        :param read_filters: List of :class:`~ReadFilter` to filter reads
+        :param check_sorted: Double-check that input SAM files
+                             are sorted if True (default)
+        :param tmpdir: Directory for temporary files
+        :param decompression_threads: Number of threads used for decompressing
+                                      each BAM file
+        :param sort: If True, SAM/BAM files do not need to be sorted by read
+                     name, and are sorted on the fly while pairing reads
+                     (see :func:`~fanc.tools.files.natural_sorted_reads`)
+        :param pair_filters: List of :class:`~FragmentReadPairFilter` that are
+                             evaluated in the worker processes while pairs are
+                             added, instead of in a separate pass over
+                             all pairs with :func:`~ReadPairs.filter`. Filters
+                             must support :func:`~FragmentReadPairFilter.valid_fragment_infos`
+        :param drop_filtered: If True, read pairs filtered by pair_filters are
+                              not stored at all. Only their counts are recorded
+                              (see :func:`~ReadPairs.filter_statistics`)
+        :param resume: If True, every loaded chunk is recorded in a checkpoint
+                       in this object. If the object already contains a
+                       checkpoint from an interrupted run with the same input
+                       files and batch_size, completed chunks are skipped
+                       and pairs from incomplete chunks are removed before
+                       loading continues
+        """
+        pair_filters = self._import_filters(pair_filters)
+
+        if self._pair_count is None:
+            self._pair_count = sum(edge_table._original_len()
+                                   for _, edge_table in self._iter_edge_tables())
+
+        completed_chunks = dict()
+        all_stats = defaultdict(int)
+        all_pair_filter_stats = defaultdict(int)
+        if resume:
+            inputs = self._sam_checkpoint_inputs(sam_file1, sam_file2, batch_size, sort)
+            if self._has_sam_checkpoint():
+                completed_chunks, all_stats, all_pair_filter_stats, complete = self._sam_checkpoint(inputs)
+                if complete:
+                    logger.info("All read pairs have already been loaded from {} and {}".format(sam_file1,
+                                                                                               sam_file2))
+                    return
+                if len(completed_chunks) > 0:
+                    logger.info("Resuming after {} completed chunks".format(len(completed_chunks)))
+            else:
+                self._init_sam_checkpoint(inputs)
+
         self._edges_dirty = True
         self._disable_edge_indexes()
 
-        fragment_infos = defaultdict(list)
-        fragment_ends = defaultdict(list)
-        for region in self.regions(lazy=True):
-            chromosome = region.chromosome
-            fragment_infos[chromosome].append((region.ix, self._chromosome_to_ix[chromosome],
-                                               region.start, region.end))
-            fragment_ends[chromosome].append(region.end)
+        fragment_infos = self._fragment_info_arrays()
 
         if tmpdir is None:
             split_tmpdir = tempfile.mkdtemp()
@@ -1403,7 +2613,6 @@ class ReadPairs(RegionPairsTable):
 
         worker_pool = None
         t_split = None
-        all_stats = defaultdict(int)
         try:
             queue_manager = mp.Manager()
             input_file_queue = queue_manager.Queue(maxsize=threads * 3)
@@ -1411,11 +2620,17 @@ class ReadPairs(RegionPairsTable):
 
             monitor = Monitor(manager=queue_manager)
             monitor.set_generating_pairs(True)
+            # both files are sorted one after the other before the first chunk
+            # is queued, and sorting processes exit before pairing starts,
+            # so sorting can use all threads while the workers are waiting
             t_split = threading.Thread(target=_split_sam_worker, args=(sam_file1, sam_file2,
                                                                        input_file_queue,
                                                                        monitor, batch_size,
                                                                        split_tmpdir,
-                                                                       check_sorted))
+                                                                       check_sorted,
+                                                                       decompression_threads,
+                                                                       sort, threads,
+                                                                       completed_chunks))
             t_split.daemon = True
             logger.debug("Launching SAM splitting thread")
             t_split.start()
@@ -1423,8 +2638,9 @@ class ReadPairs(RegionPairsTable):
             logger.debug("Launching _load_paired_sam_worker workers")
             with mp.get_context("spawn").Pool(threads, _load_paired_sam_worker,
                                              (monitor, input_file_queue, output_file_queue,
-                                              fragment_infos, fragment_ends, self._partition_breaks,
-                                              read_filters, pairs_tmpdir)) as worker_pool:
+                                              fragment_infos,
+                                              read_filters, pairs_tmpdir,
+                                              pair_filters, drop_filtered)) as worker_pool:
                 logger.debug("Done launching _load_paired_sam_worker workers")
 
                 output_counter = 0
@@ -1437,17 +2653,26 @@ class ReadPairs(RegionPairsTable):
                         output_data = output_file_queue.get(block=True)
                         if isinstance(output_data, Exception):
                             raise output_data
-                        input_file, read_pairs_file, chunk_stats = output_data
+                        input_file, read_pairs_file, chunk_stats, pair_filter_stats, chunk_info = output_data
                         w = datetime.now() - s
                         logger.debug("Wait time: {}".format(w))
                         cumulative_wait_time += w.total_seconds()
 
                         s = datetime.now()
                         os.remove(input_file)
+                        pair_count_before = self._pair_count
                         self.load_read_pairs_fragment_info_file(read_pairs_file)
                         os.remove(read_pairs_file)
+
                         for key, value in chunk_stats.items():
                             all_stats[key] += value
+                        for key, value in pair_filter_stats.items():
+                            all_pair_filter_stats[key] += value
+                        if resume:
+                            chunk_id, chunk_offset, chunk_pairs = chunk_info
+                            self._save_sam_checkpoint_chunk(chunk_id, chunk_offset, chunk_pairs,
+                                                            self._pair_count - pair_count_before,
+                                                            chunk_stats, pair_filter_stats)
                         output_counter += 1
                         l = datetime.now() - s
                         logger.debug("Load time: {}".format(l))
@@ -1471,9 +2696,16 @@ class ReadPairs(RegionPairsTable):
         else:
             self.meta.read_filter_stats = add_dict(self.meta.read_filter_stats, all_stats)
 
+        if drop_filtered and len(pair_filters) > 0:
+            self._add_pair_filter_stats(all_pair_filter_stats)
+
+        if resume:
+            self._complete_sam_checkpoint()
+
         self.flush()
 
-    def add_read_pairs(self, read_pairs, batch_size=1000000, threads=1):
+    def add_read_pairs(self, read_pairs, batch_size=1000000, threads=1,
+                       pair_filters=None, drop_filtered=False):
         """
         Add read pairs to this object.
 
@@ -1500,38 +2732,30 @@ class ReadPairs(RegionPairsTable):
                            instances of :class:`~ReadPairGenerator`
         :param batch_size: Batch size of read pairs sent to fragment info workers
         :param threads: Number of threads for simultaneous fragment info finding
+        :param pair_filters: List of :class:`~FragmentReadPairFilter` that are
+                             evaluated in the fragment info workers while pairs
+                             are added, see :func:`~ReadPairs.add_read_pairs_from_sam`
+        :param drop_filtered: If True, read pairs filtered by pair_filters are
+                              not stored, and only their counts are recorded
         """
+        pair_filters = self._import_filters(pair_filters)
+
         self._edges_dirty = True
         self._disable_edge_indexes()
 
-        if self._pair_count is None:
-            self._pair_count = sum(edge_table._original_len()
-                                   for _, edge_table in self._iter_edge_tables())
-
-        start_time = timer()
-        chunk_start_time = timer()
-        pairs_counter = 0
-        edge = {}
-        for fi1, fi2 in self._read_pairs_fragment_info(read_pairs, batch_size=batch_size, threads=threads):
-            source, sink = int(fi1[2]), int(fi2[2])
-            if source > sink:
-                source, sink = sink, source
-                fi1, fi2 = fi2, fi1
-
-            edge['ix'] = self._pair_count
-            edge['source'] = source
-            edge['sink'] = sink
-            edge['left_read_position'], edge['right_read_position'] = int(fi1[0]), int(fi2[0])
-            edge['left_read_strand'], edge['right_read_strand'] = fi1[1], fi2[1]
-            edge['left_fragment_start'], edge['right_fragment_start'] = int(fi1[4]), int(fi2[4])
-            edge['left_fragment_end'], edge['right_fragment_end'] = int(fi1[5]), int(fi2[5])
-            edge['left_fragment_chromosome'], edge['right_fragment_chromosome'] = int(fi1[3]), int(fi2[3])
-
-            self._edge_buffer.add_dict(edge)
-            self._pair_count += 1
+        all_pair_filter_stats = defaultdict(int)
+        for fragment_infos, masks, pair_filter_stats in self._read_pairs_fragment_info(
+                read_pairs, batch_size=batch_size, threads=threads,
+                pair_filters=pair_filters, drop_filtered=drop_filtered):
+            self._load_read_pairs_fragment_info_array(fragment_infos, masks=masks)
+            for key, value in pair_filter_stats.items():
+                all_pair_filter_stats[key] += value
 
         logger.info('Done saving read pairs.')
 
+        if drop_filtered and len(pair_filters) > 0:
+            self._add_pair_filter_stats(all_pair_filter_stats)
+
         if isinstance(read_pairs, ReadPairGenerator):
             stats = read_pairs.stats()
             if 'read_filter_stats' not in self.meta:
@@ -1556,14 +2780,8 @@ class ReadPairs(RegionPairsTable):
             lazy_pair.ix = row['ix']
             return lazy_pair
         else:
-            fragment1 = GenomicRegion(start=row['left_fragment_start'],
-                                      end=row['left_fragment_end'],
-                                      chromosome=self._ix_to_chromosome[row['left_fragment_chromosome']],
-                                      ix=row['source'])
-            fragment2 = GenomicRegion(start=row['right_fragment_start'],
-                                      end=row['right_fragment_end'],
-                                      chromosome=self._ix_to_chromosome[row['right_fragment_chromosome']],
-                                      ix=row['sink'])
+            fragment1 = self._row_fragment(row, side='left')
+            fragment2 = self._row_fragment(row, side='right')
 
             left_read = FragmentRead(fragment1, position=row['left_read_position'],
                                      strand=row['left_read_strand'])
@@ -1572,8 +2790,24 @@ class ReadPairs(RegionPairsTable):
 
             return FragmentReadPair(left_read=left_read, right_read=right_read, ix=row['ix'])
 
+    def _row_fragment(self, row, side='left'):
+        """
+        Get the fragment of one read in a read pair row.
+
+        :param row: PyTables row, or other object with item access to columns
+        :param side: 'left' or 'right'
+        :return: :class:`~fanc.GenomicRegion`
+        """
+        ix = row['source'] if side == 'left' else row['sink']
+        if self._compact:
+            chromosome_ix, start, end = (int(v) for v in self._fragment_coordinates()[:, ix])
+        else:
+            chromosome_ix = row[side + '_fragment_chromosome']
+            start, end = row[side + '_fragment_start'], row[side + '_fragment_end']
+        return GenomicRegion(start=start, end=end, chromosome=self._ix_to_chromosome[chromosome_ix], ix=ix)
+
     def get_ligation_structure_biases(self, sampling=None, skip_self_ligations=True,
-                                      **kwargs):
+                                      sample=None, random_seed=0, **kwargs):
 
         """
         Compute the ligation biases (inward and outward to same-strand) of this data set.
@@ -1584,103 +2818,67 @@ class ReadPairs(RegionPairsTable):
         :param skip_self_ligations: If True (default), will not consider
                                     self-ligated fragments for assessing
                                     the error rates.
-        :param unfiltered: If True, uses all read pairs, even those that do not
-                           pass filters, for the ligation error calculation
+        :param sample: If an integer, only use a random sample of this many
+                       read pairs to compute the biases
+        :param random_seed: Seed for drawing a reproducible sample
+        :param excluded_filters: Masks of filters to ignore. By default, all
+                                 read pairs are used, even those that do not
+                                 pass filters
         :return: tuple with (list of gap sizes between reads, list of matching le type ratios)
         """
-        n_pairs = len(self)
         type_same = 0
         type_inward = 1
         type_outward = 2
 
-        def _init_gaps_and_types():
-            same_count = 0
-            inward_count = 0
-            outward_count = 0
-            same_fragment_count = 0
-            inter_chrm_count = 0
-            gaps = []
-            types = []
-
-            max_value = sum(et._original_len() for _, et in self._iter_edge_tables())
-
-            with RareUpdateProgressBar(max_value=max_value, silent=config.hide_progressbars,
-                                       prefix="Ligation error") as pb:
-                for i, pair in enumerate(self.pairs(lazy=True, excluded_filters='all',
-                                                    **kwargs)):
-                    if pair.is_same_fragment():
-                        same_fragment_count += 1
-                        if skip_self_ligations:
-                            continue
-                    if pair.is_same_chromosome():
-                        gap_size = pair.get_gap_size()
-                        if gap_size > 0:
-                            gaps.append(gap_size)
-                            if pair.is_outward_pair():
-                                types.append(type_outward)
-                                outward_count += 1
-                            elif pair.is_inward_pair():
-                                types.append(type_inward)
-                                inward_count += 1
-                            else:
-                                types.append(type_same)
-                                same_count += 1
-                    else:
-                        inter_chrm_count += 1
-                    pb.update(i)
+        infos = self._pairs_fragment_infos(excluded_filters=kwargs.get('excluded_filters', 'all'),
+                                           sample=sample, random_seed=random_seed)
+        n_pairs = len(self) if sample is None else infos.shape[0]
+
+        same_chromosome = infos[:, 3] == infos[:, 9]
+        same_fragment = np.logical_and(same_chromosome, infos[:, 4] == infos[:, 10])
+        gaps = infos[:, 10] - infos[:, 5]
+        gaps[np.logical_or(same_fragment, gaps == 1)] = 0  # self-ligated or neighboring fragments
+        valid = np.logical_and(same_chromosome, gaps > 0)
+        if skip_self_ligations:
+            valid = np.logical_and(valid, ~same_fragment)
+
+        inward = np.logical_and(infos[:, 1] == 1, infos[:, 7] == -1)
+        outward = np.logical_and(infos[:, 1] == -1, infos[:, 7] == 1)
+        types = np.full(infos.shape[0], type_same, dtype=np.int64)
+        types[inward] = type_inward
+        types[outward] = type_outward
+        gaps, types = gaps[valid], types[valid]
+
+        logger.info("Pairs: %d" % n_pairs)
+        logger.info("Inter-chromosomal: {}".format(int(np.sum(~same_chromosome))))
+        logger.info("Same fragment: {}".format(int(np.sum(same_fragment))))
+        logger.info("Same: {}".format(int(np.sum(types == type_same))))
+        logger.info("Inward: {}".format(int(np.sum(types == type_inward))))
+        logger.info("Outward: {}".format(int(np.sum(types == type_outward))))
 
-            logger.info("Pairs: %d" % n_pairs)
-            logger.info("Inter-chromosomal: {}".format(inter_chrm_count))
-            logger.info("Same fragment: {}".format(same_fragment_count))
-            logger.info("Same: {}".format(same_count))
-            logger.info("Inward: {}".format(inward_count))
-            logger.info("Outward: {}".format(outward_count))
-            return gaps, types
-
-        def _sort_data(gaps, types):
-            points = zip(gaps, types)
-            sorted_points = sorted(points)
-            return zip(*sorted_points)
-
-        def _calculate_ratios(gaps, types, sampling):
-            x = []
-            inward_ratios = []
-            outward_ratios = []
-            bin_sizes = []
-            counter = 0
-            same_counter = 0
-            mids = 0
-            outwards = 0
-            inwards = 0
-            for typ, gap in zip(types, gaps):
-                mids += gap
-                if typ == type_same:
-                    same_counter += 1
-                elif typ == type_inward:
-                    inwards += 1
-                else:
-                    outwards += 1
-                counter += 1
-                if same_counter > sampling:
-                    x.append(int(mids / counter))
-                    inward_ratios.append(inwards / same_counter)
-                    outward_ratios.append(outwards / same_counter)
-                    bin_sizes.append(counter)
-                    same_counter = 0
-                    counter = 0
-                    mids = 0
-                    outwards = 0
-                    inwards = 0
-            return list(map(np.array, [x, inward_ratios, outward_ratios, bin_sizes]))
-
-        gaps, types = _init_gaps_and_types()
         # sort data
-        gaps, types = _sort_data(gaps, types)
+        order = np.lexsort((types, gaps))
+        gaps, types = gaps[order], types[order]
         # best guess for number of data points
         sampling = max(100, int(n_pairs * 0.0025)) if sampling is None else sampling
         logger.debug("Number of data points averaged per point in plot: {}".format(sampling))
-        # calculate ratios
-        return _calculate_ratios(gaps, types, sampling)
+
+        # calculate ratios: a point is complete once it
+        # contains sampling + 1 same-strand pairs
+        same_ixs = np.nonzero(types == type_same)[0]
+        ends = same_ixs[sampling::sampling + 1] + 1
+        if ends.shape[0] == 0:
+            return [np.array([]) for _ in range(4)]
+        starts = np.concatenate([[0], ends[:-1]])
+        bin_sizes = ends - starts
+        gap_sums = np.add.reduceat(gaps[:ends[-1]], starts)
+        inwards = np.add.reduceat((types == type_inward)[:ends[-1]].astype(np.int64), starts)
+        outwards = np.add.reduceat((types == type_outward)[:ends[-1]].astype(np.int64), starts)
+
+        x = (gap_sums / bin_sizes).astype(int)
+        inward_ratios = inwards / (sampling + 1)
+        outward_ratios = outwards / (sampling + 1)
+        return [x, inward_ratios, outward_ratios, bin_sizes]
 
     @staticmethod
     def _auto_dist(dists, ratios, sample_sizes, p=0.05, expected_ratio=0.5):
@@ -1695,14 +2893,13 @@ class ReadPairs(RegionPairsTable):
         :param ratios: List of ratios
         """
 
-        def x_prop(p_obs, p_exp, n):
-            obs = p_obs * n
-            exp = p_exp * n
-            p = (obs + exp) / (n * 2)
-            return abs((p_exp - p_obs) / np.sqrt(p * (1 - p) * (2 / n)))
-
         ratios = np.clip(ratios, 0.0, 1.0)
-        z_scores = np.array([x_prop(r, expected_ratio, b) for r, b in zip(ratios, sample_sizes)])
+        sample_sizes = np.asarray(sample_sizes, dtype=np.float64)
+        obs = ratios * sample_sizes
+        exp = expected_ratio * sample_sizes
+        p_pooled = (obs + exp) / (sample_sizes * 2)
+        z_scores = np.abs((expected_ratio - ratios) /
+                          np.sqrt(p_pooled * (1 - p_pooled) * (2 / sample_sizes)))
         which_valid = z_scores < 1.96
         which_valid_indices = np.argwhere(which_valid).flatten()
         if len(which_valid_indices) > 0:
@@ -1851,6 +3048,14 @@ class ReadPairs(RegionPairsTable):
         :param kwargs: Additional arguments to pass
                        to :func:`~ReadPairs.get_ligation_structure_biases`
         """
+        if inward_threshold is None or outward_threshold is None:
+            # only compute ligation biases once for both thresholds
+            dists, inward_ratios, outward_ratios, bins_sizes = self.get_ligation_structure_biases(**kwargs)
+            if inward_threshold is None:
+                inward_threshold = self._auto_dist(dists, inward_ratios, bins_sizes)
+            if outward_threshold is None:
+                outward_threshold = self._auto_dist(dists, outward_ratios, bins_sizes)
+
         self.filter_inward(inward_threshold, queue=queue, **kwargs)
         self.filter_outward(outward_threshold, queue=queue, **kwargs)
 
@@ -1936,22 +3141,7 @@ class ReadPairs(RegionPairsTable):
 
     def __getitem__(self, item):
         if isinstance(item, int):
-            edge = self.get_edge(item)
-            fragment1 = GenomicRegion(start=edge.left_fragment_start,
-                                      end=edge.left_fragment_end,
-                                      chromosome=self._ix_to_chromosome[edge.left_fragment_chromosome],
-                                      ix=edge.source)
-            fragment2 = GenomicRegion(start=edge.right_fragment_start,
-                                      end=edge.right_fragment_end,
-                                      chromosome=self._ix_to_chromosome[edge.right_fragment_chromosome],
-                                      ix=edge.sink)
-
-            left_read = FragmentRead(fragment1, position=edge.left_read_position,
-                                     strand=edge.left_read_strand)
-            right_read = FragmentRead(fragment2, position=edge.right_read_position,
-                                      strand=edge.right_read_strand)
-
-            return FragmentReadPair(left_read=left_read, right_read=right_read, ix=edge.ix)
+            return self._pair_from_row(self.get_edge(item))
         else:
             pairs = []
             for row in self.edges.get_row_range(item):
@@ -1975,39 +3165,65 @@ class ReadPairs(RegionPairsTable):
         hic = _hic_class(file_name=file_name, mode='w', tmpdir=tmpdir)
         hic.add_regions(self.regions(), preserve_attributes=False)
 
-        hic._disable_edge_indexes()
-
-        n_pairs = len(self)
-        pairs_counter = 0
-        with RareUpdateProgressBar(max_value=n_pairs, silent=config.hide_progressbars,
+        n_regions = len(self.regions)
+        edge_tables = [edge_table for _, edge_table in self._iter_edge_tables()]
+        with RareUpdateProgressBar(max_value=len(edge_tables), silent=config.hide_progressbars,
                                    prefix="Hi-C convert") as pb:
-            for _, pairs_edge_table in self._iter_edge_tables():
-
-                partition_edge_buffer = defaultdict(lambda: defaultdict(int))
-                for row in pairs_edge_table:
-                    key = (row['source'], row['sink'])
-                    source_partition = self._get_partition_ix(key[0])
-                    sink_partition = self._get_partition_ix(key[1])
-                    partition_edge_buffer[(source_partition, sink_partition)][key] += 1
-                    pb.update(pairs_counter)
-                    pairs_counter += 1
-
-                for hic_partition_key, edge_buffer in viewitems(partition_edge_buffer):
-                    hic_edge_table = hic._edge_table(hic_partition_key[0], hic_partition_key[1])
-                    row = hic_edge_table.row
-
-                    for (source, sink), weight in viewitems(edge_buffer):
-                        row['source'] = source
-                        row['sink'] = sink
-                        row[hic._default_score_field] = float(weight)
-                        row.append()
-                    hic_edge_table.flush(update_index=False)
+            for i, pairs_edge_table in enumerate(edge_tables):
+                visible = pairs_edge_table.read(field=pairs_edge_table._mask_field) == 0
+                sources = pairs_edge_table.read(field='source')[visible].astype(np.int64)
+                sinks = pairs_edge_table.read(field='sink')[visible]
+                keys, weights = np.unique(sources * n_regions + sinks, return_counts=True)
+                del visible, sources, sinks
+
+                hic._add_edge_arrays({'source': keys // n_regions, 'sink': keys % n_regions,
+                                      hic._default_score_field: weights.astype(np.float64)})
+                pb.update(i + 1)
         hic.flush()
 
-        hic._enable_edge_indexes()
-
         return hic
 
+    def to_compact(self, file_name=None, tmpdir=None, chunk_size=1000000):
+        """
+        Copy this object to a :class:`~ReadPairs` object with compact schema.
+
+        Read pairs, including filtered pairs and their masks, as well as
+        filter statistics are retained. See :class:`~ReadPairs` (compact
+        parameter) for details.
+
+        :param file_name: Path to the output file
+        :param tmpdir: If True (or path to temporary directory) will
+                       work in temporary directory until closed
+        :param chunk_size: Number of rows copied at once from each table
+        :return: :class:`~ReadPairs`
+        """
+        pairs = ReadPairs(file_name=file_name, mode='w', tmpdir=tmpdir, compact=True)
+        pairs.add_regions(self.regions(), preserve_attributes=False)
+
+        for mask in self.masks():
+            if mask.ix > 0:
+                pairs.add_mask_description(mask.name, mask.description)
+
+        for key in ('read_filter_stats', 'pair_filter_stats'):
+            if key in self.meta:
+                pairs.meta[key] = self.meta[key]
+
+        edge_tables = [edge_table for _, edge_table in self._iter_edge_tables()]
+        total = sum(edge_table._original_len() for edge_table in edge_tables)
+        with RareUpdateProgressBar(max_value=total, silent=config.hide_progressbars,
+                                   prefix="Compact") as pb:
+            copied = 0
+            for edge_table in edge_tables:
+                for start in range(0, edge_table._original_len(), chunk_size):
+                    rows = edge_table.read(start, start + chunk_size)
+                    pairs._add_edge_arrays({name: rows[name] for name in rows.dtype.names})
+                    copied += rows.shape[0]
+                    pb.update(copied)
+        pairs._pair_count = None
+        pairs.flush()
+
+        return pairs
+
     def pairs_by_chromosomes(self, chromosome1, chromosome2, **kwargs):
         """
         Only iterate over read pairs in this combination of chromosomes.
@@ -2028,12 +3244,23 @@ class ReadPairs(RegionPairsTable):
         except AttributeError:
             read_stats = dict()
 
+        try:
+            dropped_stats = self.meta.pair_filter_stats
+        except AttributeError:
+            dropped_stats = dict()
+
         pair_stats = self.mask_statistics(self._pairs)
         if 'valid' in pair_stats:
             read_stats['valid'] = pair_stats['valid']
         pair_stats.update(read_stats)
 
-        pair_stats['total'] = sum(t._original_len() for t in self._pairs)
+        # pairs removed by filters during import are only counted
+        for name, count in dropped_stats.items():
+            if name != 'total':
+                pair_stats[name] = pair_stats.get(name, 0) + count
+
+        pair_stats['total'] = sum(t._original_len() for t in self._pairs) + \
+            dropped_stats.get('total', 0)
         return pair_stats
 
 
@@ -2426,6 +3653,33 @@ class FragmentReadPairFilter(with_metaclass(ABCMeta, MaskFilter)):
     def valid_pair(self, fr_pair):
         pass
 
+    def valid_fragment_infos(self, fragment_infos):
+        """
+        Map validity check to an array of read pair fragment infos.
+
+        Override this method to check many read pairs at once.
+
+        :param fragment_infos: (n, 12) array of read position, read strand,
+                               fragment index, fragment chromosome index,
+                               fragment start, and fragment end for the left
+                               and then the right read, where the left read
+                               maps to the lower fragment index
+        :return: boolean array with False for filtered pairs, or None if
+                 the filter does not support array checks
+        """
+        return None
+
+    def valid_rows(self, rows):
+        """
+        Map validity check of table rows to fragment infos.
+
+        Uses :func:`~FragmentReadPairFilter.valid_fragment_infos`, if implemented.
+        """
+        if self.pairs is None or \
+                type(self).valid_fragment_infos is FragmentReadPairFilter.valid_fragment_infos:
+            return None
+        return self.valid_fragment_infos(self.pairs._rows_fragment_infos(rows))
+
     def valid(self, row):
         """
         Map validity check of rows to pairs.
@@ -2460,12 +3714,21 @@ class InwardPairsFilter(FragmentReadPairFilter):
             return False
         return True
 
+    def valid_fragment_infos(self, fragment_infos):
+        inward = np.logical_and.reduce([fragment_infos[:, 3] == fragment_infos[:, 9],
+                                        fragment_infos[:, 1] == 1, fragment_infos[:, 7] == -1])
+        return ~(inward & (_fragment_gap_sizes(fragment_infos) <= self.minimum_distance))
+
 
 class PCRDuplicateFilter(FragmentReadPairFilter):
     """
     Masks alignments that are suspected to be PCR duplicates.
     In order to be considered duplicates, two pairs need to have identical
     start positions of their respective left alignments AND of their right alignments.
+
+    Pairs are sorted by chromosomes and left read position, and a pair is
+    marked as duplicate if both its read positions are within the threshold
+    of the first pair of the current group of duplicates.
     """
 
     def __init__(self, pairs, threshold=2, mask=None):
@@ -2482,62 +3745,68 @@ class PCRDuplicateFilter(FragmentReadPairFilter):
         FragmentReadPairFilter.__init__(self, mask=mask)
         self.threshold = threshold
         self.pairs = pairs
-        self.duplicates_set = set()
         self.duplicate_stats = defaultdict(int)
         original_len = 0
+        duplicate_ixs = []
+        max_ix = -1
         for _, edge_table in self.pairs._iter_edge_tables():
             original_len += edge_table._original_len()
-            self._mark_duplicates(edge_table)
-
-        n_dups = len(self.duplicates_set)
-        percent_dups = 1. * n_dups / original_len
+            ixs, duplicates = self._mark_duplicates(edge_table)
+            duplicate_ixs.append(ixs[duplicates])
+            if len(ixs) > 0:
+                max_ix = max(max_ix, int(ixs.max()))
+
+        # boolean duplicate mask indexed by pair ix
+        self._duplicates = np.zeros(max_ix + 1, dtype=bool)
+        for ixs in duplicate_ixs:
+            self._duplicates[ixs] = True
+
+        n_dups = int(np.sum(self._duplicates))
+        percent_dups = 1. * n_dups / original_len if original_len > 0 else 0.
         logger.info("PCR duplicate stats: " +
                     "{} ({:.1%}) of pairs marked as duplicate. ".format(n_dups, percent_dups) +
                     " (multiplicity:occurances) " +
-                    " ".join("{}:{}".format(k, v) for k, v in self.duplicate_stats.items()))
-
-    def _mark_duplicates(self, edge_table):
-        pairs = [
-            (
-                row['ix'],
-                row['left_fragment_chromosome'], row['right_fragment_chromosome'],
-                row['left_read_position'], row['right_read_position']
-             ) for row in edge_table._iter_visible_and_masked()
-        ]
-        pairs = sorted(pairs, key=lambda p: p[3])
-
-        current_positions = {}
-        current_duplicates = {}
-        for ix, left_chromosome, right_chromosome, left_position, right_position in pairs:
-            chromosomes = (left_chromosome, right_chromosome)
+                    " ".join("{}:{}".format(k, v) for k, v in sorted(self.duplicate_stats.items())))
 
-            # case 1: no current duplicates
-            if current_positions.get(chromosomes) is None:
-                current_positions[chromosomes] = (left_position, right_position)
-                current_duplicates[chromosomes] = 1
-                continue
-
-            # case 2: found duplicate
-            if (abs(left_position - current_positions[chromosomes][0]) <= self.threshold and
-                    abs(right_position - current_positions[chromosomes][1]) <= self.threshold):
-                self.duplicates_set.add(ix)
-                current_duplicates[chromosomes] += 1
-                continue
+    def _mark_duplicates(self, edge_table, chunk_size=1000000):
+        if self.pairs._compact:
+            fragment_chromosomes = self.pairs._fragment_coordinates()[0]
+            fields = ['ix', 'source', 'sink', 'left_read_position', 'right_read_position']
+        else:
+            fields = ['ix', 'left_fragment_chromosome', 'right_fragment_chromosome',
+                      'left_read_position', 'right_read_position']
+
+        columns = [[] for _ in fields]
+        for start in range(0, edge_table._original_len(), chunk_size):
+            for column, field in zip(columns, fields):
+                values = edge_table.read(start, start + chunk_size, field=field)
+                if self.pairs._compact and field in ('source', 'sink'):
+                    values = fragment_chromosomes[values]
+                column.append(values)
+        ixs, chromosomes1, chromosomes2, positions1, positions2 = [
+            np.concatenate(column) if len(column) > 0 else np.zeros(0, dtype=np.int64)
+            for column in columns
+        ]
 
-            # update statistics
-            if current_duplicates[chromosomes] > 1:
-                self.duplicate_stats[current_duplicates[chromosomes]] += 1
+        duplicates, multiplicities = _pcr_duplicates(chromosomes1, chromosomes2,
+                                                     positions1, positions2,
+                                                     threshold=self.threshold)
+        for multiplicity, count in zip(*np.unique(multiplicities, return_counts=True)):
+            self.duplicate_stats[int(multiplicity)] += int(count)
+        return ixs, duplicates
 
-            current_positions[chromosomes] = (left_position, right_position)
-            current_duplicates[chromosomes] = 1
+    @property
+    def duplicates_set(self):
+        return set(np.flatnonzero(self._duplicates).tolist())
 
     def valid_pair(self, pair):
         """
         Check if a pair is duplicated.
         """
-        if pair.ix in self.duplicates_set:
-            return False
-        return True
+        return not self._duplicates[pair.ix]
+
+    def valid_rows(self, rows):
+        return ~self._duplicates[rows['ix']]
 
 
 class OutwardPairsFilter(FragmentReadPairFilter):
@@ -2566,6 +3835,11 @@ class OutwardPairsFilter(FragmentReadPairFilter):
             return True
         return False
 
+    def valid_fragment_infos(self, fragment_infos):
+        outward = np.logical_and.reduce([fragment_infos[:, 3] == fragment_infos[:, 9],
+                                         fragment_infos[:, 1] == -1, fragment_infos[:, 7] == 1])
+        return ~outward | (_fragment_gap_sizes(fragment_infos) > self.minimum_distance)
+
 
 class ReDistanceFilter(FragmentReadPairFilter):
     """
@@ -2591,6 +3865,13 @@ class ReDistanceFilter(FragmentReadPairFilter):
 
         return True
 
+    def valid_fragment_infos(self, fragment_infos):
+        d1 = np.minimum(np.abs(fragment_infos[:, 0] - fragment_infos[:, 4]),
+                        np.abs(fragment_infos[:, 0] - fragment_infos[:, 5]))
+        d2 = np.minimum(np.abs(fragment_infos[:, 6] - fragment_infos[:, 10]),
+                        np.abs(fragment_infos[:, 6] - fragment_infos[:, 11]))
+        return d1 + d2 <= self.maximum_distance
+
 
 class SelfLigationFilter(FragmentReadPairFilter):
     """
@@ -2608,3 +3889,7 @@ class SelfLigationFilter(FragmentReadPairFilter):
         if pair.is_same_fragment():
             return False
         return True
+
+    def valid_fragment_infos(self, fragment_infos):
+        return ~((fragment_infos[:, 3] == fragment_infos[:, 9]) &
+                 (fragment_infos[:, 4] == fragment_infos[:, 10]))
@@ -4,13 +4,16 @@ from .config import config
 from abc import abstractmethod, ABCMeta
 import numpy as np
 from scipy.stats import poisson
-from collections import defaultdict, OrderedDict
+from scipy.spatial import cKDTree
+from collections import defaultdict, OrderedDict, deque
 import tables as t
 from .matrix import RegionMatrixTable, Edge, LazyEdge
 from .general import MaskFilter
 import msgpack
 import msgpack_numpy
 import math
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import pandas as pd
 from .tools.general import RareUpdateProgressBar, pairwise
 import warnings
@@ -164,37 +167,92 @@ class PeakInfo(RegionMatrixTable):
         self.filter(rao_filter, queue)
 
     def to_bedpe(self, file_name, anchor_radius=True, score_field='q_value_sum', name_field=None):
-        regions = list(self.regions)
-        with open(file_name, 'w') as f:
-            for peak in self.peaks(lazy=True, distances_in_bp=True):
-                r1 = regions[peak.source]
-                r2 = regions[peak.sink]
-                if score_field is not None:
-                    score = getattr(peak, score_field)
-                else:
-                    score = '.'
-                if name_field is not None:
-                    name = getattr(peak, name_field)
-                else:
-                    name = '.'
-
-                if anchor_radius:
-                    r = peak.radius
-                    start1 = r1.start - r
-                    end1 = r1.end + r
-                    start2 = r2.start - r
-                    end2 = r2.end + r
-                else:
-                    start1 = r1.start
-                    end1 = r1.end
-                    start2 = r2.start
-                    end2 = r2.end
-
-                f.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                    r1.chromosome, int(start1), int(end1),
-                    r2.chromosome, int(start2), int(end2),
-                    name, score
-                ))
+        """
+        Write unmasked peaks to a BEDPE file.
+
+        :param file_name: Path to output file
+        :param anchor_radius: If True, extend both anchors by the peak radius
+        :param score_field: Name of the field used as score, '.' if None
+        :param name_field: Name of the field used as name, '.' if None
+        """
+        _write_peaks_bedpe(self, file_name, anchor_radius=anchor_radius,
+                           score_field=score_field, name_field=name_field)
+
+
+def _write_peaks_bedpe(peaks, file_name, anchor_radius=True, score_field=None, name_field=None,
+                       chunk_size=100000):
+    """
+    Write unmasked peaks to a BEDPE file, reading peak table columns in chunks.
+
+    Output is identical to formatting each :class:`~Peak` from
+    :func:`~PeakInfo.peaks` individually: peaks are written in the same
+    order, peaks involving invalid regions are skipped, x, y, and radius
+    are converted to base pairs and float values are formatted as
+    double precision numbers.
+
+    :param peaks: :class:`~PeakInfo` or :class:`~RaoPeakInfo`
+    :param file_name: Path to output file
+    :param anchor_radius: If True, extend both anchors by the peak radius
+    :param score_field: Name of the field used as score, '.' if None
+    :param name_field: Name of the field used as name, '.' if None
+    :param chunk_size: Number of peaks read and written at once
+    """
+    chromosome_names, chromosome_ixs = np.unique(peaks._regions.col('chromosome'), return_inverse=True)
+    chromosome_names = np.array([c.decode() if isinstance(c, bytes) else str(c) for c in chromosome_names])
+    chromosomes = chromosome_names[chromosome_ixs]
+    starts = peaks._regions.col('start').astype(np.int64)
+    ends = peaks._regions.col('end').astype(np.int64)
+    if 'valid' in peaks._regions.colnames:
+        valid = peaks._regions.col('valid').astype(bool)
+    else:
+        valid = np.ones(len(starts), dtype=bool)
+    bin_size = peaks.bin_size if anchor_radius or {score_field, name_field} & {'x', 'y', 'radius'} else 1
+
+    # region index range of each chromosome, in region order
+    chromosome_ranges = OrderedDict()
+    for ix, chromosome in enumerate(chromosomes.tolist()):
+        chromosome_ranges.setdefault(chromosome, [ix, ix])[1] = ix
+
+    def _field_strings(rows, field):
+        if field is None:
+            return ['.'] * len(rows)
+        values = rows[field]
+        if field in ('x', 'y', 'radius'):
+            values = values.astype(np.float64) * bin_size
+        elif values.dtype.kind == 'S':
+            values = np.char.decode(values)
+        elif values.dtype.kind == 'f':
+            values = values.astype(np.float64)
+        return values.astype(str).tolist()
+
+    # same chromosome pair and row order as PeakInfo.peaks
+    chromosome_pairs = set()
+    with open(file_name, 'w') as f:
+        for row_chromosome, row_range in chromosome_ranges.items():
+            for col_chromosome, col_range in chromosome_ranges.items():
+                if (col_chromosome, row_chromosome) in chromosome_pairs:
+                    continue
+                chromosome_pairs.add((row_chromosome, col_chromosome))
+
+                for rows in peaks._edge_subset_row_chunks(row_range, col_range, chunk_size=chunk_size):
+                    source = rows['source'].astype(np.int64)
+                    sink = rows['sink'].astype(np.int64)
+                    is_valid = valid[source] & valid[sink]
+                    rows, source, sink = rows[is_valid], source[is_valid], sink[is_valid]
+                    if len(rows) == 0:
+                        continue
+
+                    start1, end1, start2, end2 = starts[source], ends[source], starts[sink], ends[sink]
+                    if anchor_radius:
+                        r = rows['radius'].astype(np.float64) * bin_size
+                        start1, end1, start2, end2 = [np.trunc(v).astype(np.int64) for v in
+                                                      (start1 - r, end1 + r, start2 - r, end2 + r)]
+
+                    columns = [chromosomes[source].tolist(), start1.astype(str).tolist(),
+                               end1.astype(str).tolist(), chromosomes[sink].tolist(),
+                               start2.astype(str).tolist(), end2.astype(str).tolist(),
+                               _field_strings(rows, name_field), _field_strings(rows, score_field)]
+                    f.write(''.join(['\t'.join(fields) + '\n' for fields in zip(*columns)]))
 
 
 class RaoPeakInfo(RegionMatrixTable):
@@ -283,6 +341,125 @@ class RaoPeakInfo(RegionMatrixTable):
     def __iter__(self):
         return self.peaks()
 
+    class CheckpointPairDescription(t.IsDescription):
+        """
+        Chromosome pairs completely processed by :class:`~RaoPeakCaller`.
+        """
+        chromosome1 = t.StringCol(255, pos=0)
+        chromosome2 = t.StringCol(255, pos=1)
+
+    class CheckpointDistributionDescription(t.IsDescription):
+        """
+        Observed values per neighborhood and lambda-chunk.
+        """
+        e_type = t.StringCol(2, pos=0)
+        chunk = t.Int64Col(pos=1)
+        observed = t.Int64Col(pos=2)
+        count = t.Int64Col(pos=3)
+
+    class CheckpointEdgeCountDescription(t.IsDescription):
+        """
+        Number of rows in each edge table.
+        """
+        name = t.StringCol(255, pos=0)
+        nrows = t.Int64Col(pos=1)
+
+    _checkpoint_group_name = 'peak_calling_checkpoint'
+
+    def _has_peak_calling_checkpoint(self):
+        return '/' + self._checkpoint_group_name in self.file
+
+    def _init_peak_calling_checkpoint(self, parameters):
+        """
+        Create a new, empty peak calling checkpoint in this object.
+
+        :param parameters: list of peak calling parameters, which
+                           must be identical when resuming
+        """
+        if self._has_peak_calling_checkpoint():
+            self.file.remove_node('/', self._checkpoint_group_name, recursive=True)
+
+        group = self.file.create_group('/', self._checkpoint_group_name)
+        self.file.create_table(group, 'pairs', RaoPeakInfo.CheckpointPairDescription)
+        self.file.create_table(group, 'observed_chunk_distribution',
+                               RaoPeakInfo.CheckpointDistributionDescription)
+        self.file.create_table(group, 'edge_counts', RaoPeakInfo.CheckpointEdgeCountDescription)
+        group._v_attrs.parameters = parameters
+        group._v_attrs.inter_possible = 0
+        self._save_peak_calling_checkpoint(None, dict(), 0)
+
+    def _peak_calling_checkpoint(self, parameters):
+        """
+        Load the peak calling checkpoint of this object.
+
+        Peaks added after the last completed chromosome
+        pair are removed.
+
+        :param parameters: list of peak calling parameters, which
+                           must be identical to those of the checkpoint
+        :return: tuple (list of completed chromosome pairs,
+                 dict <neighborhood>: {<chunk>: {<observed>: <count>}},
+                 number of possible inter-chromosomal peaks)
+        """
+        group = self.file.get_node('/', self._checkpoint_group_name)
+        if group._v_attrs.parameters != parameters:
+            raise ValueError("Peak calling checkpoint was created with different "
+                             "parameters ({}), cannot resume!".format(group._v_attrs.parameters))
+
+        self._remove_peaks_from({name.decode(): nrows for name, nrows in group.edge_counts.read().tolist()})
+
+        pairs = [(chromosome1.decode(), chromosome2.decode())
+                 for chromosome1, chromosome2 in group.pairs.read().tolist()]
+        observed_chunk_distribution = defaultdict(lambda: defaultdict(dict))
+        for e_type, chunk, observed, count in group.observed_chunk_distribution.read().tolist():
+            observed_chunk_distribution[e_type.decode()][chunk][observed] = count
+        return pairs, observed_chunk_distribution, int(group._v_attrs.inter_possible)
+
+    def _save_peak_calling_checkpoint(self, pair, observed_chunk_distribution, inter_possible):
+        """
+        Record a completed chromosome pair in the peak calling checkpoint.
+
+        :param pair: tuple of chromosome names or None
+        :param observed_chunk_distribution: dict <neighborhood>: {<chunk>: {<observed>: <count>}}
+                                            of all completed chromosome pairs
+        :param inter_possible: number of possible inter-chromosomal peaks
+                               of all completed chromosome pairs
+        """
+        group = self.file.get_node('/', self._checkpoint_group_name)
+
+        edge_counts = [(edge_table.name, edge_table.nrows) for _, edge_table in self._iter_edge_tables()]
+        group.edge_counts.truncate(0)
+        if len(edge_counts) > 0:
+            group.edge_counts.append(edge_counts)
+
+        distribution = [(e_type, chunk, observed, count)
+                        for e_type, chunk_distribution in observed_chunk_distribution.items()
+                        for chunk, observed_counts in chunk_distribution.items()
+                        for observed, count in observed_counts.items()]
+        group.observed_chunk_distribution.truncate(0)
+        if len(distribution) > 0:
+            group.observed_chunk_distribution.append(distribution)
+
+        if pair is not None:
+            group.pairs.append([pair])
+        group._v_attrs.inter_possible = inter_possible
+        self.file.flush()
+
+    def _remove_peaks_from(self, edge_counts):
+        """
+        Remove all peaks appended to the edge tables after they
+        contained the given number of rows.
+
+        :param edge_counts: dict of edge table name: number of rows
+        """
+        for _, edge_table in self._iter_edge_tables():
+            n_rows = edge_table.nrows
+            first = edge_counts.get(edge_table.name, 0)
+            if first < n_rows:
+                logger.info("Removing {} peaks from incomplete chromosome pairs".format(n_rows - first))
+                edge_table.remove_rows(first, n_rows)
+                edge_table.flush()
+
     def filter_fdr(self, fdr_cutoff, queue=False):
         """
         Convenience function that applies a :class:`~FdrPeakFilter`.
@@ -361,34 +538,69 @@ class RaoPeakInfo(RegionMatrixTable):
         rao_filter = RaoPeakFilter(mask=mask)
         self.filter(rao_filter, queue)
 
-    @staticmethod
-    def _euclidian_distance(x1, y1, x2, y2):
-        """
-        Determine the 2D euclidian distance between two points.
+    def to_bedpe(self, file_name, score_field='weight', name_field=None):
         """
-        return math.sqrt((x1-x2)**2+(y1-y2)**2)
+        Write unmasked peak candidate pixels to a BEDPE file.
 
-    @staticmethod
-    def _centroid_and_radius(peak_list):
-        """
-        Determine the centroid coordinates and radius of list of peaks.
+        :param file_name: Path to output file
+        :param score_field: Name of the field used as score, '.' if None
+        :param name_field: Name of the field used as name, '.' if None
         """
-        x = 0
-        y = 0
-        for peak in peak_list:
-            x += peak.source
-            y += peak.sink
+        _write_peaks_bedpe(self, file_name, anchor_radius=False,
+                           score_field=score_field, name_field=name_field)
 
-        if len(peak_list) > 0:
-            x /= len(peak_list)
-            y /= len(peak_list)
-
-        radius = 0
-        for peak in peak_list:
-            distance = RaoPeakInfo._euclidian_distance(x, y, peak.source, peak.sink)
-            if distance > radius:
-                radius = distance
-        return x, y, radius
+    @staticmethod
+    def _peak_clusters(source, sink, weight, euclidian_distance, bin_size):
+        """
+        Cluster spatially proximal peaks.
+
+        Starting from the highest remaining peak, the closest remaining
+        peak is added to a cluster as long as its distance to the cluster
+        centroid does not exceed euclidian_distance plus the cluster radius.
+        Candidates are looked up in a KD-tree.
+
+        :param source: array of peak source bins
+        :param sink: array of peak sink bins
+        :param weight: array of peak weights
+        :param euclidian_distance: Maximal distance in base pairs
+        :param bin_size: Bin size in base pairs
+        :return: list of (peak indexes, x, y, radius) tuples, where
+                 the first index is the highest peak in the cluster
+        """
+        source = np.asarray(source, dtype=np.int64)
+        sink = np.asarray(sink, dtype=np.int64)
+        tree = cKDTree(np.column_stack([source, sink]).astype(np.float64))
+        remaining = np.ones(source.shape[0], dtype=bool)
+
+        clusters = []
+        for seed in np.argsort(-np.asarray(weight), kind='stable'):
+            if not remaining[seed]:
+                continue
+            remaining[seed] = False
+            cluster = [seed]
+            source_sum, sink_sum = int(source[seed]), int(sink[seed])
+            x, y, radius = float(source_sum), float(sink_sum), 0
+
+            while True:
+                query_radius = euclidian_distance / bin_size + radius
+                candidates = np.array(tree.query_ball_point((x, y), query_radius * (1 + 1e-9) + 1e-9),
+                                      dtype=np.int64)
+                candidates = candidates[remaining[candidates]]
+                distances = np.sqrt((x - source[candidates]) ** 2 + (y - sink[candidates]) ** 2)
+                close = distances * bin_size <= euclidian_distance + (radius * bin_size)
+                if not np.any(close):
+                    break
+
+                closest = candidates[close][np.argmin(distances[close])]
+                remaining[closest] = False
+                cluster.append(closest)
+
+                source_sum += int(source[closest])
+                sink_sum += int(sink[closest])
+                x, y = source_sum / len(cluster), sink_sum / len(cluster)
+                radius = np.sqrt((x - source[cluster]) ** 2 + (y - sink[cluster]) ** 2).max()
+            clusters.append((np.array(cluster), x, y, float(radius)))
+        return clusters
 
     def merged_peaks(self, file_name=None, euclidian_distance=20000):
         """
@@ -403,79 +615,44 @@ class RaoPeakInfo(RegionMatrixTable):
         merged_peaks.add_regions(self.regions(lazy=True), preserve_attributes=False)
 
         bin_size = self.bin_size
-
-        def _append_merged_peak(peak_list):
-            # add merged peak
-            hp = peak_list[0]
-            q_value_sum = hp.fdr_ll + hp.fdr_d + hp.fdr_h + hp.fdr_v
-            oe = 1 if hp.e_d == 0 else hp.weight/hp.e_d
-            merged_peak = Peak(source=hp.source, sink=hp.sink, weight=hp.weight,
-                               uncorrected=hp.uncorrected, expected_local=hp.e_d,
-                               p_value=hp.fdr_d, q_value_sum=q_value_sum, x=x, y=y,
-                               radius=radius, oe=oe)
-            merged_peaks.add_edge(merged_peak)
+        fields = ['source', 'sink', 'weight', 'uncorrected', 'e_d', 'fdr_ll', 'fdr_h', 'fdr_v', 'fdr_d']
 
         merged_peak_counter = 0
+        chromosome_bins = self.chromosome_bins
         chromosome_names = self.chromosomes()
         for i, chromosome_name1 in enumerate(chromosome_names):
             for j in range(i, len(chromosome_names)):
                 chromosome_name2 = chromosome_names[j]
 
-                remaining_peaks_set = set()
-                for peak in self.edge_subset((chromosome_name1, chromosome_name2), lazy=False):
-                    remaining_peaks_set.add(peak)
-
-                if len(remaining_peaks_set) == 0:
+                peaks = self._edge_subset_arrays(chromosome_bins[chromosome_name1],
+                                                 chromosome_bins[chromosome_name2], fields=fields)
+                if len(peaks['source']) == 0:
                     continue
 
                 logger.info("Merging peaks in %s/%s" % (chromosome_name1, chromosome_name2))
-
-                last_peak_number = 0
-                current_peaks = []
-                n_remaining = len(remaining_peaks_set)
-                with RareUpdateProgressBar(max_value=n_remaining, silent=config.hide_progressbars,
-                                           prefix="Peak merge") as pb:
-                    while len(remaining_peaks_set) > 0:
-                        x, y, radius = RaoPeakInfo._centroid_and_radius(current_peaks)
-
-                        if len(current_peaks) == last_peak_number:
-                            if len(current_peaks) > 0:
-                                _append_merged_peak(current_peaks)
-                                current_peaks = []
-                                last_peak_number = 0
-                                merged_peak_counter += 1
-
-                            # find highest peak
-                            highest_peak = None
-                            for peak in remaining_peaks_set:
-                                if highest_peak is None:
-                                    highest_peak = peak
-                                else:
-                                    if highest_peak.weight < peak.weight:
-                                        highest_peak = peak
-
-                            current_peaks.append(highest_peak)
-                            remaining_peaks_set.remove(highest_peak)
-                        else:
-                            last_peak_number = len(current_peaks)
-
-                            closest_peak = None
-                            closest_distance = None
-                            for peak in remaining_peaks_set:
-                                distance = RaoPeakInfo._euclidian_distance(x, y, peak.source, peak.sink)
-                                if closest_peak is None or distance < closest_distance:
-                                    closest_peak = peak
-                                    closest_distance = distance
-
-                            if closest_distance*bin_size <= euclidian_distance+(radius*bin_size):
-                                current_peaks.append(closest_peak)
-                                remaining_peaks_set.remove(closest_peak)
-
-                        pb.update(n_remaining-len(remaining_peaks_set))
-
-                if len(current_peaks) > 0:
-                    _append_merged_peak(current_peaks)
-                    merged_peak_counter += 1
+                clusters = RaoPeakInfo._peak_clusters(peaks['source'], peaks['sink'], peaks['weight'],
+                                                      euclidian_distance, bin_size)
+
+                # highest peak in each cluster
+                hp = np.array([cluster[0][0] for cluster in clusters])
+                hp_peaks = {field: peaks[field][hp].astype(np.float64) for field in fields[2:]}
+                weight, e_d = hp_peaks['weight'], hp_peaks['e_d']
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    oe = np.where(e_d == 0, 1, weight / e_d)
+                merged_peaks._add_edge_arrays({
+                    'source': peaks['source'][hp],
+                    'sink': peaks['sink'][hp],
+                    'weight': weight,
+                    'uncorrected': peaks['uncorrected'][hp],
+                    'expected_local': e_d,
+                    'p_value': hp_peaks['fdr_d'],
+                    'q_value_sum': hp_peaks['fdr_ll'] + hp_peaks['fdr_d'] + hp_peaks['fdr_h'] + hp_peaks['fdr_v'],
+                    'x': np.array([cluster[1] for cluster in clusters]),
+                    'y': np.array([cluster[2] for cluster in clusters]),
+                    'radius': np.array([cluster[3] for cluster in clusters]),
+                    'oe': oe,
+                })
+                merged_peak_counter += len(clusters)
 
         logger.info("Total merged peaks: {}".format(merged_peak_counter))
         merged_peaks.flush()
@@ -537,6 +714,9 @@ class PeakFilter(with_metaclass(ABCMeta, MaskFilter)):
     valid_peak should return False for a specific :class:`~Edge` object
     if the object is supposed to be filtered/masked and True
     otherwise. See :class:`~DiagonalFilter` for an example.
+    Filters that can be expressed on column arrays should also override
+    valid_rows(self, rows), which is evaluated on whole blocks of the
+    peak table instead of peak by peak.
 
     Pass a custom filter to the :func:`~RaoPeakInfo.filter` method in :class:`~Hic`
     to apply it.
@@ -606,6 +786,12 @@ class ObservedPeakFilter(PeakFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the observed cutoff.
+        """
+        return ~(rows['uncorrected'].astype(np.int64) < self.cutoff)
+
 
 class DistancePeakFilter(PeakFilter):
     """
@@ -631,6 +817,12 @@ class DistancePeakFilter(PeakFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the distance cutoff.
+        """
+        return ~(np.abs(rows['source'].astype(np.int64) - rows['sink']) < self.cutoff)
+
 
 class FdrPeakFilter(PeakFilter):
     """
@@ -680,6 +872,18 @@ class FdrPeakFilter(PeakFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the FDR cutoffs.
+        """
+        valid = np.ones(len(rows), dtype=bool)
+        for e_type in ('ll', 'h', 'v', 'd'):
+            cutoff = getattr(self, 'fdr_{}_cutoff'.format(e_type))
+            if cutoff is not None:
+                # compare in double precision like valid_peak
+                valid &= ~(rows['fdr_' + e_type].astype(np.float64) > cutoff)
+        return valid
+
 
 class MappabilityPeakFilter(PeakFilter):
     """
@@ -729,6 +933,17 @@ class MappabilityPeakFilter(PeakFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the mappability cutoffs.
+        """
+        valid = np.ones(len(rows), dtype=bool)
+        for e_type in ('ll', 'h', 'v', 'd'):
+            cutoff = getattr(self, 'mappability_{}_cutoff'.format(e_type))
+            if cutoff is not None:
+                valid &= ~(rows['mappability_' + e_type].astype(np.float64) < cutoff)
+        return valid
+
 
 class EnrichmentPeakFilter(PeakFilter):
     """
@@ -778,6 +993,17 @@ class EnrichmentPeakFilter(PeakFilter):
             return False
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the enrichment cutoffs.
+        """
+        valid = _nonzero_expected_rows(rows)
+        for e_type in ('ll', 'h', 'v', 'd'):
+            cutoff = getattr(self, 'enrichment_{}_cutoff'.format(e_type))
+            if cutoff is not None:
+                valid &= ~(rows['oe_' + e_type].astype(np.float64) < cutoff)
+        return valid
+
 
 class RaoPeakFilter(PeakFilter):
     """
@@ -822,6 +1048,19 @@ class RaoPeakFilter(PeakFilter):
 
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which peaks in an array of rows pass the Rao et al. (2014) criteria.
+        """
+        oe = {e_type: rows['oe_' + e_type].astype(np.float64) for e_type in ('ll', 'h', 'v', 'd')}
+        valid = _nonzero_expected_rows(rows)
+        valid &= ~((oe['d'] <= oe['ll']) & (oe['ll'] < 2.0))
+        valid &= ~((oe['h'] < 1.5) & (oe['v'] < 1.5))
+        valid &= ~((oe['d'] < 1.75) | (oe['ll'] < 1.75))
+        for e_type in ('d', 'll', 'h', 'v'):
+            valid &= ~(rows['fdr_' + e_type].astype(np.float64) > .1)
+        return valid
+
 
 class RaoMergedPeakFilter(PeakFilter):
     """
@@ -839,6 +1078,12 @@ class RaoMergedPeakFilter(PeakFilter):
 
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which merged peaks in an array of rows are no singlets above the cutoff.
+        """
+        return ~((rows['radius'] == 0) & (rows['q_value_sum'].astype(np.float64) > self.cutoff))
+
 
 class FdrSumFilter(PeakFilter):
     """
@@ -854,6 +1099,23 @@ class FdrSumFilter(PeakFilter):
 
         return True
 
+    def valid_rows(self, rows):
+        """
+        Check which merged peaks in an array of rows pass the q-value sum cutoff.
+        """
+        return ~(rows['q_value_sum'].astype(np.float64) > self.cutoff)
+
+
+def _nonzero_expected_rows(rows):
+    """
+    Check which peaks in an array of rows have non-zero expected values
+    in all neighborhoods.
+    """
+    valid = np.ones(len(rows), dtype=bool)
+    for e_type in ('ll', 'h', 'v', 'd'):
+        valid &= rows['e_' + e_type] != 0
+    return valid
+
 
 class RaoPeakCaller(object):
     """
@@ -1053,44 +1315,154 @@ class RaoPeakCaller(object):
         logger.debug("Got gridmap output.")
 
         for compressed_results in job_outputs:
-            results = msgpack.loads(compressed_results, strict_map_key=False)
-            for result in results:
-                found_none = False
-                for value in result:
-                    if value is None:
-                        found_none = True
-                if found_none:
-                    continue
+            results, zero_chunk_counts = msgpack.loads(compressed_results, strict_map_key=False)
+            results = np.array([tuple(result) for result in results if None not in result],
+                               dtype=_peak_result_dtype)
+            RaoPeakCaller._add_segment_results(results, zero_chunk_counts,
+                                               peaks, observed_chunk_distribution)
+
+    def _process_segments_local(self, segments, process_segment, e, c, mappable, ix_offset,
+                                segment_args, peaks, observed_chunk_distribution):
+        """
+        Process matrix segments in a local process pool and save in peak table.
+
+        Vectors of matrix rows and columns and segments are handed to the
+        workers in shared memory, results are returned as structured arrays.
+        With a single process, segments are processed directly.
+
+        :param process_segment: :func:`~_process_segment_intra` or
+                                :func:`~_process_segment_inter`
+        :param c: Biases of the matrix, or tuple with the biases of
+                  matrix rows and columns
+        :param mappable: Mappability of the matrix, or tuple with the
+                         mappability of matrix rows and columns
+        """
+        c_i, c_j = c if isinstance(c, tuple) else (c, c)
+        mappable_i, mappable_j = mappable if isinstance(mappable, tuple) else (mappable, mappable)
+
+        if self.n_processes <= 1:
+            for ms, i_range, i_inspect, j_range, j_inspect in segments:
+                results, zero_chunk_counts = process_segment(
+                    ms, e, ix_offset,
+                    i_range, i_inspect, mappable_i[i_range[0]:i_range[1]], c_i[i_range[0]:i_range[1]],
+                    j_range, j_inspect, mappable_j[j_range[0]:j_range[1]], c_j[j_range[0]:j_range[1]],
+                    *segment_args)
+                RaoPeakCaller._add_segment_results(results, zero_chunk_counts,
+                                                   peaks, observed_chunk_distribution)
+            return
+
+        pending = deque()
+
+        def _collect():
+            segment_arrays, result = pending.popleft()
+            try:
+                results, zero_chunk_counts = result.get()
+            finally:
+                segment_arrays.close()
+            RaoPeakCaller._add_segment_results(results, zero_chunk_counts,
+                                               peaks, observed_chunk_distribution)
+
+        with _SharedArrays({'e': e, 'c_i': c_i, 'mappable_i': mappable_i,
+                            'c_j': c_j, 'mappable_j': mappable_j}) as vector_arrays:
+            try:
+                with mp.get_context("spawn").Pool(self.n_processes) as pool:
+                    for ms, i_range, i_inspect, j_range, j_inspect in segments:
+                        if isinstance(ms, dict):
+                            segment_arrays = _SharedArrays({'row': ms['row'], 'col': ms['col'],
+                                                            'data': ms['data']})
+                            shape = tuple(ms['shape'])
+                        else:
+                            segment_arrays = _SharedArrays({'matrix': np.asarray(ms, dtype=np.float64)})
+                            shape = None
 
-                source, sink, weight, w_corr, p, observed, \
-                    ll_sum, e_ll, e_v, e_h, e_d, \
-                    o_chunk, e_ll_chunk, e_v_chunk, e_h_chunk, e_d_chunk, \
-                    e_ll_mappable, e_v_mappable, e_h_mappable, e_d_mappable = result
+                        args = [shape, ix_offset, i_range, i_inspect, j_range, j_inspect] + segment_args
+                        pending.append((segment_arrays,
+                                        pool.apply_async(_process_matrix_segment_shared,
+                                                         (process_segment, vector_arrays.specs,
+                                                          segment_arrays.specs, args))))
 
-                # update observed distribution
-                observed_chunk_distribution['ll'][e_ll_chunk][observed] += 1
-                observed_chunk_distribution['h'][e_h_chunk][observed] += 1
-                observed_chunk_distribution['v'][e_v_chunk][observed] += 1
-                observed_chunk_distribution['d'][e_d_chunk][observed] += 1
+                        # limit the number of segments held in memory
+                        if len(pending) >= 2 * self.n_processes:
+                            _collect()
 
-                if weight == 0.0:
-                    continue
+                    while len(pending) > 0:
+                        _collect()
+            finally:
+                for segment_arrays, _ in pending:
+                    segment_arrays.close()
+
+    def _process_segments_gridmap(self, segments, job_function, e, c, mappable, ix_offset,
+                                  segment_args, peaks, observed_chunk_distribution):
+        """
+        Process matrix segments as gridmap jobs and save in peak table.
+
+        :param job_function: :func:`~process_matrix_segment_intra` or
+                             :func:`~process_matrix_segment_inter`
+        :param c: Biases of the matrix, or tuple with the biases of
+                  matrix rows and columns
+        :param mappable: Mappability of the matrix, or tuple with the
+                         mappability of matrix rows and columns
+        """
+        c_i, c_j = c if isinstance(c, tuple) else (c, c)
+        mappable_i, mappable_j = mappable if isinstance(mappable, tuple) else (mappable, mappable)
 
-                oe_ll = 1 if e_ll == 0 else weight / e_ll
-                oe_h = 1 if e_h == 0 else weight / e_h
-                oe_v = 1 if e_v == 0 else weight / e_v
-                oe_d = 1 if e_d == 0 else weight / e_d
-
-                peak = Edge(source=source, sink=sink,
-                            weight=weight, uncorrected=observed,
-                            w=w_corr, p=p, ll_sum=ll_sum,
-                            e_ll=e_ll, e_h=e_h, e_v=e_v, e_d=e_d,
-                            oe_ll=oe_ll, oe_h=oe_h, oe_v=oe_v, oe_d=oe_d,
-                            e_ll_chunk=e_ll_chunk, e_v_chunk=e_v_chunk,
-                            e_h_chunk=e_h_chunk, e_d_chunk=e_d_chunk,
-                            mappability_ll=e_ll_mappable, mappability_v=e_v_mappable,
-                            mappability_h=e_h_mappable, mappability_d=e_d_mappable)
-                peaks.add_edge(peak)
+        jobs = []
+        for segment in segments:
+            ms, i_range, i_inspect, j_range, j_inspect = segment
+
+            args = [ms, e, ix_offset,
+                    i_range, i_inspect, mappable_i[i_range[0]:i_range[1]], c_i[i_range[0]:i_range[1]],
+                    j_range, j_inspect, mappable_j[j_range[0]:j_range[1]], c_j[j_range[0]:j_range[1]]] + \
+                segment_args
+
+            args = msgpack.dumps(args)
+            job = gridmap.Job(job_function, [args])
+            jobs.append(job)
+
+            # submit intermediate segments if maximum number of jobs reached
+            if len(jobs) >= self.n_processes:
+                self._process_jobs(jobs, peaks, observed_chunk_distribution)
+                jobs = []
+
+        if len(jobs) > 0:
+            self._process_jobs(jobs, peaks, observed_chunk_distribution)
+
+    @staticmethod
+    def _add_segment_results(results, zero_chunk_counts, peaks, observed_chunk_distribution):
+        """
+        Update the observed distribution and add non-zero pixels to peak table.
+
+        :param results: structured array with :code:`_peak_result_dtype`
+        :param zero_chunk_counts: dict <neighborhood>: {<chunk>: <number of zero pixels>}
+        :param peaks: :class:`~RaoPeakInfo`
+        :param observed_chunk_distribution: dict <neighborhood>: {<chunk>: {<observed>: <count>}}.
+                                            If None, results do not contribute to
+                                            the distribution (inter-chromosomal peaks)
+        """
+        if observed_chunk_distribution is not None:
+            # pixels without contacts are only reported as counts
+            for e_type, chunk_counts in zero_chunk_counts.items():
+                for chunk, count in chunk_counts.items():
+                    observed_chunk_distribution[e_type][chunk][0] += count
+
+        if len(results) == 0:
+            return
+
+        # update observed distribution
+        if observed_chunk_distribution is not None:
+            for e_type in ('ll', 'h', 'v', 'd'):
+                chunk_observed = np.stack([results['e_{}_chunk'.format(e_type)], results['uncorrected']], axis=1)
+                chunk_observed, counts = np.unique(chunk_observed, axis=0, return_counts=True)
+                for (chunk, observed), count in zip(chunk_observed.tolist(), counts.tolist()):
+                    observed_chunk_distribution[e_type][chunk][observed] += count
+
+        results = results[results['weight'] != 0.0]
+        edge_arrays = {name: results[name] for name in results.dtype.names if name != 'o_chunk'}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for e_type in ('ll', 'h', 'v', 'd'):
+                e = results['e_' + e_type]
+                edge_arrays['oe_' + e_type] = np.where(e == 0, 1, results['weight'] / e)
+        peaks._add_edge_arrays(edge_arrays)
 
     @staticmethod
     def _get_fdr_cutoffs(observed_chunk_distribution, e_func=lambda x: 2**(x/3)):
@@ -1098,42 +1470,109 @@ class RaoPeakCaller(object):
         For all possible observed values in each lambda chunk, determine the
         FDR cutoff that denotes the lower significance bound.
         """
-        # determine all possible observed values
-
         fdr_cutoffs = dict()
         for e_type in observed_chunk_distribution:  # ll, h, v, d
             fdr_cutoffs[e_type] = defaultdict(lambda: defaultdict(int))
-            for chunk in observed_chunk_distribution[e_type].keys():
-                max_e = e_func(chunk)
-                poisson_e = poisson(max_e)
-
-                observed_sum = 0
-                for observed_count in observed_chunk_distribution[e_type][chunk].values():
-                    observed_sum += observed_count
-
-                observed_distribution_integral_left = 0
-                for observed in sorted(observed_chunk_distribution[e_type][chunk].keys()):
-                    observed_count = observed_chunk_distribution[e_type][chunk][observed]
-                    observed_distribution_integral_left += observed_count/observed_sum
-                    observed_distribution_integral_right = 1 - observed_distribution_integral_left
-                    poisson_integral_right = 1 - poisson_e.cdf(observed)
-
-                    if observed_distribution_integral_right > 0:
-                        integral_ratio = poisson_integral_right/observed_distribution_integral_right
-                        fdr_cutoff = min(1, integral_ratio)
-                        fdr_cutoffs[e_type][chunk][observed] = fdr_cutoff
-                    else:
-                        fdr_cutoffs[e_type][chunk][observed] = 0
+            for chunk, observed_counts in observed_chunk_distribution[e_type].items():
+                observed = np.array(sorted(observed_counts.keys()), dtype=np.int64)
+                counts = np.array([observed_counts[o] for o in observed.tolist()], dtype=np.float64)
+
+                observed_distribution_integral_right = 1 - np.cumsum(counts / counts.sum())
+                poisson_integral_right = poisson.sf(observed, e_func(chunk))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    integral_ratio = poisson_integral_right / observed_distribution_integral_right
+                cutoffs = np.where(observed_distribution_integral_right > 0,
+                                   np.minimum(1, integral_ratio), 0)
+                fdr_cutoffs[e_type][chunk].update(zip(observed.tolist(), cutoffs.tolist()))
         return fdr_cutoffs
 
     @staticmethod
-    def segment_matrix_intra(m, chunk_size, w_max):
+    def _lookup_fdr_cutoffs(cutoffs, chunks, observed):
+        """
+        Vectorised lookup of FDR cutoffs for a single neighborhood type.
+
+        :param cutoffs: dict <chunk>: {<observed>: <FDR cutoff>}, as returned
+                        for each neighborhood by :func:`~RaoPeakCaller._get_fdr_cutoffs`
+        :param chunks: array of lambda chunks
+        :param observed: array of observed values
+        :return: tuple (FDR cutoffs, found), where found is False for
+                 combinations of chunk and observed value without a cutoff
+        """
+        chunks = np.asarray(chunks, dtype=np.int64)
+        observed = np.asarray(observed, dtype=np.int64)
+        cutoff_chunks, cutoff_observed, cutoff_values = [], [], []
+        for chunk, observed_cutoffs in cutoffs.items():
+            cutoff_chunks += [chunk] * len(observed_cutoffs)
+            cutoff_observed += list(observed_cutoffs.keys())
+            cutoff_values += list(observed_cutoffs.values())
+        if len(cutoff_values) == 0:
+            return np.ones(chunks.shape), np.zeros(chunks.shape, dtype=bool)
+
+        base = max(cutoff_observed) + 1
+        keys = np.array(cutoff_chunks, dtype=np.int64) * base + np.array(cutoff_observed, dtype=np.int64)
+        order = np.argsort(keys)
+        keys, values = keys[order], np.array(cutoff_values, dtype=np.float64)[order]
+
+        query = chunks * base + observed
+        ixs = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        found = np.logical_and.reduce([keys[ixs] == query, observed >= 0, observed < base])
+        return np.where(found, values[ixs], 1.), found
+
+    @staticmethod
+    def _assign_fdrs(peaks, fdr_cutoffs, chunk_size=1000000):
+        """
+        Write FDR values of all peaks in a peak table.
+
+        :param peaks: :class:`~RaoPeakInfo`
+        :param fdr_cutoffs: FDR cutoffs from :func:`~RaoPeakCaller._get_fdr_cutoffs`
+        :param chunk_size: Number of peaks processed at once
+        """
+        e_types = ('ll', 'h', 'v', 'd')
+        with RareUpdateProgressBar(max_value=len(peaks.edges), prefix='FDR') as pb:
+            counter = 0
+            for _, edge_table in peaks._iter_edge_tables():
+                for start in range(0, edge_table.nrows, chunk_size):
+                    stop = min(start + chunk_size, edge_table.nrows)
+                    observed = edge_table.read(start, stop, field='uncorrected')
+
+                    fdrs = dict()
+                    all_found = np.ones(observed.shape, dtype=bool)
+                    for e_type in e_types:
+                        chunks = edge_table.read(start, stop, field='e_{}_chunk'.format(e_type))
+                        fdrs[e_type], found = RaoPeakCaller._lookup_fdr_cutoffs(fdr_cutoffs[e_type],
+                                                                                chunks, observed)
+                        all_found = np.logical_and(all_found, found)
+
+                    for e_type in e_types:
+                        edge_table.modify_column(start, stop, colname='fdr_{}'.format(e_type),
+                                                 column=np.where(all_found, fdrs[e_type], 1))
+                    counter += stop - start
+                    pb.update(counter)
+                edge_table.flush()
+
+    @staticmethod
+    def segment_matrix_intra(m, chunk_size, w_max, max_distance=None):
+        """
+        Split an intra-chromosomal matrix into overlapping segments.
+
+        :param m: Matrix, or any object with a shape that supports
+                  2D slicing, such as the sparse :class:`~_IntraChromosomalMatrix`
+        :param chunk_size: Size of the inspected part of each segment
+        :param w_max: Maximum neighborhood width, added to each side
+                      of the inspected part
+        :param max_distance: Maximum distance in bins of inspected pixels
+                             from the diagonal. Segments without any
+                             pixels in this band are skipped
+        :return: iterator over (segment, i_range, i_inspect, j_range, j_inspect)
+        """
         for i in range(0, m.shape[0], chunk_size):
             i_start = max(0, i - w_max)
             i_end = min(i + chunk_size + w_max, m.shape[0])
             i_range = (i_start, i_end)
             i_inspect = (i, min(i + chunk_size, m.shape[0]))
             for j in range(i, m.shape[1], chunk_size):
+                if max_distance is not None and j - (i_inspect[1] - 1) > max_distance:
+                    break
                 j_start = max(0, j - w_max)
                 j_end = min(j + chunk_size + w_max, m.shape[1])
                 j_range = (j_start, j_end)
@@ -1141,36 +1580,140 @@ class RaoPeakCaller(object):
                 ms = m[i_start:i_end, j_start:j_end]
                 yield ms, i_range, i_inspect, j_range, j_inspect
 
-    def _find_peaks_intra_matrix(self, m, e, c, peak_info, mappable, ix_offset,
-                                 observed_chunk_distribution, w, p):
+    @staticmethod
+    def segment_matrix_inter(m, chunk_size, w_max):
         """
-        Given a matrix (strictly intra-chromosomal), calculate peak
-        information for all pixels.
+        Split an inter-chromosomal matrix into overlapping segments,
+        skipping all segments without edges in their inspected part.
+
+        :param m: Matrix, or any object with a shape that supports 2D
+                  slicing and provides tile_counts, such as the sparse
+                  :class:`~_InterChromosomalMatrix`
+        :param chunk_size: Size of the inspected part of each segment
+        :param w_max: Maximum neighborhood width, added to each side
+                      of the inspected part
+        :return: iterator over (segment, i_range, i_inspect, j_range, j_inspect)
         """
+        if hasattr(m, 'tile_counts'):
+            tile_counts = m.tile_counts(chunk_size)
+        else:
+            row, col = np.nonzero(m)
+            tile_counts = _tile_counts(row, col, m.shape, chunk_size)
 
-        jobs = []
-        for segment in RaoPeakCaller.segment_matrix_intra(m, self.slice_size, self.max_w):
-            ms, i_range, i_inspect, j_range, j_inspect = segment
+        for i_tile, j_tile in zip(*np.nonzero(tile_counts)):
+            i, j = i_tile * chunk_size, j_tile * chunk_size
+            i_start = max(0, i - w_max)
+            i_end = min(i + chunk_size + w_max, m.shape[0])
+            i_range = (i_start, i_end)
+            i_inspect = (i, min(i + chunk_size, m.shape[0]))
+            j_start = max(0, j - w_max)
+            j_end = min(j + chunk_size + w_max, m.shape[1])
+            j_range = (j_start, j_end)
+            j_inspect = (j, min(j + chunk_size, m.shape[1]))
+            ms = m[i_start:i_end, j_start:j_end]
+            yield ms, i_range, i_inspect, j_range, j_inspect
 
-            args = [ms, e, ix_offset,
-                    i_range, i_inspect, mappable[i_range[0]:i_range[1]], c[i_range[0]:i_range[1]],
-                    j_range, j_inspect, mappable[j_range[0]:j_range[1]], c[j_range[0]:j_range[1]],
-                    w, p, self.min_locus_dist, self.min_ll_reads, self.min_mappable_fraction,
-                    self.max_w]
+    def _find_peaks_intra_matrix(self, m, e, c, peak_info, mappable, ix_offset,
+                                 observed_chunk_distribution, w, p, max_distance=None):
+        """
+        Given a matrix (strictly intra-chromosomal), calculate peak
+        information for all pixels (up to max_distance bins from the diagonal).
+        """
+        segments = RaoPeakCaller.segment_matrix_intra(m, self.slice_size, self.max_w,
+                                                      max_distance=max_distance)
+        segment_args = [w, p, self.min_locus_dist, self.min_ll_reads, self.min_mappable_fraction,
+                        self.max_w, max_distance]
 
-            args = msgpack.dumps(args)
-            job = gridmap.Job(process_matrix_segment_intra, [args])
-            jobs.append(job)
+        if not self.cluster:
+            self._process_segments_local(segments, _process_segment_intra, e, c, mappable, ix_offset,
+                                         segment_args, peak_info, observed_chunk_distribution)
+        else:
+            self._process_segments_gridmap(segments, process_matrix_segment_intra, e, c, mappable, ix_offset,
+                                           segment_args, peak_info, observed_chunk_distribution)
 
-            # submit intermediate segments if maximum number of jobs reached
-            if len(jobs) >= self.n_processes:
-                self._process_jobs(jobs, peak_info, observed_chunk_distribution)
-                jobs = []
+    def _find_peaks_inter_matrix(self, m, e, c_row, c_col, peak_info, mappable_row, mappable_col,
+                                 ix_offset_row, ix_offset_col, w, p):
+        """
+        Given a (sparse) inter-chromosomal matrix, calculate peak
+        information for all pixels in tiles containing edges, using
+        a constant expected value.
+        """
+        segments = RaoPeakCaller.segment_matrix_inter(m, self.slice_size, self.max_w)
+        segment_args = [w, p, self.min_ll_reads, self.min_mappable_fraction, self.max_w]
 
-        if len(jobs) > 0:
-            self._process_jobs(jobs, peak_info, observed_chunk_distribution)
+        args = [e, (c_row, c_col), (mappable_row, mappable_col), (ix_offset_row, ix_offset_col),
+                segment_args, peak_info, None]
+        if not self.cluster:
+            self._process_segments_local(segments, _process_segment_inter, *args)
+        else:
+            self._process_segments_gridmap(segments, process_matrix_segment_inter, *args)
 
-    def call_peaks(self, hic, chromosome_pairs=None, file_name=None, intra_expected=None, inter_expected=None):
+    @staticmethod
+    def _assign_inter_fdrs(peaks, bias, n_tests, correction='fdr'):
+        """
+        Write FDR values of all inter-chromosomal peaks in a peak table.
+
+        P-values are obtained from a Poisson distribution with the
+        expected value of each neighborhood as mean, and corrected for
+        the number of tested inter-chromosomal pixels.
+
+        :param peaks: :class:`~RaoPeakInfo`
+        :param bias: Bias vector of the Hi-C matrix
+        :param n_tests: Number of possible inter-chromosomal pixels
+        :param correction: 'fdr' for Benjamini-Hochberg, 'bonferroni' for
+                           Bonferroni correction, None for uncorrected p-values
+        """
+        if correction not in ('fdr', 'bonferroni', None):
+            raise ValueError("Unknown multiple testing correction '{}'".format(correction))
+
+        region_chromosomes = np.empty(len(peaks.regions), dtype=np.int64)
+        for i, (start, end) in enumerate(peaks.chromosome_bins.values()):
+            region_chromosomes[start:end] = i
+
+        e_types = ('ll', 'h', 'v', 'd')
+        tables, rows, p_values = [], [], {e_type: [] for e_type in e_types}
+        for _, edge_table in peaks._iter_edge_tables():
+            source = edge_table.col('source').astype(np.int64)
+            sink = edge_table.col('sink').astype(np.int64)
+            inter = np.nonzero(region_chromosomes[source] != region_chromosomes[sink])[0]
+            if len(inter) == 0:
+                continue
+            source, sink = source[inter], sink[inter]
+            observed = edge_table.col('uncorrected')[inter]
+            cf = bias[source] * bias[sink]
+            for e_type in e_types:
+                e = edge_table.col('e_{}'.format(e_type))[inter]
+                # P(X >= observed)
+                p_values[e_type].append(poisson.sf(observed - 1, e / cf))
+            tables.append(edge_table)
+            rows.append(inter)
+
+        if len(tables) == 0:
+            return
+
+        for e_type in e_types:
+            p = np.concatenate(p_values[e_type])
+            if correction == 'fdr':
+                order = np.argsort(p, kind='stable')
+                fdrs = p[order] * n_tests / np.arange(1, len(p) + 1)
+                fdrs = np.minimum.accumulate(fdrs[::-1])[::-1]
+                p[order] = fdrs
+            elif correction == 'bonferroni':
+                p = p * n_tests
+            p = np.minimum(1, p)
+
+            offset = 0
+            for edge_table, inter in zip(tables, rows):
+                fdrs = edge_table.col('fdr_{}'.format(e_type))
+                fdrs[inter] = p[offset:offset + len(inter)]
+                edge_table.modify_column(colname='fdr_{}'.format(e_type), column=fdrs)
+                offset += len(inter)
+
+        for edge_table in tables:
+            edge_table.flush()
+
+    def call_peaks(self, hic, chromosome_pairs=None, file_name=None, intra_expected=None, inter_expected=None,
+                   max_distance=None, resume=False):
         """
         Call peaks in Hi-C matrix.
 
@@ -1194,29 +1737,47 @@ class RaoPeakCaller(object):
                                <chromosome>:<list of expected values> to override
                                expected value calculation
         :param inter_expected: A float describing the expected value
-                               for inter-chromosomal contact matrix entries
+                               for inter-chromosomal contact matrix entries.
+                               Inter-chromosomal matrices are only scanned if
+                               process_inter is True, skipping all tiles
+                               without contacts
+        :param max_distance: Maximum distance in base pairs between two loci
+                             to consider a peak. If set, only the diagonal band
+                             of each intra-chromosomal matrix up to this distance
+                             is loaded and scanned, which saves time at high
+                             resolution
+        :param resume: If True, progress is recorded in file_name after each
+                       chromosome pair. If file_name already contains such a
+                       checkpoint from an interrupted run with the same
+                       parameters, chromosome pairs that were completely
+                       processed are skipped
         :return: :class:`~RaoPeakInfo` object
         """
-        if self.process_inter:
-            raise RuntimeError("Inter-chromosomal peak calling not currently supported!")
+        peaks = None
+        checkpoint_found = False
+        if resume and file_name is not None and os.path.exists(os.path.expanduser(file_name)):
+            peaks = RaoPeakInfo(file_name, mode='a')
+            if not peaks._has_peak_calling_checkpoint():
+                logger.info("No peak calling checkpoint found in {}, starting from scratch".format(file_name))
+                peaks.close()
+                peaks = None
+            else:
+                logger.info("Resuming peak calling in {}".format(file_name))
+                checkpoint_found = True
 
-        peaks = RaoPeakInfo(file_name, mode='w')
-        peaks.add_regions(hic.regions, preserve_attributes=False)
+        if peaks is None:
+            peaks = RaoPeakInfo(file_name, mode='w')
+            peaks.add_regions(hic.regions, preserve_attributes=False)
 
         # expected values
-        if intra_expected is None:
-            logger.info("Calculating intra-chromosomal expected values...")
-            _, intra_expected, _ = hic.expected_values()
+        if intra_expected is None or (self.process_inter and inter_expected is None):
+            logger.info("Calculating expected values...")
+            _, hic_intra_expected, hic_inter_expected = hic.expected_values()
+            if intra_expected is None:
+                intra_expected = hic_intra_expected
+            if inter_expected is None:
+                inter_expected = hic_inter_expected
             logger.info("Done.")
-        # if self.process_inter and inter_expected is None:
-        #     logger.info("Inter-chromosomal expected values...")
-        #     with ExpectedContacts(hic, smooth=False) as expected:
-        #         inter_expected = expected.inter_expected()
-        #
-        # if self.process_inter:
-        #     intra_possible, inter_possible = hic.possible_contacts()
-        # else:
-        #     intra_possible, inter_possible = None, None
 
         # mappability
         mappable = hic.mappable()
@@ -1239,14 +1800,39 @@ class RaoPeakCaller(object):
             self.min_locus_dist = p
         logger.info("Initial parameter values: p=%d, w=%d" % (p, w_init))
 
+        max_distance_bins = None
+        if max_distance is not None:
+            max_distance_bins = int(max_distance // hic.bin_size)
+            logger.info("Only considering peaks up to {}bp ({} bins) apart".format(max_distance,
+                                                                                  max_distance_bins))
+
         logger.info("Obtaining bias vector...")
         c = hic.bias_vector()
         logger.info("Done.")
 
+        parameters = [p, w_init, self.min_locus_dist, self.max_w, self.min_ll_reads,
+                      self.min_mappable_fraction, self.slice_size, max_distance_bins,
+                      bool(self.process_inter), len(hic.regions)]
+        completed_pairs = []
+        checkpoint_distribution = dict()
+        inter_possible = 0
+        if checkpoint_found:
+            try:
+                completed_pairs, checkpoint_distribution, inter_possible = \
+                    peaks._peak_calling_checkpoint(parameters)
+            except ValueError:
+                peaks.close()
+                raise
+        elif resume:
+            peaks._init_peak_calling_checkpoint(parameters)
+        completed_pairs = set(completed_pairs)
+
         # lambda chunks container
         observed_chunk_distribution = dict()
         for e_type in ('ll', 'h', 'v', 'd'):
             observed_chunk_distribution[e_type] = defaultdict(lambda: defaultdict(int))
+            for chunk, observed_counts in checkpoint_distribution.get(e_type, {}).items():
+                observed_chunk_distribution[e_type][chunk].update(observed_counts)
 
         # start processing chromosome pairs
         if chromosome_pairs is None:
@@ -1260,185 +1846,635 @@ class RaoPeakCaller(object):
 
         chromosome_bins = hic.chromosome_bins
         for chromosome1, chromosome2 in chromosome_pairs:
+            if (chromosome1, chromosome2) in completed_pairs:
+                logger.info("Skipping %s-%s (already processed)" % (chromosome1, chromosome2))
+                continue
             logger.info("Processing %s-%s" % (chromosome1, chromosome2))
 
             start1, end1 = chromosome_bins[chromosome1]
             ix_offset = start1
             start2, end2 = chromosome_bins[chromosome2]
             if chromosome1 == chromosome2:
-                m = hic.matrix((chromosome1, chromosome2))
+                # segments are loaded sparsely and on demand
+                m = _IntraChromosomalMatrix(hic, start1, end1, bias=c, valid=mappable)
                 self._find_peaks_intra_matrix(m, intra_expected[chromosome1], c[start1:end1],
                                               peaks, mappable[start1:end1], ix_offset,
-                                              observed_chunk_distribution, w_init, p)
+                                              observed_chunk_distribution, w_init, p,
+                                              max_distance=max_distance_bins)
             elif self.process_inter:
-                warnings.warn("Inter-chromosomal peak calling not currently supported!")
-                # self._find_peaks_inter_matrix(m, inter_expected, c[start1:end1], c[start2:end2],
-                #                              peaks, mappable[start1:end1], mappable[start2:end2],
-                #                              None, None, w_init, p)
+                # only tiles containing edges are loaded and scanned
+                m = _InterChromosomalMatrix(hic, start1, end1, start2, end2, bias=c, valid=mappable)
+                self._find_peaks_inter_matrix(m, inter_expected, c[start1:end1], c[start2:end2],
+                                              peaks, mappable[start1:end1], mappable[start2:end2],
+                                              start1, start2, w_init, p)
+                inter_possible += int(np.sum(mappable[start1:end1])) * int(np.sum(mappable[start2:end2]))
+
+            # peaks and distributions of completed pairs survive interruptions
+            if resume:
+                peaks._save_peak_calling_checkpoint((chromosome1, chromosome2),
+                                                    observed_chunk_distribution, inter_possible)
         peaks.flush()
 
         # calculate fdrs
         logger.info("Finding FDR cutoffs...")
         fdr_cutoffs = RaoPeakCaller._get_fdr_cutoffs(observed_chunk_distribution)
 
-        # regions_dict = peaks.regions_dict
-        with RareUpdateProgressBar(max_value=len(peaks.edges), prefix='FDR') as pb:
-            for i, peak in enumerate(peaks.peaks(lazy=True, writable=True)):
-                # region1 = regions_dict[peak.source]
-                # region2 = regions_dict[peak.sink]
-                # if region1.chromosome == region2.chromosome:
-                try:
-                    peak.fdr_ll = fdr_cutoffs['ll'][peak.e_ll_chunk][peak.uncorrected]
-                    peak.fdr_h = fdr_cutoffs['h'][peak.e_h_chunk][peak.uncorrected]
-                    peak.fdr_v = fdr_cutoffs['v'][peak.e_v_chunk][peak.uncorrected]
-                    peak.fdr_d = fdr_cutoffs['d'][peak.e_d_chunk][peak.uncorrected]
-                except KeyError:
-                    peak.fdr_ll = 1
-                    peak.fdr_h = 1
-                    peak.fdr_v = 1
-                    peak.fdr_d = 1
-                peak.update()
-
-                pb.update(i)
-                # else:
-                #     # Bonferroni correction
-                #     if self.correct_inter == 'bonferroni':
-                #         peak.fdr_ll *= inter_possible
-                #         peak.fdr_h *= inter_possible
-                #         peak.fdr_v *= inter_possible
-                #         peak.fdr_d *= inter_possible
-                #         peak.update()
+        RaoPeakCaller._assign_fdrs(peaks, fdr_cutoffs)
         peaks.flush()
 
-        # if self.process_inter and self.correct_inter == 'fdr':
-        #     # fdr_ll
-        #     for i, peak in enumerate(peaks.peaks_sorted('fdr_ll', lazy=True, auto_update=False)):
-        #         region1 = regions_dict[peak.source]
-        #         region2 = regions_dict[peak.sink]
-        #         if region1.chromosome != region2.chromosome:
-        #             peak.fdr_ll *= inter_possible/(i+1)
-        #             peak.update()
-        #     peaks.flush()
-        #     # fdr_h
-        #     for i, peak in enumerate(peaks.peaks_sorted('fdr_h', lazy=True, auto_update=False)):
-        #         region1 = regions_dict[peak.source]
-        #         region2 = regions_dict[peak.sink]
-        #         if region1.chromosome != region2.chromosome:
-        #             peak.fdr_h *= inter_possible/(i+1)
-        #             peak.update()
-        #     peaks.flush()
-        #     # fdr_v
-        #     for i, peak in enumerate(peaks.peaks_sorted('fdr_v', lazy=True, auto_update=False)):
-        #         region1 = regions_dict[peak.source]
-        #         region2 = regions_dict[peak.sink]
-        #         if region1.chromosome != region2.chromosome:
-        #             peak.fdr_v *= inter_possible/(i+1)
-        #             peak.update()
-        #     peaks.flush()
-        #     # fdr_d
-        #     for i, peak in enumerate(peaks.peaks_sorted('fdr_d', lazy=True, auto_update=False)):
-        #         region1 = regions_dict[peak.source]
-        #         region2 = regions_dict[peak.sink]
-        #         if region1.chromosome != region2.chromosome:
-        #             peak.fdr_d *= inter_possible/(i+1)
-        #             peak.update()
-        #     peaks.flush()
+        # inter-chromosomal peaks are not lambda-chunked
+        if inter_possible > 0:
+            logger.info("Correcting inter-chromosomal FDRs...")
+            RaoPeakCaller._assign_inter_fdrs(peaks, c, inter_possible, correction=self.correct_inter)
 
         return peaks
 
 
-def process_matrix_segment_intra(data):
-    m_original, e, ix_offset, \
-        i_range, i_inspect, mappable_i, c_i, \
-        j_range, j_inspect, mappable_j, c_j, \
-        w, p, min_locus_dist, min_ll_reads, min_mappable, \
-        max_w = msgpack.loads(data, strict_map_key=False)
+def _integral_image(m, dtype=np.float64):
+    """
+    Summed-area table of a matrix, padded with a leading row and column of zeros.
+    """
+    sat = np.zeros((m.shape[0] + 1, m.shape[1] + 1), dtype=dtype)
+    np.cumsum(m, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
 
-    m_original = np.array(m_original)
-    # construct convenient matrices
-    row_ixs = np.arange(i_range[0], i_range[1])
-    col_ixs = np.arange(j_range[0], j_range[1])
+
+def _rectangles(shape, row_start, row_end, col_start, col_end):
+    """
+    Clip rectangle coordinates (end exclusive) to a matrix shape.
+
+    Equivalent to slicing a matrix with m[max(0, row_start):row_end, ...].
+    Empty rectangles have identical start and end coordinates.
+    """
+    row_start = np.clip(row_start, 0, shape[0])
+    row_end = np.maximum(np.clip(row_end, 0, shape[0]), row_start)
+    col_start = np.clip(col_start, 0, shape[1])
+    col_end = np.maximum(np.clip(col_end, 0, shape[1]), col_start)
+    return row_start, row_end, col_start, col_end
+
+
+def _rectangle_sums(sat, rectangles):
+    """
+    Sums of matrix entries in rectangles using its summed-area table.
+    """
+    row_start, row_end, col_start, col_end = rectangles
+    return sat[row_end, col_end] - sat[row_start, col_end] - sat[row_end, col_start] + sat[row_start, col_start]
+
+
+def _rectangle_areas(rectangles):
+    row_start, row_end, col_start, col_end = rectangles
+    return (row_end - row_start) * (col_end - col_start)
+
+
+def _neighborhood_rectangles(shape, neighborhood, i, j, w, p):
+    """
+    Rectangles that add up to a neighborhood of pixels (i, j).
+
+    The first rectangle is added, all others are subtracted, mirroring
+    :func:`~RaoPeakCaller.e_ll_sum`, :func:`~RaoPeakCaller.e_h_sum`,
+    :func:`~RaoPeakCaller.e_v_sum`, and :func:`~RaoPeakCaller.e_d_sum`.
+    """
+    if neighborhood == 'll':
+        return [_rectangles(shape, i + 1, i + w + 1, j - w, j),
+                _rectangles(shape, i + 1, i + p + 1, j - p, j)]
+    if neighborhood == 'h':
+        return [_rectangles(shape, i - 1, i + 2, j - w, j + w + 1),
+                _rectangles(shape, i - 1, i + 2, j - p, j + p + 1)]
+    if neighborhood == 'v':
+        return [_rectangles(shape, i - w, i + w + 1, j - 1, j + 2),
+                _rectangles(shape, i - p, i + p + 1, j - 1, j + 2)]
+    if neighborhood == 'd':
+        return [_rectangles(shape, i - w, i + w + 1, j - w, j + w + 1),
+                _rectangles(shape, i - p, i + p + 1, j - p, j + p + 1),
+                _rectangles(shape, i - w, np.maximum(0, i - p), j, j + 1),
+                _rectangles(shape, i + p + 1, i + w + 1, j, j + 1),
+                _rectangles(shape, i, i + 1, j - w, np.maximum(0, j - p)),
+                _rectangles(shape, i, i + 1, j + p + 1, j + w + 1)]
+    raise ValueError("Unknown neighborhood type '{}'".format(neighborhood))
+
+
+class _SegmentNeighborhoods(object):
+    """
+    Vectorised neighborhood sums for all pixels of a matrix segment.
+
+    Reproduces the masked-array semantics of the per-pixel
+    :class:`~RaoPeakCaller` helpers: a sum over a rectangle without
+    unmasked pixels is "masked" (if the segment has any masked pixels).
+    Masked lower-left, horizontal, and vertical sums result in NaN
+    enrichment, masked donut components count as 0.
+    """
+
+    def __init__(self, m_original, m_uncorrected, m_expected, mask):
+        self.shape = m_original.shape
+        self.m_expected = m_expected
+        self.has_mask = bool(mask.any())
+        unmasked = ~mask
+        self.unmasked_sat = _integral_image(unmasked, dtype=np.int64)
+        self.masked_sat = _integral_image(mask, dtype=np.int64)
+        # uncorrected values are integers, so float64 sums are exact
+        self.uncorrected_sat = _integral_image(np.where(unmasked, m_uncorrected, 0.0))
+        # extended precision to keep cancellation errors below float64 resolution
+        self.original_sat = _integral_image(np.where(unmasked, m_original, 0.0), dtype=np.longdouble)
+        self.expected_sat = _integral_image(np.where(unmasked, m_expected, 0.0), dtype=np.longdouble)
+
+    def _is_masked(self, rectangles):
+        if not self.has_mask:
+            return np.zeros(rectangles[0].shape, dtype=bool)
+        return _rectangle_sums(self.unmasked_sat, rectangles) == 0
+
+    def ll_sum(self, i, j, w, p):
+        """
+        Sum of uncorrected reads in the lower-left neighborhood (0 if masked).
+        """
+        outer, inner = _neighborhood_rectangles(self.shape, 'll', i, j, w, p)
+        sums = _rectangle_sums(self.uncorrected_sat, outer) - _rectangle_sums(self.uncorrected_sat, inner)
+        sums[np.logical_or(self._is_masked(outer), self._is_masked(inner))] = 0
+        return sums
+
+    def mappability(self, neighborhood, i, j, w, p):
+        """
+        Fraction of mappable pixels in a neighborhood.
+        """
+        rectangles = _neighborhood_rectangles(self.shape, neighborhood, i, j, w, p)
+        n_masked = _rectangle_sums(self.masked_sat, rectangles[0])
+        n_total = _rectangle_areas(rectangles[0]).astype(np.float64)
+        for r in rectangles[1:]:
+            n_masked = n_masked - _rectangle_sums(self.masked_sat, r)
+            n_total = n_total - _rectangle_areas(r)
+        return 1 - n_masked / n_total
+
+    def _neighborhood_sum(self, sat, rectangles):
+        sums = [_rectangle_sums(sat, r).astype(np.float64) for r in rectangles]
+        if len(rectangles) == 2:
+            total = sums[0] - sums[1]
+            total[np.logical_or(self._is_masked(rectangles[0]), self._is_masked(rectangles[1]))] = np.nan
+            return total
+
+        for r, rectangle_sum in zip(rectangles, sums):
+            rectangle_sum[self._is_masked(r)] = 0
+        total = sums[0]
+        for rectangle_sum in sums[1:]:
+            total = total - rectangle_sum
+        return total
+
+    def enrichment(self, neighborhood, i, j, w, p):
+        """
+        Locally expected value of pixels based on a neighborhood.
+        """
+        rectangles = _neighborhood_rectangles(self.shape, neighborhood, i, j, w, p)
+        observed = self._neighborhood_sum(self.original_sat, rectangles)
+        expected = self._neighborhood_sum(self.expected_sat, rectangles)
+        return observed / expected * self.m_expected[i, j]
+
+
+def _find_chunks(values):
+    """
+    Vectorised version of :func:`~RaoPeakCaller.find_chunk`.
+
+    :return: tuple (chunks, valid), where valid is False for values
+             that :func:`~RaoPeakCaller.find_chunk` maps to None
+    """
+    values = np.asarray(values, dtype=np.float64)
+    chunks = np.zeros(values.shape, dtype=np.int64)
     with np.errstate(divide='ignore', invalid='ignore'):
-        m_uncorrected = np.rint(m_original/c_i[:, None]/c_j)
-    m_distance = np.array([abs(col_ixs - i) for i in row_ixs])
-    expected_f = np.vectorize(lambda x: e[x])
-    m_expected = expected_f(m_distance)
+        v = 3 * np.log2(values)
+    large = values >= 1
+    valid = np.logical_and(~np.isnan(values), np.logical_or(~large, np.isfinite(v)))
+    ix = np.logical_and(large, valid)
+    chunks[ix] = np.floor(v[ix]).astype(np.int64) + 1
+    return chunks, valid
+
+
+_peak_result_dtype = np.dtype([
+    ('source', np.int64), ('sink', np.int64), ('weight', np.float64),
+    ('w', np.int64), ('p', np.int64), ('uncorrected', np.int64), ('ll_sum', np.int64),
+    ('e_ll', np.float64), ('e_v', np.float64), ('e_h', np.float64), ('e_d', np.float64),
+    ('o_chunk', np.int64), ('e_ll_chunk', np.int64), ('e_v_chunk', np.int64),
+    ('e_h_chunk', np.int64), ('e_d_chunk', np.int64),
+    ('mappability_ll', np.float64), ('mappability_v', np.float64),
+    ('mappability_h', np.float64), ('mappability_d', np.float64),
+])
+
+
+class _SharedArrays(object):
+    """
+    Numpy arrays in a single block of shared memory.
 
-    # mask above matrices by mappability
-    mask = np.zeros(m_original.shape, dtype=bool)
-    mask[np.logical_not(mappable_i)] = True
-    mask[:, np.logical_not(mappable_j)] = True
+    Other processes obtain views of the arrays from :attr:`specs` using
+    :func:`~_attach_shared_arrays`, without copying or serialising the
+    data. The block is freed with :func:`~_SharedArrays.close`.
+    """
 
-    m_original = np.ma.masked_where(mask, m_original)
-    m_uncorrected = np.ma.masked_where(mask, m_uncorrected)
-    m_expected = np.ma.masked_where(mask, m_expected)
-    m_ones = np.ones(m_original.shape)
+    def __init__(self, arrays):
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        offsets = {}
+        size = 0
+        for name, array in arrays.items():
+            offsets[name] = size
+            size += -(-array.nbytes // 8) * 8  # keep arrays 8-byte aligned
 
-    results = []
-    for o_i in range(i_inspect[0], i_inspect[1]):
-        i = o_i - i_range[0]
-        for o_j in range(j_inspect[0], j_inspect[1]):
-            j = o_j - j_range[0]
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.specs = {'name': self._shm.name, 'arrays': {}}
+        for name, array in arrays.items():
+            np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf, offset=offsets[name])[...] = array
+            self.specs['arrays'][name] = (array.shape, array.dtype.str, offsets[name])
 
-            # only inspect pixels at a certain distance
-            # above the diagonal
-            if o_j - o_i < p + min_locus_dist:
-                continue
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
 
-            # only inspect mappable pixels
-            if mask[i, j]:
-                continue
+    def __enter__(self):
+        return self
 
-            # only inspect pixels if they have more than
-            # a minimum number of reads
-            w_corr = w
-            ll_sum = 0
-            while ll_sum < min_ll_reads and w_corr <= max_w:
-                ll_sum = RaoPeakCaller.ll_sum(m_uncorrected, i, j, w=w_corr, p=p)
-                if np.ma.is_masked(ll_sum):
-                    ll_sum = 0
-                w_corr += 1
-
-            if w_corr > max_w:
-                continue
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-            # calculate mappability and enrichment values
-            ll_mappable = 1 - RaoPeakCaller.e_ll_sum(mask, i, j, w, p) / RaoPeakCaller.e_ll_sum(m_ones, i, j, w, p)
-            if ll_mappable < min_mappable:
-                continue
-            e_ll = RaoPeakCaller.e_ll(m_original, i, j, m_expected, w=w_corr, p=p)
 
-            v_mappable = 1 - RaoPeakCaller.e_v_sum(mask, i, j, w, p) / RaoPeakCaller.e_v_sum(m_ones, i, j, w, p)
-            if v_mappable < min_mappable:
-                continue
-            e_v = RaoPeakCaller.e_v(m_original, i, j, m_expected, w=w_corr, p=p)
+def _attach_shared_arrays(specs):
+    """
+    Access arrays created by :class:`~_SharedArrays` from another process.
 
-            h_mappable = 1 - RaoPeakCaller.e_h_sum(mask, i, j, w, p) / RaoPeakCaller.e_h_sum(m_ones, i, j, w, p)
-            if h_mappable < min_mappable:
-                continue
-            e_h = RaoPeakCaller.e_h(m_original, i, j, m_expected, w=w_corr, p=p)
+    :return: tuple (shared memory, dict of name: array). Arrays must be
+             released before the shared memory is closed.
+    """
+    shm = shared_memory.SharedMemory(name=specs['name'])
+    arrays = {name: np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+              for name, (shape, dtype, offset) in specs['arrays'].items()}
+    return shm, arrays
 
-            d_mappable = 1 - RaoPeakCaller.e_d_sum(mask, i, j, w, p) / RaoPeakCaller.e_d_sum(m_ones, i, j, w, p)
-            if d_mappable < min_mappable:
-                continue
-            e_d = RaoPeakCaller.e_d(m_original, i, j, m_expected, w=w_corr, p=p)
 
-            # find chunks
-            cf = c_i[i] * c_j[j]
-            o_chunk = RaoPeakCaller.find_chunk(m_uncorrected[i, j])
-            e_ll_chunk = RaoPeakCaller.find_chunk(e_ll/cf)
-            e_h_chunk = RaoPeakCaller.find_chunk(e_h/cf)
-            e_v_chunk = RaoPeakCaller.find_chunk(e_v/cf)
-            e_d_chunk = RaoPeakCaller.find_chunk(e_d/cf)
+class _IntraChromosomalMatrix(object):
+    """
+    Lazily loaded, sparse intra-chromosomal matrix.
+
+    Slicing returns the corresponding part of the matrix in a
+    :class:`~fanc.hic.Hic` object as a sparse segment, i.e. a dict
+    with the local 'row' and 'col' indexes, 'data' and 'shape' of
+    all non-zero entries. Segments are assembled directly from the
+    edge table, so that neither the whole matrix nor dense segments
+    are built in the main process.
+    """
+
+    def __init__(self, hic, start, end, bias=None, valid=None):
+        self.hic = hic
+        self.row_start = start
+        self.col_start = start
+        self.shape = (end - start, end - start)
+        self.bias = hic.bias_vector() if bias is None else bias
+        self.valid = hic.mappable() if valid is None else valid
+        weight_field = hic._default_score_field
+        if weight_field is None or weight_field not in hic.field_names:
+            weight_field = 'weight'
+        self.weight_field = weight_field
+
+    def __getitem__(self, item):
+        row_slice, col_slice = item
+        row_start, row_end = self.row_start + row_slice.start, self.row_start + row_slice.stop
+        col_start, col_end = self.col_start + col_slice.start, self.col_start + col_slice.stop
+
+        edges = self.hic._edge_subset_arrays((row_start, row_end), (col_start, col_end),
+                                             fields=['source', 'sink', self.weight_field])
+        source = edges['source'].astype(np.int64)
+        sink = edges['sink'].astype(np.int64)
+        valid = np.logical_and(self.valid[source], self.valid[sink])
+        source, sink = source[valid], sink[valid]
+        # same normalisation as in RegionMatrixContainer.matrix
+        weight = edges[self.weight_field][valid] * (self.bias[source] * self.bias[sink])
+
+        # edges are stored once per pixel pair, add the mirrored pixels
+        # below the diagonal that fall into the segment
+        upper = np.logical_and.reduce([row_start <= source, source < row_end,
+                                       col_start <= sink, sink < col_end])
+        lower = np.logical_and.reduce([row_start <= sink, sink < row_end,
+                                       col_start <= source, source < col_end,
+                                       source != sink])
+        return {
+            'row': np.concatenate([source[upper], sink[lower]]) - row_start,
+            'col': np.concatenate([sink[upper], source[lower]]) - col_start,
+            'data': np.concatenate([weight[upper], weight[lower]]),
+            'shape': (row_end - row_start, col_end - col_start),
+        }
+
+
+class _InterChromosomalMatrix(_IntraChromosomalMatrix):
+    """
+    Lazily loaded, sparse inter-chromosomal matrix.
+
+    Rows correspond to the bins of the first, columns to the bins of
+    the second chromosome. Works like :class:`~_IntraChromosomalMatrix`,
+    but can additionally count the edges in each tile of the matrix
+    using :func:`~_InterChromosomalMatrix.tile_counts`.
+    """
+
+    def __init__(self, hic, start1, end1, start2, end2, bias=None, valid=None):
+        super(_InterChromosomalMatrix, self).__init__(hic, start1, end1, bias=bias, valid=valid)
+        self.col_start = start2
+        self.shape = (end1 - start1, end2 - start2)
+
+    def tile_counts(self, tile_size):
+        """
+        Count the valid edges in each tile of the matrix.
+
+        :param tile_size: Number of rows and columns of a tile
+        :return: :class:`~np.ndarray` with one entry per tile
+        """
+        row_range = (self.row_start, self.row_start + self.shape[0])
+        col_range = (self.col_start, self.col_start + self.shape[1])
+        edges = self.hic._edge_subset_arrays(row_range, col_range, fields=['source', 'sink'])
+        source = edges['source'].astype(np.int64)
+        sink = edges['sink'].astype(np.int64)
+        valid = np.logical_and(self.valid[source], self.valid[sink])
+        source, sink = source[valid], sink[valid]
+
+        # edges can be stored in either orientation
+        flip = np.logical_or(source < row_range[0], source >= row_range[1])
+        row = np.where(flip, sink, source) - row_range[0]
+        col = np.where(flip, source, sink) - col_range[0]
+        return _tile_counts(row, col, self.shape, tile_size)
+
+
+def _tile_counts(row, col, shape, tile_size):
+    """
+    Count matrix entries in each square tile of a matrix.
+
+    :param row: Row indexes of matrix entries
+    :param col: Column indexes of matrix entries
+    :param shape: Shape of the matrix
+    :param tile_size: Number of rows and columns of a tile
+    :return: :class:`~np.ndarray` with one entry per tile
+    """
+    n_row_tiles = -(-shape[0] // tile_size)
+    n_col_tiles = -(-shape[1] // tile_size)
+    tiles = np.asarray(row, dtype=np.int64) // tile_size * n_col_tiles + \
+        np.asarray(col, dtype=np.int64) // tile_size
+    counts = np.bincount(tiles, minlength=n_row_tiles * n_col_tiles)
+    return counts.reshape((n_row_tiles, n_col_tiles))
+
+
+def _dense_segment(segment):
+    """
+    Convert a (sparse) matrix segment to a dense :class:`~np.ndarray`.
+
+    :param segment: Dense matrix or a sparse segment dict as returned
+                    by :class:`~_IntraChromosomalMatrix`
+    """
+    if not isinstance(segment, dict):
+        return np.array(segment, dtype=np.float64)
+    m = np.zeros(tuple(segment['shape']), dtype=np.float64)
+    m[np.asarray(segment['row'], dtype=np.int64),
+      np.asarray(segment['col'], dtype=np.int64)] = segment['data']
+    return m
+
+
+def process_matrix_segment_intra(data, block_size=1048576):
+    """
+    Calculate peak information for the inspected pixels of a matrix segment.
+
+    msgpack-based interface of :func:`~_process_segment_intra`, used
+    for jobs submitted via gridmap.
+
+    :param data: msgpack-serialised list of arguments to
+                 :func:`~_process_segment_intra`
+    :param block_size: Approximate number of pixels processed at once
+    :return: msgpack-serialised list [results, zero_chunk_counts], where
+             results contains a tuple of peak information for each
+             non-zero pixel
+    """
+    args = msgpack.loads(data, strict_map_key=False)
+    results, zero_chunk_counts = _process_segment_intra(*args, block_size=block_size)
+    return msgpack.dumps([results.tolist(), zero_chunk_counts])
+
 
-            result = [o_i + ix_offset, o_j + ix_offset, float(m_original.data[i, j]), w_corr, p,
-                      int(m_uncorrected.data[i, j]),
-                      int(ll_sum), e_ll, e_v, e_h, e_d,
-                      o_chunk, e_ll_chunk, e_v_chunk, e_h_chunk, e_d_chunk,
-                      ll_mappable, v_mappable, h_mappable, d_mappable]
+def process_matrix_segment_inter(data, block_size=1048576):
+    """
+    Calculate peak information for the inspected pixels of an
+    inter-chromosomal matrix segment.
 
-            results.append(result)
-    return msgpack.dumps(results)
+    msgpack-based interface of :func:`~_process_segment_inter`, used
+    for jobs submitted via gridmap.
+
+    :param data: msgpack-serialised list of arguments to
+                 :func:`~_process_segment_inter`
+    :param block_size: Approximate number of pixels processed at once
+    :return: see :func:`~process_matrix_segment_intra`
+    """
+    args = msgpack.loads(data, strict_map_key=False)
+    results, zero_chunk_counts = _process_segment_inter(*args, block_size=block_size)
+    return msgpack.dumps([results.tolist(), zero_chunk_counts])
+
+
+def _process_matrix_segment_shared(process_segment, vector_specs, segment_specs, args):
+    """
+    Calculate peak information for a matrix segment in shared memory.
+
+    :param process_segment: :func:`~_process_segment_intra` or
+                            :func:`~_process_segment_inter`
+    :param vector_specs: :attr:`~_SharedArrays.specs` of the expected
+                         values 'e', and of the biases 'c_i', 'c_j' and
+                         mappability 'mappable_i', 'mappable_j' of the
+                         matrix rows and columns
+    :param segment_specs: :attr:`~_SharedArrays.specs` of a sparse ('row',
+                          'col', 'data') or dense ('matrix') segment
+    :param args: list [shape, ix_offset, i_range, i_inspect, j_range, j_inspect]
+                 followed by the remaining arguments to process_segment,
+                 where shape is the shape of a sparse segment
+    :return: see :func:`~_process_segment_intra`
+    """
+    vector_shm, vectors = _attach_shared_arrays(vector_specs)
+    segment_shm, segment_arrays = _attach_shared_arrays(segment_specs)
+    try:
+        shape, ix_offset, i_range, i_inspect, j_range, j_inspect = args[:6]
+        if shape is None:
+            segment = segment_arrays['matrix']
+        else:
+            segment = dict(segment_arrays, shape=shape)
+        return process_segment(segment, vectors['e'], ix_offset,
+                               i_range, i_inspect, vectors['mappable_i'][i_range[0]:i_range[1]],
+                               vectors['c_i'][i_range[0]:i_range[1]],
+                               j_range, j_inspect, vectors['mappable_j'][j_range[0]:j_range[1]],
+                               vectors['c_j'][j_range[0]:j_range[1]], *args[6:])
+    finally:
+        # views on the shared memory need to be released before closing it
+        segment = vectors = segment_arrays = None
+        vector_shm.close()
+        segment_shm.close()
+
+
+def _process_segment_intra(segment, e, ix_offset,
+                           i_range, i_inspect, mappable_i, c_i,
+                           j_range, j_inspect, mappable_j, c_j,
+                           w, p, min_locus_dist, min_ll_reads, min_mappable,
+                           max_w, max_distance, block_size=1048576):
+    """
+    Calculate peak information for the inspected pixels of a matrix segment.
+
+    The segment can be a dense matrix or a sparse segment as returned by
+    :class:`~_IntraChromosomalMatrix`. Pixels without contacts are not
+    reported individually, as they can never be peaks, but are still
+    needed for the observed value distribution in each lambda chunk.
+
+    :param segment: Dense or sparse matrix segment
+    :param e: Expected values of the chromosome by distance in bins
+    :param ix_offset: Region index of the first chromosome bin
+    :param i_range: (start, end) of segment rows in the chromosome matrix
+    :param i_inspect: (start, end) of inspected rows
+    :param mappable_i: Mappability of segment rows
+    :param c_i: Biases of segment rows
+    :param j_range: (start, end) of segment columns in the chromosome matrix
+    :param j_inspect: (start, end) of inspected columns
+    :param mappable_j: Mappability of segment columns
+    :param c_j: Biases of segment columns
+    :param block_size: Approximate number of pixels processed at once
+    :return: tuple (results, zero_chunk_counts), where results is a
+             structured array (:code:`_peak_result_dtype`) with peak
+             information for each non-zero pixel and zero_chunk_counts
+             is a dict <neighborhood>: {<chunk>: <number of zero pixels>}
+    """
+    e = np.array(e, dtype=np.float64)
+    row_ixs = np.arange(i_range[0], i_range[1])
+    col_ixs = np.arange(j_range[0], j_range[1])
+    m_expected = e[np.abs(col_ixs[None, :] - row_ixs[:, None])]
+    return _process_segment(segment, m_expected, (ix_offset, ix_offset),
+                            i_range, i_inspect, mappable_i, c_i,
+                            j_range, j_inspect, mappable_j, c_j,
+                            w, p, min_ll_reads, min_mappable, max_w,
+                            min_distance=p + min_locus_dist, max_distance=max_distance,
+                            block_size=block_size)
+
+
+def _process_segment_inter(segment, e, ix_offset,
+                           i_range, i_inspect, mappable_i, c_i,
+                           j_range, j_inspect, mappable_j, c_j,
+                           w, p, min_ll_reads, min_mappable, max_w, block_size=1048576):
+    """
+    Calculate peak information for the inspected pixels of an
+    inter-chromosomal matrix segment.
+
+    Works like :func:`~_process_segment_intra`, but uses a constant
+    expected value for all pixels and inspects all pixels in the segment,
+    as there is no diagonal in inter-chromosomal matrices.
+
+    :param segment: Dense or sparse matrix segment
+    :param e: Inter-chromosomal expected value
+    :param ix_offset: tuple with the region indexes of the first row
+                      and the first column bin of the matrix
+    :return: see :func:`~_process_segment_intra`
+    """
+    shape = (i_range[1] - i_range[0], j_range[1] - j_range[0])
+    m_expected = np.full(shape, e, dtype=np.float64)
+    return _process_segment(segment, m_expected, ix_offset,
+                            i_range, i_inspect, mappable_i, c_i,
+                            j_range, j_inspect, mappable_j, c_j,
+                            w, p, min_ll_reads, min_mappable, max_w,
+                            block_size=block_size)
+
+
+def _process_segment(segment, m_expected, ix_offset,
+                     i_range, i_inspect, mappable_i, c_i,
+                     j_range, j_inspect, mappable_j, c_j,
+                     w, p, min_ll_reads, min_mappable, max_w,
+                     min_distance=None, max_distance=None, block_size=1048576):
+    """
+    Calculate peak information for a matrix segment with the given expected values.
+
+    :param m_expected: Dense matrix of expected values of the segment
+    :param ix_offset: tuple with the region indexes of the first row
+                      and the first column bin of the matrix
+    :param min_distance: Minimum distance of inspected pixels above the diagonal
+    :param max_distance: Maximum distance of inspected pixels above the diagonal
+    :return: see :func:`~_process_segment_intra`
+    """
+    m_original = _dense_segment(segment)
+    c_i = np.array(c_i, dtype=np.float64)
+    c_j = np.array(c_j, dtype=np.float64)
+    # construct convenient matrices
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_uncorrected = np.rint(m_original/c_i[:, None]/c_j)
+
+    # mask above matrices by mappability
+    mask = np.zeros(m_original.shape, dtype=bool)
+    mask[np.logical_not(mappable_i)] = True
+    mask[:, np.logical_not(mappable_j)] = True
+
+    neighborhoods = _SegmentNeighborhoods(m_original, m_uncorrected, m_expected, mask)
+
+    # process blocks of rows to limit memory usage
+    n_cols = max(1, j_inspect[1] - j_inspect[0])
+    block_rows = max(1, block_size // n_cols)
+    results = [np.empty(0, dtype=_peak_result_dtype)]
+    zero_chunk_counts = {neighborhood: defaultdict(int) for neighborhood in ('ll', 'v', 'h', 'd')}
+    for block_start in range(i_inspect[0], i_inspect[1], block_rows):
+        block_end = min(i_inspect[1], block_start + block_rows)
+        o_i, o_j = np.meshgrid(np.arange(block_start, block_end),
+                               np.arange(j_inspect[0], j_inspect[1]), indexing='ij')
+        o_i, o_j = o_i.ravel(), o_j.ravel()
+        i, j = o_i - i_range[0], o_j - j_range[0]
+
+        # only inspect mappable pixels (at a certain distance above the diagonal)
+        keep = ~mask[i, j]
+        if min_distance is not None:
+            keep = np.logical_and(keep, o_j - o_i >= min_distance)
+        if max_distance is not None:
+            keep = np.logical_and(keep, o_j - o_i <= max_distance)
+        o_i, o_j, i, j = o_i[keep], o_j[keep], i[keep], j[keep]
+
+        # only inspect pixels if they have more than
+        # a minimum number of reads, extending w if necessary
+        w_corr = np.full(i.shape, w, dtype=np.int64)
+        ll_sum = np.zeros(i.shape, dtype=np.float64)
+        for w_current in range(w, max_w + 1):
+            extend = ll_sum < min_ll_reads
+            if not np.any(extend):
+                break
+            ll_sum[extend] = neighborhoods.ll_sum(i[extend], j[extend], w_current, p)
+            w_corr[extend] = w_current + 1
+
+        keep = w_corr <= max_w
+        o_i, o_j, i, j, w_corr, ll_sum = o_i[keep], o_j[keep], i[keep], j[keep], w_corr[keep], ll_sum[keep]
+
+        # calculate mappability and enrichment values
+        mappabilities = {}
+        enrichments = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for neighborhood in ('ll', 'v', 'h', 'd'):
+                mappabilities[neighborhood] = neighborhoods.mappability(neighborhood, i, j, w, p)
+            keep = np.logical_and.reduce([~(mappability < min_mappable)
+                                          for mappability in mappabilities.values()])
+            o_i, o_j, i, j, w_corr, ll_sum = o_i[keep], o_j[keep], i[keep], j[keep], w_corr[keep], ll_sum[keep]
+            for neighborhood in ('ll', 'v', 'h', 'd'):
+                mappabilities[neighborhood] = mappabilities[neighborhood][keep]
+                enrichments[neighborhood] = neighborhoods.enrichment(neighborhood, i, j, w_corr, p)
+
+            # find chunks
+            cf = c_i[i] * c_j[j]
+            o_chunk, valid = _find_chunks(m_uncorrected[i, j])
+            chunks = {}
+            for neighborhood in ('ll', 'v', 'h', 'd'):
+                chunks[neighborhood], valid_chunk = _find_chunks(enrichments[neighborhood] / cf)
+                valid = np.logical_and(valid, valid_chunk)
+
+        # pixels with undefined chunks are ignored in RaoPeakCaller._process_jobs
+        weight = m_original[i, j]
+        zero = np.logical_and(valid, weight == 0)
+        for neighborhood in ('ll', 'v', 'h', 'd'):
+            for chunk, count in zip(*np.unique(chunks[neighborhood][zero], return_counts=True)):
+                zero_chunk_counts[neighborhood][int(chunk)] += int(count)
+        valid = np.logical_and(valid, weight != 0)
+
+        columns = [o_i + ix_offset[0], o_j + ix_offset[1], weight, w_corr, p,
+                   m_uncorrected[i, j], ll_sum, enrichments['ll'], enrichments['v'],
+                   enrichments['h'], enrichments['d'],
+                   o_chunk, chunks['ll'], chunks['v'], chunks['h'], chunks['d'],
+                   mappabilities['ll'], mappabilities['v'], mappabilities['h'], mappabilities['d']]
+        block_results = np.empty(np.count_nonzero(valid), dtype=_peak_result_dtype)
+        for name, column in zip(_peak_result_dtype.names, columns):
+            block_results[name] = column[valid] if isinstance(column, np.ndarray) else column
+        results.append(block_results)
+    zero_chunk_counts = {neighborhood: dict(counts) for neighborhood, counts in zero_chunk_counts.items()}
+    return np.concatenate(results), zero_chunk_counts
 
 
 def overlap_peaks(peaks, max_distance=6000):
@@ -1461,12 +2497,6 @@ def overlap_peaks(peaks, max_distance=6000):
     # blob/cb5999cb1e8e430dd29d4114fb208aca4b8d35ac/src/juicebox/
     # tools/utils/juicer/hiccups/HiCCUPSUtils.java#L235
 
-    def key_func(p):
-        try:
-            return p[1].weight
-        except AttributeError:
-            return 1
-
     def hypotenuse(x, y):
         return math.sqrt(x*x + y*y)
 
@@ -1499,46 +2529,79 @@ def overlap_peaks(peaks, max_distance=6000):
     max_distance = max_distance/bin_size
     logger.info("Fetching and sorting peaks...")
 
-    all_peaks = list(sorted(((s, p) for s, pgen in viewitems(peaks) for p in pgen),
-                            key=key_func, reverse=True))
+    n_regions = len(peaks1.regions)
+    fields = ['x', 'y', 'weight'] + [attr for _, attr in summarize_attrs if attr != 'weight']
+    samples, peak_arrays = [], defaultdict(list)
+    for s, pinfo in viewitems(peaks):
+        arrays = pinfo._edge_subset_arrays((0, n_regions), (0, n_regions), fields=fields)
+        samples += [s] * len(arrays['x'])
+        for field in fields:
+            peak_arrays[field].append(arrays[field])
+    peak_arrays = {field: np.concatenate(arrays) for field, arrays in peak_arrays.items()}
+
+    # process peaks by decreasing weight
+    order = np.argsort(-peak_arrays['weight'], kind='stable')
+    samples = [samples[i] for i in order]
+    peak_arrays = {field: array[order] for field, array in peak_arrays.items()}
+    all_x, all_y = peak_arrays['x'], peak_arrays['y']
+    tree = cKDTree(np.column_stack([all_x, all_y]).astype(np.float64))
+    remaining = np.ones(len(samples), dtype=bool)
 
     logger.info("Done.")
     logger.info("Finding overlaps...")
     out_peaks = defaultdict(list)
-    total_n = len(all_peaks)
+    total_n = len(samples)
 
     with RareUpdateProgressBar(max_value=total_n, silent=config.hide_progressbars,
                                prefix="Overlap") as pb:
-        while len(all_peaks) > 0:
-            cur_p = all_peaks.pop(0)
-            cur_p_list = [cur_p]
-            cur_x = cur_p[1].x
-            cur_y = cur_p[1].y
+        n_processed = 0
+        for cur_ix in range(total_n):
+            if not remaining[cur_ix]:
+                continue
+            remaining[cur_ix] = False
+            cur_ixs = [cur_ix]
+            cur_x = all_x[cur_ix]
+            cur_y = all_y[cur_ix]
             cluster_radius = max_distance
-            for p in all_peaks:
-                if hypotenuse(cur_x - p[1].x, cur_y - p[1].y) <= cluster_radius:
-                    cur_p_list.append(p)
-                    cur_x = mean(_p.x for _s, _p in cur_p_list)
-                    cur_y = mean(_p.y for _s, _p in cur_p_list)
-                    r = max(hypotenuse(cur_x - _p.x, cur_y - _p.y) for _s, _p in cur_p_list)
-                    cluster_radius = max_distance + r
+
+            # peaks are checked in order of decreasing weight, so the next
+            # peak in a cluster is the first remaining peak after the last
+            # one added that lies within the current cluster radius
+            last_ix = cur_ix
+            while True:
+                candidates = tree.query_ball_point((cur_x, cur_y), cluster_radius * (1 + 1e-9) + 1e-9)
+                candidates = sorted(ix for ix in candidates if ix > last_ix and remaining[ix])
+                next_ix = None
+                for ix in candidates:
+                    if hypotenuse(cur_x - all_x[ix], cur_y - all_y[ix]) <= cluster_radius:
+                        next_ix = ix
+                        break
+                if next_ix is None:
+                    break
+
+                remaining[next_ix] = False
+                cur_ixs.append(next_ix)
+                last_ix = next_ix
+                cur_x = mean(all_x[ix] for ix in cur_ixs)
+                cur_y = mean(all_y[ix] for ix in cur_ixs)
+                r = max(hypotenuse(cur_x - all_x[ix], cur_y - all_y[ix]) for ix in cur_ixs)
+                cluster_radius = max_distance + r
 
             summed_attrs = {}
             for sum_func, attr in summarize_attrs:
-                summed_attrs[attr] = sum_func(getattr(p, attr) for s, p in cur_p_list)
+                summed_attrs[attr] = sum_func(peak_arrays[attr][ix] for ix in cur_ixs)
 
-            cons_p = Peak(
+            cons_p = dict(
                 x=cur_x,
                 y=cur_y,
-                radius=r if len(cur_p_list) > 1 else 0.,
+                radius=r if len(cur_ixs) > 1 else 0.,
                 source=math.floor(min(cur_x, cur_y)),
                 sink=math.floor(max(cur_x, cur_y)),
                 **summed_attrs
             )
-            out_peaks[frozenset(s for s, p in cur_p_list)].append(cons_p)
-            for p in cur_p_list[1:]:
-                all_peaks.remove(p)
-            pb.update(total_n - len(all_peaks))
+            out_peaks[frozenset(samples[ix] for ix in cur_ixs)].append(cons_p)
+            n_processed += len(cur_ixs)
+            pb.update(n_processed)
     logger.info("Done.")
     logger.info("Gathering overlapped peaks.")
     out_dict = {}
@@ -1546,7 +2609,8 @@ def overlap_peaks(peaks, max_distance=6000):
     for sample_set, p_list in viewitems(out_peaks):
         pi = PeakInfo()
         pi.add_regions(peaks1.regions(), preserve_attributes=False)
-        pi.add_edges(p_list)
+        pi._add_edge_arrays({field: np.array([p[field] for p in p_list]) for field in p_list[0].keys()})
+        pi.flush()
         out_dict[sample_set] = pi
         stat = OrderedDict((s, s in sample_set) for s in peaks.keys())
         stat["n"] = len(p_list)
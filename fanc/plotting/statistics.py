@@ -124,7 +124,7 @@ def ligation_bias_plot(pairs, ax=None, log=False, **kwargs):
 
 def restriction_site_distance_plot(pairs, ax=None, max_percentile=95,
                                    sample=100000, max_distance=None,
-                                   **kwargs):
+                                   random_seed=0, **kwargs):
     """
     Plot the distribution of read pair restriction site distances.
 
@@ -150,6 +150,7 @@ def restriction_site_distance_plot(pairs, ax=None, max_percentile=95,
                    sample of 100000 is shown.
     :param max_distance: If this is different from None, distances larger
                          than <max_distance> are ignored.
+    :param random_seed: Seed for drawing a reproducible sample of mate pairs
     :param kwargs: Keyword arguments passed to :code:`seaborn.distplot`
     :return: ax
     """
@@ -158,16 +159,9 @@ def restriction_site_distance_plot(pairs, ax=None, max_percentile=95,
 
     color = kwargs.pop('color', '#FBAFE4')
 
-    distances = []
-    for i, pair in enumerate(pairs.pairs(lazy=True)):
-        d = pair.left.re_distance() + pair.right.re_distance()
-
-        if max_distance is None or d <= max_distance:
-            distances.append(d)
-        if sample is not None and i >= sample:
-            break
-
-    distances = np.array(distances)
+    distances = pairs.restriction_site_distances(sample=sample, random_seed=random_seed)
+    if max_distance is not None:
+        distances = distances[distances <= max_distance]
     if max_percentile is not None:
         median_insert, high = np.nanpercentile(distances, [50, max_percentile])
         distances = distances[distances < high]
@@ -138,6 +138,10 @@ class TestMaskedTable:
             if test['b'] < self.cutoff:
                 return False
             return True
+
+    class ExampleArrayFilter(ExampleFilter):
+        def valid_rows(self, rows):
+            return rows['b'] >= self.cutoff
             
     def setup_method(self, method):
         f = create_or_open_pytables_file()
@@ -205,6 +209,14 @@ class TestMaskedTable:
                 assert row[self.table._mask_index_field] == i
                 i += 1
             
+    def test_filter_rows(self):
+        self.table._filter([TestMaskedTable.ExampleArrayFilter(cutoff=10)], _chunk_size=7)
+
+        assert len(self.table) == 40
+        for row in self.table._iter_visible_and_masked():
+            assert (row[self.table._mask_field] > 0) == (row['b'] < 10)
+        assert self.table[0][1] == 10
+
     def test_masked(self):
         assert self.filtered_table.masked_rows()[0][1] == 0
         assert self.filtered_table.masked_rows()[-1][1] == 24
@@ -3,7 +3,8 @@ import numpy as np
 from fanc.compatibility.cooler import to_cooler
 from genomic_regions import GenomicRegion
 from fanc.matrix import Edge, RegionPairsTable, RegionMatrixTable, RegionMatrix
-from fanc.hic import Hic, _get_overlap_map, _edge_overlap_split_rao, kr_balancing, ice_balancing
+from fanc.hic import Hic, _get_overlap_map, _edge_overlap_split_rao, kr_balancing, ice_balancing, \
+    _get_overlap_index_arrays, _edges_overlap_split_rao_arrays, _uncorrected_marginals
 from fanc.regions import Chromosome, Genome
 from fanc.pairs import ReadPairs, SamBamReadPairGenerator
 from fanc.tools.matrix import is_symmetric
@@ -394,6 +395,25 @@ class TestRegionMatrixTable:
             for j, col_region in enumerate(m.col_regions):
                 assert m[i, j] == max(row_region.ix, col_region.ix)
 
+    def test_edge_subset_arrays(self):
+        hic = load(os.path.join(test_dir, 'test_peaks', 'rao2014.chr11_77400000_78600000.hic'), mode='r')
+        rows = np.concatenate([edge_table.read() for _, edge_table in hic._iter_edge_tables()])
+        rows = rows[rows['_mask'] == 0]
+        source, sink = rows['source'], rows['sink']
+
+        # indexed queries on disjoint ranges used to miss most rows
+        for (row_start, row_end), (col_start, col_end) in [((0, 60), (60, 121)), ((60, 121), (0, 60)),
+                                                           ((10, 30), (50, 90)), ((20, 80), (40, 100)),
+                                                           ((0, 121), (0, 121))]:
+            arrays = hic._edge_subset_arrays((row_start, row_end), (col_start, col_end))
+            expected = np.logical_or(
+                (row_start <= source) & (source < row_end) & (col_start <= sink) & (sink < col_end),
+                (col_start <= source) & (source < col_end) & (row_start <= sink) & (sink < row_end)
+            )
+            assert sorted(zip(arrays['source'], arrays['sink'])) == \
+                sorted(zip(source[expected], sink[expected]))
+        hic.close()
+
 
 class TestHicBasic:
     def setup_method(self, method):
@@ -786,6 +806,42 @@ class TestHicBasic:
             weight_sum += new_edge[2]
         assert weight_sum == original_edge[2]
 
+    def test_overlap_index_arrays(self):
+        old_regions = list(self.hic_cerevisiae.regions(lazy=False))
+        for bin_size in [500, 5000, 20000]:
+            binned = self.hic_cerevisiae.bin(bin_size)
+            new_regions = list(binned.regions(lazy=False))
+            binned.close()
+            overlap_map = _get_overlap_map(old_regions, new_regions)
+            first_ix, last_ix = _get_overlap_index_arrays(old_regions, new_regions)
+            for i, overlaps in overlap_map.items():
+                if len(overlaps) == 0:
+                    assert first_ix[i] == -1 and last_ix[i] == -1
+                else:
+                    assert first_ix[i] == overlaps[0][0]
+                    assert last_ix[i] == overlaps[-1][0]
+
+    def test_edge_splitting_rao_arrays(self):
+        #     0         1         2         3
+        # ---------|---------|---------|---------| old
+        # ----|----|----|----|---------|---|--|--| new
+        #  0    1    2    3       4      5  6  7
+        first_ix = np.array([0, 2, 4, 5])
+        last_ix = np.array([1, 3, 4, 7])
+
+        sources, sinks, weights = _edges_overlap_split_rao_arrays([0, 0, 0, 2, 0], [1, 0, 2, 2, 3],
+                                                                  [12., 12., 9., 9., 9.],
+                                                                  first_ix, last_ix)
+        assert len(sources) == len(set(zip(sources, sinks)))
+        assert sum(weights) == 51
+        assert all(sources <= sinks)
+        for source, sink, weight in zip(sources, sinks, weights):
+            assert weight == int(weight)
+            if (source, sink) == (4, 4):
+                assert weight == 9
+            if (source, sink) in {(0, 0), (1, 1)}:
+                assert weight == 4
+
     def test_bin(self):
         original_reads = 0
         for edge in self.hic_cerevisiae.edges():
@@ -812,6 +868,24 @@ class TestHicBasic:
         for bin_size in bin_sizes:
             assert_binning(bin_size)
 
+    def test_bin_pyramid(self, tmpdir):
+        original_reads = sum(edge.weight for edge in self.hic_cerevisiae.edges())
+
+        prefix = os.path.join(str(tmpdir), 'cerevisiae')
+        binned = self.hic_cerevisiae.bin_pyramid([20000, 5000, 10000, 15000, 7500], file_prefix=prefix)
+        assert sorted(binned.keys()) == [5000, 7500, 10000, 15000, 20000]
+        file_names = {5000: '5kb', 7500: '7.5kb', 10000: '10kb', 15000: '15kb', 20000: '20kb'}
+        for bin_size, hic in binned.items():
+            assert hic.bin_size == bin_size
+            assert hic.file.filename == prefix + '_{}.hic'.format(file_names[bin_size])
+            assert sum(edge.weight for edge in hic.edges()) == original_reads
+
+            edge_keys = set()
+            for edge in hic.edges():
+                assert (edge.source, edge.sink) not in edge_keys
+                edge_keys.add((edge.source, edge.sink))
+            hic.close()
+
     def test_from_hic_sample(self, tmpdir):
         dest_file = os.path.join(str(tmpdir), "hic.h5")
         hic = self.hic_class(file_name=dest_file, mode='w')
@@ -991,6 +1065,10 @@ class TestHicBasic:
                 else:
                     assert m[i, j] != 0
 
+    def test_uncorrected_marginals(self):
+        marginals = self.hic_cerevisiae.marginals(norm=False, masked=False)
+        assert np.allclose(_uncorrected_marginals(self.hic_cerevisiae), marginals)
+
     def test_to_cooler(self, tmpdir):
         cooler = pytest.importorskip("cooler")
         out = str(tmpdir.join("test_to_cooler.cool"))
@@ -3,7 +3,8 @@ import pytest
 from fanc.pairs import SamBamReadPairGenerator, ReadPairs, UnmappedFilter, FragmentReadPair, \
     FragmentRead, InwardPairsFilter, OutwardPairsFilter, ContaminantFilter, QualityFilter, \
     BwaMemQualityFilter, ReDistanceFilter, SelfLigationFilter, LazyFragment, LazyFragmentRead, \
-    PCRDuplicateFilter
+    PCRDuplicateFilter, MinimalRead, FourDNucleomePairGenerator, ReadPairGenerator, TxtReadPairGenerator, \
+    _assign_fragments, _fragment_info_pair, _pcr_duplicates
 from genomic_regions import GenomicRegion
 from fanc.regions import Genome, Chromosome
 from fanc.general import Mask
@@ -97,6 +98,117 @@ class TestReadPairs:
     def test_len(self):
         assert len(self.pairs) == 44
 
+    def test_assign_fragments(self):
+        chromosome = self.pairs.regions[0].chromosome
+        fragment_infos = self.pairs._fragment_info_arrays()
+
+        found, infos = _assign_fragments(fragment_infos, [chromosome, chromosome, 'foo', chromosome],
+                                         [999, 1000, 10, 10000000])
+        assert list(found) == [True, True, False, False]
+        assert list(infos[:, 0]) == [0, 0, 1, 1000]
+        assert list(infos[:, 1]) == [1, 0, 1001, 2000]
+
+        found, infos = _assign_fragments(fragment_infos, [chromosome, chromosome], [1000, 1001], side='left')
+        assert list(found) == [True, True]
+        assert list(infos[0]) == [0, 1]
+
+    def test_decompression_threads(self, tmpdir):
+        import pysam
+        bam_files = []
+        for i in (1, 2):
+            sam_file = os.path.join(self.dir, "test_pairs", "lambda_reads{}_sort.sam".format(i))
+            bam_file = str(tmpdir) + "/lambda_reads{}_sort.bam".format(i)
+            with pysam.AlignmentFile(sam_file) as sam:
+                with pysam.AlignmentFile(bam_file, 'wb', template=sam) as bam:
+                    for read in sam:
+                        bam.write(read)
+            bam_files.append(bam_file)
+
+        pair_generator = SamBamReadPairGenerator(*bam_files, decompression_threads=2)
+        positions = [(read1.pos, read2.pos) for read1, read2 in pair_generator]
+        assert len(positions) == 44
+        assert positions[0] == (self.pairs[0].left.position, self.pairs[0].right.position) or \
+            positions[0] == (self.pairs[0].right.position, self.pairs[0].left.position)
+
+    def test_builtin_sort(self, tmpdir):
+        import pysam
+        import random
+        from fanc.tools.files import natural_sorted_reads, sort_natural_sam
+
+        random.seed(0)
+        bam_files = []
+        for i in (1, 2):
+            sam_file = os.path.join(self.dir, "test_pairs", "lambda_reads{}_sort.sam".format(i))
+            bam_file = str(tmpdir) + "/lambda_reads{}_shuffled.bam".format(i)
+            with pysam.AlignmentFile(sam_file) as sam:
+                reads = list(sam)
+                qnames = [read.query_name for read in reads]
+                random.shuffle(reads)
+                with pysam.AlignmentFile(bam_file, 'wb', template=sam) as bam:
+                    for read in reads:
+                        bam.write(read)
+            bam_files.append(bam_file)
+
+            sorted_qnames = [read.query_name for read in natural_sorted_reads(bam_file, chunk_size=10,
+                                                                              threads=2)]
+            assert sorted_qnames == qnames
+
+            # multiple merge passes
+            sorted_qnames = [read.query_name for read in natural_sorted_reads(bam_file, chunk_size=2,
+                                                                              threads=2, max_open_files=3)]
+            assert sorted_qnames == qnames
+
+            sorted_file = sort_natural_sam(bam_file, str(tmpdir) + "/lambda_reads{}_sort.bam".format(i),
+                                           builtin=True, chunk_size=10)
+            with pysam.AlignmentFile(sorted_file) as sam:
+                assert [read.query_name for read in sam] == qnames
+
+        pairs = ReadPairs()
+        regions = self.genome.get_regions(1000)
+        pairs.add_regions(regions.regions)
+        regions.close()
+        pairs.add_read_pairs_from_sam(*bam_files, threads=2, sort=True)
+        assert len(pairs) == len(self.pairs)
+        pairs.close()
+
+    def test_split_sam_pairs_reference_order(self, tmpdir):
+        import pysam
+        from fanc.tools.files import split_sam_pairs
+
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        bam2_file = str(tmpdir) + "/lambda_reads2_decoy.bam"
+        with pysam.AlignmentFile(sam2_file) as sam:
+            header = sam.header.to_dict()
+            header['SQ'] = [{'SN': 'decoy', 'LN': 1000}] + header['SQ']
+            header = pysam.AlignmentHeader.from_dict(header)
+            with pysam.AlignmentFile(bam2_file, 'wb', header=header) as bam:
+                for read in sam:
+                    bam.write(pysam.AlignedSegment.fromstring(read.to_string(), header))
+
+        with pysam.AlignmentFile(sam1_file) as sam:
+            reference = sam.references[0]
+            header = sam.header.to_dict()
+            header['SQ'] = header['SQ'] + [{'SN': 'decoy', 'LN': 1000}]
+            bam1_file = str(tmpdir) + "/lambda_reads1_decoy.bam"
+            with pysam.AlignmentFile(bam1_file, 'wb', header=pysam.AlignmentHeader.from_dict(header)) as bam:
+                for read in sam:
+                    bam.write(pysam.AlignedSegment.fromstring(read.to_string(), bam.header))
+
+        chunks = list(split_sam_pairs(bam1_file, bam2_file, str(tmpdir) + "/chunk"))
+        assert sum(total for _, total, _ in chunks) == 44
+        n_reads = 0
+        for chunk_file, _, _ in chunks:
+            with pysam.AlignmentFile(chunk_file) as sam:
+                for read in sam:
+                    if not read.is_unmapped:
+                        assert read.reference_name == reference
+                        n_reads += 1
+        assert n_reads > 0
+
+        with pytest.raises(ValueError):
+            list(split_sam_pairs(sam1_file, bam2_file, str(tmpdir) + "/chunk_missing"))
+
     def test_auto_mindist(self):
         ad = self.pairs_class._auto_dist
         np.random.seed(101)
@@ -144,6 +256,148 @@ class TestReadPairs:
         self.pairs.filter(self_ligation_filter)
         assert len(self.pairs) == 7
 
+    def test_compact(self):
+        def pair_tuples(pairs):
+            return [(pair.ix, pair.left.fragment.chromosome, pair.left.fragment.start, pair.left.fragment.end,
+                     pair.left.fragment.ix, pair.left.position, pair.left.strand,
+                     pair.right.fragment.chromosome, pair.right.fragment.start, pair.right.fragment.end,
+                     pair.right.fragment.ix, pair.right.position, pair.right.strand)
+                    for pair in pairs]
+
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        compact_pairs = self.pairs_class(compact=True)
+        compact_pairs.add_regions(self.pairs.regions(lazy=False))
+        compact_pairs.add_read_pairs(SamBamReadPairGenerator(sam1_file, sam2_file))
+        assert compact_pairs._compact
+        assert not self.pairs._compact
+        assert 'left_fragment_start' not in compact_pairs.field_names
+
+        assert pair_tuples(compact_pairs.pairs(lazy=True)) == pair_tuples(self.pairs.pairs(lazy=True))
+        assert pair_tuples(compact_pairs.pairs()) == pair_tuples(self.pairs.pairs())
+        assert pair_tuples([compact_pairs[11]]) == pair_tuples([self.pairs[11]])
+
+        mask = compact_pairs.add_mask_description('self_ligated', 'Mask read pairs that '
+                                                                  'represent self-ligated fragments')
+        compact_pairs.filter(SelfLigationFilter(mask=mask))
+        assert len(compact_pairs) == 7
+        compact_pairs.close()
+
+        self.pairs.filter_self_ligated()
+        converted_pairs = self.pairs.to_compact()
+        assert converted_pairs._compact
+        assert len(converted_pairs) == 7
+        assert converted_pairs.filter_statistics() == self.pairs.filter_statistics()
+        assert pair_tuples(converted_pairs.pairs()) == pair_tuples(self.pairs.pairs())
+        converted_pairs.close()
+
+        chunked_pairs = self.pairs.to_compact(chunk_size=3)
+        assert chunked_pairs.filter_statistics() == self.pairs.filter_statistics()
+        assert pair_tuples(chunked_pairs.pairs()) == pair_tuples(self.pairs.pairs())
+        chunked_pairs.close()
+
+    def test_import_filters(self):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+
+        for drop_filtered in (False, True):
+            pairs = self.pairs_class()
+            pairs.add_regions(self.pairs.regions(lazy=False))
+            self_ligation_filter = SelfLigationFilter(mask=Mask(name='self_ligated'))
+            pairs.add_read_pairs(SamBamReadPairGenerator(sam1_file, sam2_file),
+                                 pair_filters=[self_ligation_filter], drop_filtered=drop_filtered)
+            assert len(pairs) == 7
+
+            statistics = pairs.filter_statistics()
+            assert statistics['self_ligated'] == 37
+            assert statistics['total'] == 44
+            assert sum(t._original_len() for _, t in pairs._iter_edge_tables()) == (7 if drop_filtered else 44)
+            pairs.close()
+
+        pairs = self.pairs_class()
+        pairs.add_regions(self.pairs.regions(lazy=False))
+        with pytest.raises(ValueError):
+            pairs.add_read_pairs(SamBamReadPairGenerator(sam1_file, sam2_file),
+                                 pair_filters=[PCRDuplicateFilter(self.pairs)])
+        pairs.close()
+
+    def test_resume_loading(self, tmpdir):
+        def pair_tuples(pairs):
+            return [(pair.ix, pair.left.fragment.ix, pair.left.position, pair.left.strand,
+                     pair.right.fragment.ix, pair.right.position, pair.right.strand)
+                    for pair in pairs.pairs()]
+
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        pairs_file = str(tmpdir) + "/resume.pairs"
+
+        pairs = self.pairs_class(pairs_file, mode='w')
+        pairs.add_regions(self.pairs.regions(lazy=False))
+        pairs.add_read_pairs_from_sam(sam1_file, sam2_file, batch_size=5, resume=True)
+        expected_pairs = pair_tuples(pairs)
+        expected_stats = pairs.meta.read_filter_stats
+        checkpoint = pairs.file.get_node('/sam_load_checkpoint')
+        assert checkpoint._v_attrs.complete
+        chunks = checkpoint.chunks.read()
+        assert len(chunks) > 3
+
+        # simulate an interruption while loading the fourth chunk:
+        # its pairs are already partially written, but not recorded
+        stats = checkpoint.stats.read()
+        for table, rows in ((checkpoint.chunks, chunks), (checkpoint.stats, stats)):
+            table.truncate(0)
+            table.append(rows[rows['chunk'] < 3])
+        checkpoint._v_attrs.pair_count = int(np.sum(chunks['loaded'][chunks['chunk'] < 3]))
+        checkpoint._v_attrs.complete = False
+        pairs.meta['read_filter_stats'] = {}
+        pairs.close()
+
+        pairs = self.pairs_class(pairs_file, mode='a')
+        with pytest.raises(ValueError):
+            pairs.add_read_pairs_from_sam(sam1_file, sam2_file, batch_size=10, resume=True)
+        pairs.add_read_pairs_from_sam(sam1_file, sam2_file, batch_size=5, resume=True)
+        assert pair_tuples(pairs) == expected_pairs
+        assert pairs.meta.read_filter_stats == expected_stats
+        pairs.close()
+
+        # checkpoints are only recorded when resuming is requested
+        pairs = self.pairs_class()
+        pairs.add_regions(self.pairs.regions(lazy=False))
+        pairs.add_read_pairs_from_sam(sam1_file, sam2_file, batch_size=5)
+        assert not pairs._has_sam_checkpoint()
+        assert pair_tuples(pairs) == expected_pairs
+        assert pairs.meta.read_filter_stats == expected_stats
+
+        # checkpoints of deeply sequenced samples exceed the size limit of HDF5 attributes
+        pairs._init_sam_checkpoint(['a', 'b', 5, False])
+        for chunk_id in range(2000):
+            pairs._save_sam_checkpoint_chunk(chunk_id, chunk_id * 10, 10, 9,
+                                             {'total': 10, 'unmappable': 1}, {})
+        chunks, stats, pair_filter_stats, complete = pairs._sam_checkpoint(['a', 'b', 5, False])
+        assert len(chunks) == 2000 and chunks[1999] == (19990, 10)
+        assert stats == {'total': 20000, 'unmappable': 2000}
+        assert not complete
+        pairs.close()
+
+    def test_filter_pcr_duplicates(self):
+        chromosome = self.pairs.regions[0].chromosome
+        pairs = self.pairs_class()
+        pairs.add_regions(self.pairs.regions(lazy=False))
+        pairs.add_read_pairs([
+            (MinimalRead(chromosome, 100, '+'), MinimalRead(chromosome, 5000, '-')),
+            (MinimalRead(chromosome, 8000, '+'), MinimalRead(chromosome, 102, '-')),
+            (MinimalRead(chromosome, 101, '+'), MinimalRead(chromosome, 5001, '-')),
+            (MinimalRead(chromosome, 100, '+'), MinimalRead(chromosome, 5002, '-')),
+        ])
+
+        pcr_filter = PCRDuplicateFilter(pairs, threshold=2, mask='PCR duplicates')
+        assert pcr_filter.duplicates_set == {2, 3}
+        assert dict(pcr_filter.duplicate_stats) == {3: 1}
+
+        pairs.filter(pcr_filter)
+        assert len(pairs) == 2
+        pairs.close()
+
     def test_get_ligation_structure_biases(self):
         sam_file1 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.1_sorted.sam")
         sam_file2 = os.path.join(self.dir, "test_matrix", "yeast.sample.chrI.2_sorted.sam")
@@ -164,7 +418,148 @@ class TestReadPairs:
         assert i.tolist() == [2.8756218905472637, 0.8059701492537313, 0.6368159203980099]
         assert o.tolist() == [0.2537313432835821, 0.24875621890547264, 0.46766169154228854]
         assert b.tolist() == [830, 413, 423]
+
+        sample1 = pairs.get_ligation_structure_biases(sampling=20, sample=3000, random_seed=1)
+        sample2 = pairs.get_ligation_structure_biases(sampling=20, sample=3000, random_seed=1)
+        assert len(sample1[0]) > 0
+        for v1, v2 in zip(sample1, sample2):
+            assert np.array_equal(v1, v2)
+
+        distances = [pair.left.re_distance() + pair.right.re_distance() for pair in pairs.pairs()]
+        assert sorted(pairs.restriction_site_distances().tolist()) == sorted(distances)
+        sample_distances = pairs.restriction_site_distances(sample=100)
+        assert len(sample_distances) == 100
+        assert np.array_equal(sample_distances, pairs.restriction_site_distances(sample=100))
+        pairs.close()
+
+    def test_valid_fragment_infos(self):
+        fragment_infos = np.array([
+            [row['left_read_position'], row['left_read_strand'], row['source'],
+             row['left_fragment_chromosome'], row['left_fragment_start'], row['left_fragment_end'],
+             row['right_read_position'], row['right_read_strand'], row['sink'],
+             row['right_fragment_chromosome'], row['right_fragment_start'], row['right_fragment_end']]
+            for _, edge_table in self.pairs._iter_edge_tables() for row in edge_table
+        ], dtype=np.int64)
+
+        for f in (InwardPairsFilter(minimum_distance=100), OutwardPairsFilter(minimum_distance=100),
+                  ReDistanceFilter(maximum_distance=300), SelfLigationFilter()):
+            expected = [f.valid_pair(_fragment_info_pair(info, self.pairs._ix_to_chromosome))
+                        for info in fragment_infos]
+            assert f.valid_fragment_infos(fragment_infos).tolist() == expected
+
+    def test_pcr_duplicates(self):
+        duplicates, multiplicities = _pcr_duplicates(np.array([0, 0, 0, 0, 1]), np.array([0, 0, 1, 0, 1]),
+                                     np.array([100, 102, 100, 200, 100]),
+                                     np.array([500, 501, 500, 500, 500]), threshold=2)
+        assert duplicates.tolist() == [False, True, False, False, False]
+        assert multiplicities.tolist() == [2]
+
+    def test_pcr_duplicates_group_start(self):
+        # duplicates are compared to the first pair of their group,
+        # not chained through the preceding pair
+        duplicates, multiplicities = _pcr_duplicates(np.zeros(4, dtype=int), np.zeros(4, dtype=int),
+                                                     np.array([106, 102, 104, 100]),
+                                                     np.array([500, 500, 500, 500]), threshold=2)
+        assert duplicates.tolist() == [True, True, False, False]
+        assert multiplicities.tolist() == [2, 2]
+
+    def test_generator_to_hic(self):
+        sam1_file = os.path.join(self.dir, "test_pairs", "lambda_reads1_sort.sam")
+        sam2_file = os.path.join(self.dir, "test_pairs", "lambda_reads2_sort.sam")
+        regions = self.genome.get_regions(1000)
+        pair_generator = SamBamReadPairGenerator(sam1_file, sam2_file)
+        hics = pair_generator.to_hic([5000, 10000], regions,
+                                     filters=[SelfLigationFilter(mask='self-ligations')])
+        regions.close()
+
+        # 1kb fragments lie completely within 5kb and 10kb bins
+        self.pairs.filter_self_ligated()
+        fragment_hic = self.pairs.to_hic()
+        fragment_bins = np.array([region.start // 1000 for region in fragment_hic.regions])
+        for bin_size, hic in hics.items():
+            m = hic.matrix()
+            expected = np.zeros(m.shape)
+            for edge in fragment_hic.edges(norm=False):
+                i = min(fragment_bins[edge.source] * 1000 // bin_size, m.shape[0] - 1)
+                j = min(fragment_bins[edge.sink] * 1000 // bin_size, m.shape[0] - 1)
+                expected[i, j] += edge.weight
+                if i != j:
+                    expected[j, i] += edge.weight
+            assert np.array_equal(np.asarray(m), expected)
+            assert hic.meta.read_filter_stats['self-ligations'] == 37
+            assert hic.meta.read_filter_stats['valid'] == 7
+            hic.close()
+        fragment_hic.close()
+
+    def test_generator_to_hic_bin_boundaries(self, tmpdir):
+        chromosome = self.pairs.regions[0].chromosome
+        pairs_file = str(tmpdir.join('boundaries.txt'))
+        with open(pairs_file, 'w') as f:
+            for position1, position2 in [(0, 999), (999, 1000), (1000, 4999), (4999, 5000),
+                                         (5000, 10000), (9999, 20000), (1, 20001)]:
+                f.write("{}\t{}\t+\t{}\t{}\t-\n".format(chromosome, position1, chromosome, position2))
+
+        regions = self.genome.get_regions(1000)
+        hic = TxtReadPairGenerator(pairs_file, chr1_field=0, pos1_field=1, strand1_field=2,
+                                   chr2_field=3, pos2_field=4, strand2_field=5).to_hic(5000, regions)
+        pairs = self.pairs_class()
+        pairs.add_regions(regions.regions(lazy=False))
+        pairs.add_read_pairs(TxtReadPairGenerator(pairs_file, chr1_field=0, pos1_field=1, strand1_field=2,
+                                                  chr2_field=3, pos2_field=4, strand2_field=5))
+        regions.close()
+
+        # bins must agree with the restriction fragments of 0-based read positions
+        fragment_hic = pairs.to_hic()
+        expected = np.zeros(hic.matrix().shape)
+        for edge in fragment_hic.edges(norm=False):
+            i = fragment_hic.regions[edge.source].start // 5000
+            j = fragment_hic.regions[edge.sink].start // 5000
+            expected[i, j] += edge.weight
+            if i != j:
+                expected[j, i] += edge.weight
+        assert np.array_equal(np.asarray(hic.matrix()), expected)
+        assert expected[0, 1] == 1 and expected[1, 2] == 1
+        fragment_hic.close()
+        pairs.close()
+        hic.close()
+
+    def test_generator_to_hic_pcr_duplicates(self, tmpdir):
+        chromosome = self.pairs.regions[0].chromosome
+        pairs_file = str(tmpdir.join('duplicates.txt'))
+        with open(pairs_file, 'w') as f:
+            for position1, position2 in [(100, 5000), (101, 5001), (102, 5002), (3000, 8000),
+                                         (3003, 8000), (7000, 20000), (7002, 20002), (7004, 20004),
+                                         (12000, 30000), (12000, 30000)]:
+                f.write("{}\t{}\t+\t{}\t{}\t-\n".format(chromosome, position1, chromosome, position2))
+
+        def _generator():
+            return TxtReadPairGenerator(pairs_file, chr1_field=0, pos1_field=1, strand1_field=2,
+                                        chr2_field=3, pos2_field=4, strand2_field=5)
+
+        regions = self.genome.get_regions(1000)
+        hic = _generator().to_hic(5000, regions, pcr_duplicate_threshold=2, tmpdir=str(tmpdir))
+        pairs = self.pairs_class()
+        pairs.add_regions(regions.regions(lazy=False))
+        pairs.add_read_pairs(_generator())
+        regions.close()
+        pairs.filter_pcr_duplicates(threshold=2)
+
+        fragment_hic = pairs.to_hic()
+        expected = np.zeros(hic.matrix().shape)
+        for edge in fragment_hic.edges(norm=False):
+            i = fragment_hic.regions[edge.source].start // 5000
+            j = fragment_hic.regions[edge.sink].start // 5000
+            expected[i, j] += edge.weight
+            if i != j:
+                expected[j, i] += edge.weight
+        assert np.array_equal(np.asarray(hic.matrix()), expected)
+        assert hic.meta.read_filter_stats['PCR duplicates'] == 4
+        assert hic.meta.read_filter_stats['valid'] == 6
+        fragment_hic.close()
         pairs.close()
+        hic.close()
+        # temporary files are removed
+        assert os.listdir(str(tmpdir)) == ['duplicates.txt']
 
     def test_re_dist(self):
         read1 = FragmentRead(GenomicRegion(chromosome='chr1', start=1, end=1000), position=200, strand=-1)
@@ -330,6 +725,79 @@ class TestFragmentReadPair:
         assert not pair.is_same_pair()
 
 
+class TestTxtReadPairGenerator:
+    def test_batches(self, tmpdir):
+        import gzip
+        file_name = str(tmpdir) + "/test.pairs.gz"
+        with gzip.open(file_name, 'wt') as o:
+            o.write("## pairs format v1.0\n")
+            o.write("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n")
+            o.write("read1#0/1\tchr1\t100\tchr2\t200\t+\t-\n")
+            o.write("read2\tchr1\t300\tchr1\t400\t-\t+\n")
+            o.write("read3\tchr2\t500\tchr1\t600\t+\t+\n")
+
+        generator = FourDNucleomePairGenerator(file_name)
+        expected = list(ReadPairGenerator.batches(generator, batch_size=2))
+        batches = list(generator.batches(batch_size=2))
+        assert len(batches) == len(expected) == 2
+        for batch, expected_batch in zip(batches, expected):
+            for column, expected_column in zip(batch, expected_batch):
+                assert list(column) == list(expected_column) or \
+                    list(np.array(column) & 16) == list(np.array(expected_column) & 16)
+        assert list(batches[0][2]) == [0, 16]
+        assert list(batches[0][5]) == [16, 0]
+        assert generator.stats()['valid'] == 3
+
+    def test_bgzf_batches(self, tmpdir):
+        import pysam
+        import zlib
+        import struct
+
+        text_file = str(tmpdir) + "/test.pairs"
+        rs = np.random.RandomState(0)
+        with open(text_file, 'w') as o:
+            o.write("## pairs format v1.0\n")
+            o.write("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2\n")
+            for i in range(20000):
+                o.write("read{}\tchr{}\t{}\tchr{}\t{}\t{}\t{}\n".format(
+                    i, rs.randint(1, 4), rs.randint(0, 100000), rs.randint(1, 4), rs.randint(0, 100000),
+                    '+' if rs.rand() < 0.5 else '-', '+' if rs.rand() < 0.5 else '-'))
+        file_name = text_file + '.gz'
+        pysam.tabix_compress(text_file, file_name)
+
+        def _columns(generator):
+            batches = list(generator.batches(batch_size=3000))
+            return [np.concatenate([batch[i] for batch in batches]).tolist() for i in range(6)]
+
+        expected = _columns(FourDNucleomePairGenerator(file_name))
+        assert len(expected[0]) == 20000
+
+        generator = FourDNucleomePairGenerator(file_name, threads=2)
+        generator._bgzf_range_size = 20000
+        assert _columns(generator) == expected
+        assert generator.stats()['valid'] == 20000
+
+        # block offsets from a .gzi index
+        offsets = []
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        offset, uncompressed = 0, 0
+        while offset < len(data):
+            decompressor = zlib.decompressobj(31)
+            uncompressed += len(decompressor.decompress(data[offset:]))
+            offset = len(data) - len(decompressor.unused_data)
+            if offset < len(data):
+                offsets.append((offset, uncompressed))
+        with open(file_name + '.gzi', 'wb') as f:
+            f.write(struct.pack('<Q', len(offsets)))
+            for compressed_offset, uncompressed_offset in offsets:
+                f.write(struct.pack('<QQ', compressed_offset, uncompressed_offset))
+        assert len(offsets) > 5
+        generator = FourDNucleomePairGenerator(file_name, threads=3)
+        generator._bgzf_range_size = 1
+        assert _columns(generator) == expected
+
+
 class TestFileOpsFragmentMappedReadPairs:
     def test_tmp_with(self, tmpdir):
         filename = str(tmpdir) + "/test.file"
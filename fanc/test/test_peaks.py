@@ -1,16 +1,42 @@
 from __future__ import division
 import fanc
-from fanc.peaks import RaoPeakCaller, RaoPeakInfo
+from fanc.peaks import RaoPeakCaller, RaoPeakInfo, process_matrix_segment_intra, _find_chunks, \
+    ObservedPeakFilter, DistancePeakFilter, FdrPeakFilter, MappabilityPeakFilter, \
+    EnrichmentPeakFilter, RaoPeakFilter, RaoMergedPeakFilter, FdrSumFilter, \
+    _SharedArrays, _process_matrix_segment_shared, _process_segment_intra
 from fanc.hic import Hic
-from fanc.matrix import RegionMatrix
+from fanc.matrix import RegionMatrix, Edge
 from genomic_regions import GenomicRegion
 from fanc.tools.general import pairwise
 import numpy as np
 import math
+import msgpack
 import pickle
+import pytest
+import tables
 import os.path
 
 
+def _two_chromosome_hic():
+    np.random.seed(1)
+    regions = [GenomicRegion(chromosome='chr1', start=i * 10000 + 1, end=(i + 1) * 10000, ix=i)
+               for i in range(40)] + \
+              [GenomicRegion(chromosome='chr2', start=i * 10000 + 1, end=(i + 1) * 10000, ix=40 + i)
+               for i in range(30)]
+    m = np.zeros((70, 70))
+    m[:40, :40] = np.random.poisson(50 / (1 + np.abs(np.subtract.outer(np.arange(40), np.arange(40)))))
+    m[40:, 40:] = np.random.poisson(50 / (1 + np.abs(np.subtract.outer(np.arange(30), np.arange(30)))))
+    m[:40, 40:] = np.random.poisson(1.0, (40, 30))
+    m[:15, 40:55] = 0
+    m[30, 65] = 60
+    m = np.triu(m)
+
+    hic = Hic()
+    hic.add_regions(regions)
+    hic.add_edges([Edge(source=i, sink=j, weight=m[i, j]) for i, j in zip(*np.nonzero(m))])
+    return hic, m
+
+
 class TestRaoPeakCaller:
     def setup_method(self,  method):
         l = [
@@ -111,6 +137,90 @@ class TestRaoPeakCaller:
         assert RaoPeakCaller.find_chunk(30) == 15
         assert RaoPeakCaller.find_chunk(1024) == 31
 
+        values = [0, 1, 1.001, 1.5, 1.7, 30, 1024, np.nan, np.inf, -1]
+        chunks, valid = _find_chunks(values)
+        assert [c if v else None for c, v in zip(chunks, valid)] == \
+            [RaoPeakCaller.find_chunk(value) for value in values]
+
+    def test_process_matrix_segment_intra(self):
+        np.random.seed(0)
+        n, w, p, max_w, min_ll_reads = 40, 3, 1, 6, 30
+        m = np.random.poisson(5, (n, n)).astype(float)
+        m = np.triu(m) + np.triu(m, 1).T
+        c = np.random.uniform(0.5, 1.5, n)
+        m_corrected = m * c[:, None] * c
+        e = list(np.linspace(10, 1, n))
+        mappable = np.ones(n, dtype=bool)
+        mappable[[5, 6, 20]] = False
+
+        args = msgpack.dumps([m_corrected, e, 0, (0, n), (0, n), mappable, c,
+                              (0, n), (0, n), mappable, c, w, p, p, min_ll_reads, 0.7, max_w, None])
+        results, zero_chunk_counts = msgpack.loads(process_matrix_segment_intra(args), strict_map_key=False)
+        assert len(results) > 0
+        assert sum(zero_chunk_counts['ll'].values()) > 0
+
+        # sparse segments give identical results
+        row, col = np.nonzero(m_corrected)
+        segment = {'row': row, 'col': col, 'data': m_corrected[row, col], 'shape': m.shape}
+        sparse_args = msgpack.dumps([segment] + msgpack.loads(args, strict_map_key=False)[1:])
+        assert msgpack.loads(process_matrix_segment_intra(sparse_args), strict_map_key=False) == \
+            [results, zero_chunk_counts]
+
+        # as well as segments in shared memory
+        with _SharedArrays({'e': e, 'c_i': c, 'mappable_i': mappable,
+                            'c_j': c, 'mappable_j': mappable}) as vector_arrays, \
+                _SharedArrays({'row': row, 'col': col, 'data': m_corrected[row, col]}) as segment_arrays:
+            shared_results, shared_zero_chunk_counts = _process_matrix_segment_shared(
+                _process_segment_intra, vector_arrays.specs, segment_arrays.specs,
+                [m.shape, 0, (0, n), (0, n), (0, n), (0, n), w, p, p, min_ll_reads, 0.7, max_w, None])
+        assert shared_results.tolist() == [tuple(result) for result in results]
+        assert shared_zero_chunk_counts == zero_chunk_counts
+
+        mask = np.zeros(m.shape, dtype=bool)
+        mask[~mappable] = True
+        mask[:, ~mappable] = True
+        m_masked = np.ma.masked_where(mask, m_corrected)
+        m_uncorrected = np.ma.masked_where(mask, m)
+        m_expected = np.ma.masked_where(mask, np.array([[e[abs(i - j)] for j in range(n)] for i in range(n)]))
+        m_ones = np.ones(m.shape)
+        for source, sink, weight, w_corr, _, observed, ll_sum, e_ll, e_v, e_h, e_d, \
+                o_chunk, e_ll_chunk, e_v_chunk, e_h_chunk, e_d_chunk, \
+                ll_mappable, v_mappable, h_mappable, d_mappable in results:
+            assert weight == m_corrected[source, sink]
+            assert weight != 0
+            assert observed == m[source, sink]
+            assert ll_sum == RaoPeakCaller.ll_sum(m_uncorrected, source, sink, w=w_corr - 1, p=p)
+            assert ll_sum >= min_ll_reads
+            for neighborhood_sum, mappability in ((RaoPeakCaller.e_ll_sum, ll_mappable),
+                                                  (RaoPeakCaller.e_v_sum, v_mappable),
+                                                  (RaoPeakCaller.e_h_sum, h_mappable),
+                                                  (RaoPeakCaller.e_d_sum, d_mappable)):
+                assert mappability == 1 - neighborhood_sum(mask, source, sink, w, p) / \
+                    neighborhood_sum(m_ones, source, sink, w, p)
+            for enrichment, value in ((RaoPeakCaller.e_ll, e_ll), (RaoPeakCaller.e_v, e_v),
+                                      (RaoPeakCaller.e_h, e_h), (RaoPeakCaller.e_d, e_d)):
+                assert value == pytest.approx(enrichment(m_masked, source, sink, m_expected,
+                                                         w=w_corr, p=p), rel=1e-12)
+            cf = c[source] * c[sink]
+            assert o_chunk == RaoPeakCaller.find_chunk(observed)
+            assert e_ll_chunk == RaoPeakCaller.find_chunk(e_ll / cf)
+            assert e_d_chunk == RaoPeakCaller.find_chunk(e_d / cf)
+
+    def test_fdr_cutoffs(self):
+        observed_chunk_distribution = {'ll': {3: {0: 50, 1: 30, 2: 15, 5: 4, 9: 1},
+                                              6: {2: 10, 4: 10}}}
+        fdr_cutoffs = RaoPeakCaller._get_fdr_cutoffs(observed_chunk_distribution)
+
+        assert fdr_cutoffs['ll'][3][9] == 0
+        assert fdr_cutoffs['ll'][6][4] == 0
+        poisson_right = 1 - math.exp(-2) * (1 + 2 + 2)
+        assert fdr_cutoffs['ll'][3][2] == pytest.approx(min(1, poisson_right / 0.05))
+        assert fdr_cutoffs['ll'][3][0] == 1
+
+        fdrs, found = RaoPeakCaller._lookup_fdr_cutoffs(fdr_cutoffs['ll'], [3, 3, 6, 6, 7], [2, 9, 4, 3, 2])
+        assert list(found) == [True, True, True, False, False]
+        assert list(fdrs) == [fdr_cutoffs['ll'][3][2], 0, 0, 1, 1]
+
     def test_call_peaks(self):
         dir = os.path.dirname(os.path.realpath(__file__))
         hic_10kb = fanc.load(dir + "/test_peaks/rao2014.chr11_77400000_78600000.hic", mode='r')
@@ -131,9 +241,108 @@ class TestRaoPeakCaller:
 
         assert len(valid_peaks) == 134
         assert has_43_57
+
+        # only pixels up to 300kb (30 bins) apart, with
+        # segments smaller than the matrix to skip some of them
+        band_peak_caller = RaoPeakCaller(slice_size=20, n_processes=1)
+        band_peaks = band_peak_caller.call_peaks(hic_10kb, max_distance=300000)
+        fields = ('weight', 'uncorrected', 'w', 'll_sum', 'e_ll', 'e_h', 'e_v', 'e_d')
+        expected = {(peak.source, peak.sink): [getattr(peak, f) for f in fields]
+                    for peak in peaks.edges if peak.sink - peak.source <= 30}
+        band = {(peak.source, peak.sink): [getattr(peak, f) for f in fields]
+                for peak in band_peaks.edges}
+        assert len(band) > 0
+        assert band == expected
+        band_peaks.close()
+
         hic_10kb.close()
         peaks.close()
 
+    def test_call_peaks_inter(self):
+        hic, m = _two_chromosome_hic()
+
+        # tiles without edges are skipped
+        segments = list(RaoPeakCaller.segment_matrix_inter(m[:40, 40:], 15, 3))
+        assert [(i_inspect, j_inspect) for _, _, i_inspect, _, j_inspect in segments] == \
+            [((0, 15), (15, 30)), ((15, 30), (0, 15)), ((15, 30), (15, 30)),
+             ((30, 40), (0, 15)), ((30, 40), (15, 30))]
+
+        fields = ('source', 'sink', 'weight', 'uncorrected', 'e_ll', 'e_h', 'e_v', 'e_d',
+                  'fdr_ll', 'fdr_h', 'fdr_v', 'fdr_d')
+        results = []
+        for slice_size in (15, 100):
+            peak_caller = RaoPeakCaller(process_inter=True, p=1, w_init=3, min_ll_reads=4,
+                                        slice_size=slice_size, n_processes=1)
+            peaks = peak_caller.call_peaks(hic)
+            results.append({(peak.source, peak.sink): [getattr(peak, f) for f in fields]
+                            for peak in peaks.edges if peak.source < 40 <= peak.sink})
+            peaks.close()
+        hic.close()
+
+        assert len(results[0]) > 0
+        assert results[0] == results[1]
+        assert not any(source < 15 and sink < 55 for source, sink in results[0])
+        peak = dict(zip(fields, results[0][(30, 65)]))
+        assert peak['fdr_ll'] < 0.1 and peak['fdr_h'] < 0.1 and peak['fdr_v'] < 0.1 and peak['fdr_d'] < 0.1
+        assert sum(values[fields.index('fdr_ll')] < 0.1 for values in results[0].values()) < 5
+
+    def test_call_peaks_resume(self, tmpdir):
+        hic, _ = _two_chromosome_hic()
+        peak_caller = RaoPeakCaller(process_inter=True, p=1, w_init=3, min_ll_reads=4,
+                                    slice_size=15, n_processes=1)
+
+        def _rows(peaks):
+            rows = [edge_table.read() for _, edge_table in peaks._iter_edge_tables()]
+            return np.concatenate(rows).tolist()
+
+        peaks = peak_caller.call_peaks(hic, file_name=str(tmpdir.join('full.peaks')))
+        expected = _rows(peaks)
+        # checkpoints are only recorded when resuming is requested
+        assert not peaks._has_peak_calling_checkpoint()
+        peaks.close()
+
+        # interrupted after the first chromosome pair, with
+        # some peaks of the second chromosome pair written
+        file_name = str(tmpdir.join('resumed.peaks'))
+        peaks = peak_caller.call_peaks(hic, chromosome_pairs=[('chr1', 'chr1')], file_name=file_name,
+                                       resume=True)
+        n_peaks = len(_rows(peaks))
+        peaks._add_edge_arrays({'source': np.array([45, 46]), 'sink': np.array([50, 51]),
+                                'weight': np.array([1., 1.])})
+        peaks.close()
+
+        with pytest.raises(ValueError):
+            RaoPeakCaller(process_inter=True, p=1, w_init=4).call_peaks(hic, file_name=file_name,
+                                                                        resume=True)
+
+        peaks = peak_caller.call_peaks(hic, file_name=file_name, resume=True)
+        assert len(_rows(peaks)) > n_peaks
+        assert _rows(peaks) == expected
+        peaks.close()
+        hic.close()
+
+    def test_peak_calling_checkpoint(self, tmpdir):
+        # distributions of genome-wide runs exceed the size limit of HDF5 attributes
+        distribution = {e_type: {chunk: {observed: chunk + observed for observed in range(80)}
+                                 for chunk in range(40)}
+                        for e_type in ('ll', 'h', 'v', 'd')}
+        peaks = RaoPeakInfo(str(tmpdir.join('checkpoint.peaks')), mode='w')
+        peaks.add_regions([GenomicRegion(chromosome='chr1', start=i * 1000 + 1, end=(i + 1) * 1000)
+                           for i in range(10)])
+        peaks._init_peak_calling_checkpoint([1, 3])
+        peaks._save_peak_calling_checkpoint(('chr1', 'chr1'), distribution, 0)
+        peaks._save_peak_calling_checkpoint(('chr1', 'chr2'), distribution, 42)
+        peaks.close()
+
+        peaks = RaoPeakInfo(str(tmpdir.join('checkpoint.peaks')), mode='a')
+        with pytest.raises(ValueError):
+            peaks._peak_calling_checkpoint([1, 4])
+        pairs, checkpoint_distribution, inter_possible = peaks._peak_calling_checkpoint([1, 3])
+        assert pairs == [('chr1', 'chr1'), ('chr1', 'chr2')]
+        assert checkpoint_distribution == distribution
+        assert inter_possible == 42
+        peaks.close()
+
     def test_merge_peaks(self):
         directory = os.path.dirname(os.path.realpath(__file__))
         peaks = RaoPeakInfo(directory + "/test_peaks/rao2014.chr11_77400000_78600000.peaks_filtered", mode='r')
@@ -144,6 +353,60 @@ class TestRaoPeakCaller:
         peaks.close()
         merged_peaks.close()
 
+    def test_peak_filters_valid_rows(self):
+        directory = os.path.dirname(os.path.realpath(__file__))
+        peaks = RaoPeakInfo(directory + "/test_peaks/rao2014.chr11_77400000_78600000.peaks", mode='r')
+        merged_peaks = peaks.merged_peaks()
+
+        peak_filters = [ObservedPeakFilter(cutoff=3), DistancePeakFilter(cutoff=5),
+                        FdrPeakFilter(fdr_cutoff=0.1), FdrPeakFilter(fdr_ll_cutoff=0.1, fdr_d_cutoff=0.05),
+                        MappabilityPeakFilter(mappability_cutoff=0.95),
+                        EnrichmentPeakFilter(enrichment_cutoff=1.5), RaoPeakFilter()]
+        merged_peak_filters = [RaoMergedPeakFilter(), FdrSumFilter(cutoff=0.05)]
+        for p, filters in ((peaks, peak_filters), (merged_peaks, merged_peak_filters)):
+            for _, edge_table in p._iter_edge_tables():
+                rows = edge_table.read()
+                for peak_filter in filters:
+                    valid = [peak_filter.valid(row) for row in tables.Table.iterrows(edge_table)]
+                    assert peak_filter.valid_rows(rows).tolist() == valid
+        merged_peaks.close()
+        peaks.close()
+
+    def test_to_bedpe(self, tmpdir):
+        directory = os.path.dirname(os.path.realpath(__file__))
+        peaks = RaoPeakInfo(directory + "/test_peaks/rao2014.chr11_77400000_78600000.peaks", mode='r')
+        merged_peaks = peaks.merged_peaks()
+
+        regions = list(merged_peaks.regions)
+        expected = []
+        for peak in merged_peaks.peaks(lazy=True, distances_in_bp=True):
+            r1, r2 = regions[peak.source], regions[peak.sink]
+            expected.append("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                r1.chromosome, int(r1.start - peak.radius), int(r1.end + peak.radius),
+                r2.chromosome, int(r2.start - peak.radius), int(r2.end + peak.radius),
+                peak.merged_pixels, peak.oe))
+
+        bedpe_file = str(tmpdir.join('merged.bedpe'))
+        merged_peaks.to_bedpe(bedpe_file, score_field='oe', name_field='merged_pixels')
+        with open(bedpe_file) as f:
+            assert f.readlines() == expected
+
+        peaks.to_bedpe(bedpe_file)
+        with open(bedpe_file) as f:
+            assert len(f.readlines()) == len(peaks.edges)
+        merged_peaks.close()
+        peaks.close()
+
+    def test_peak_clusters(self):
+        clusters = RaoPeakInfo._peak_clusters([10, 11, 12, 50, 80], [20, 20, 21, 90, 85],
+                                              [5, 4, 1, 3, 6], 15000, 10000)
+        assert [list(ixs) for ixs, _, _, _ in clusters] == [[4], [0, 1, 2], [3]]
+        _, x, y, radius = clusters[1]
+        assert (x, y) == (11, 61 / 3)
+        assert radius == pytest.approx(math.sqrt(1 + (2 / 3) ** 2))
+        # centroid of the last cluster only consists of its own peak
+        assert clusters[2][1:] == (50, 90, 0)
+
 
 class TestOverlapPeaks:
     def setup_method(self, method):
@@ -1,4 +1,6 @@
+import functools
 import gzip
+import heapq
 import logging
 import multiprocessing
 import os.path
@@ -363,11 +365,175 @@ def reads_with_same_qname(iterator, last_read=None):
     return qname, reads, next_read
 
 
+_natural_key = functools.cmp_to_key(natural_cmp)
+
+
+def _natural_sort_chunk(chunk_file, sorted_chunk_file):
+    """
+    Sort a SAM/BAM chunk by read name, in natural order.
+    """
+    with pysam.AlignmentFile(chunk_file) as sam:
+        reads = list(sam)
+        names = [_natural_key(read.query_name.encode()) for read in reads]
+        with pysam.AlignmentFile(sorted_chunk_file, 'wbu', template=sam) as o:
+            for ix in sorted(range(len(reads)), key=names.__getitem__):
+                o.write(reads[ix])
+    os.remove(chunk_file)
+    return sorted_chunk_file
+
+
+def _natural_merge_chunks(chunk_files, merged_chunk_file):
+    """
+    Merge SAM/BAM chunks sorted by read name into one file, in natural order.
+    """
+    sams = [pysam.AlignmentFile(chunk_file) for chunk_file in chunk_files]
+    try:
+        with pysam.AlignmentFile(merged_chunk_file, 'wbu', template=sams[0]) as o:
+            for read in heapq.merge(*sams, key=lambda r: _natural_key(r.query_name.encode())):
+                o.write(read)
+    finally:
+        for sam in sams:
+            sam.close()
+    for chunk_file in chunk_files:
+        os.remove(chunk_file)
+    return merged_chunk_file
+
+
+def natural_sorted_reads(sam_file, chunk_size=1000000, threads=1, tmpdir=None,
+                         decompression_threads=1, max_open_files=256):
+    """
+    Iterate over the reads in a SAM/BAM file in natural read name order.
+
+    This is an external merge sort: reads are split into chunks of
+    at most chunk_size reads, which are sorted in parallel and
+    spilled to a temporary directory as uncompressed BAM, and
+    finally merged. If there are more than max_open_files chunks,
+    groups of chunks are first merged into intermediate files, so
+    that no merge opens more than max_open_files files at once.
+
+    Sorting processes are shut down before the first read is returned,
+    so they do not compete with consumers of the sorted reads.
+
+    :param sam_file: Path to SAM/BAM file
+    :param chunk_size: Maximum number of reads held in memory by each
+                       sorting process
+    :param threads: Number of processes used for sorting chunks
+    :param tmpdir: Directory for temporary chunk files
+    :param decompression_threads: Number of htslib threads used for
+                                  decompressing the input file
+    :param max_open_files: Maximum number of chunk files opened by each merge
+    :return: iterator over :class:`~pysam.AlignedSegment`
+    """
+    chunk_dir = tempfile.mkdtemp(dir=tmpdir)
+    pool = None
+    sorted_files = []
+    try:
+        if threads > 1:
+            pool = multiprocessing.get_context("spawn").Pool(threads)
+
+        with pysam.AlignmentFile(sam_file, threads=decompression_threads) as sam:
+            chunk_counter = 0
+            chunk_reads = chunk_size
+            chunk = None
+            for read in sam:
+                if chunk_reads >= chunk_size:
+                    if chunk is not None:
+                        chunk.close()
+                        sorted_files.append(_submit_natural_sort_chunk(pool, chunk_dir, chunk_counter))
+                        chunk_counter += 1
+                    chunk = pysam.AlignmentFile(os.path.join(chunk_dir, 'chunk_{}.bam'.format(chunk_counter)),
+                                                'wbu', template=sam)
+                    chunk_reads = 0
+                chunk.write(read)
+                chunk_reads += 1
+
+            if chunk is not None:
+                chunk.close()
+                sorted_files.append(_submit_natural_sort_chunk(pool, chunk_dir, chunk_counter))
+
+        sorted_files = [f.get() if hasattr(f, 'get') else f for f in sorted_files]
+
+        merge_pass = 0
+        while len(sorted_files) > max_open_files:
+            logger.debug("Merging {} sorted chunks in groups of {}".format(len(sorted_files), max_open_files))
+            merged_files = []
+            for i in range(0, len(sorted_files), max_open_files):
+                group = sorted_files[i:i + max_open_files]
+                if len(group) == 1:
+                    merged_files.append(group[0])
+                    continue
+                merged_file = os.path.join(chunk_dir, 'merged_{}_{}.bam'.format(merge_pass, i // max_open_files))
+                if pool is None:
+                    merged_files.append(_natural_merge_chunks(group, merged_file))
+                else:
+                    merged_files.append(pool.apply_async(_natural_merge_chunks, (group, merged_file)))
+            sorted_files = [f.get() if hasattr(f, 'get') else f for f in merged_files]
+            merge_pass += 1
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+
+        logger.debug("Merging {} sorted chunks".format(len(sorted_files)))
+        sorted_sams = [pysam.AlignmentFile(f) for f in sorted_files]
+        try:
+            for read in heapq.merge(*sorted_sams, key=lambda r: _natural_key(r.query_name.encode())):
+                yield read
+        finally:
+            for sorted_sam in sorted_sams:
+                sorted_sam.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(chunk_dir)
+
+
+def _submit_natural_sort_chunk(pool, chunk_dir, chunk_counter):
+    chunk_file = os.path.join(chunk_dir, 'chunk_{}.bam'.format(chunk_counter))
+    sorted_chunk_file = os.path.join(chunk_dir, 'sorted_{}.bam'.format(chunk_counter))
+    if pool is None:
+        return _natural_sort_chunk(chunk_file, sorted_chunk_file)
+    return pool.apply_async(_natural_sort_chunk, (chunk_file, sorted_chunk_file))
+
+
+def _reference_id_map(sam1, sam2):
+    """
+    Map reference IDs of a SAM/BAM file to those of another file.
+
+    :param sam1: :class:`~pysam.AlignmentFile` whose reference IDs are used
+    :param sam2: :class:`~pysam.AlignmentFile` whose reference IDs are mapped
+    :return: dict mapping reference IDs of sam2 to those of sam1, or None
+             if both files have identical references
+    """
+    references1 = list(zip(sam1.references, sam1.lengths))
+    references2 = list(zip(sam2.references, sam2.lengths))
+    if references1 == references2:
+        return None
+
+    reference_ids = {reference: i for i, reference in enumerate(references1)}
+    missing = [name for name, length in references2 if (name, length) not in reference_ids]
+    if len(missing) > 0:
+        raise ValueError("References of second SAM file are not found in the header "
+                         "of the first SAM file: {}".format(", ".join(missing)))
+
+    reference_id_map = {-1: -1}
+    for i, reference in enumerate(references2):
+        reference_id_map[i] = reference_ids[reference]
+    return reference_id_map
+
+
 def split_sam_pairs(sam_file_1, sam_file_2, output_prefix,
-                    chunk_size=10000000, check_sorted=True):
+                    chunk_size=10000000, check_sorted=True, decompression_threads=1,
+                    sort=False, sort_threads=1, tmpdir=None, skip_chunks=None):
     """
     Form mate pairs and write them into separate chunks of predefined size.
 
+    Chunks are written as uncompressed BAM, so reads do not have to be
+    converted to and parsed from text. Chunks use the header of the first
+    file. If the second file lists its references in a different order,
+    reference IDs of its reads are translated accordingly.
+
     :param sam_file_1: Path to SAM/BAM file or :class:`~pysam.AlignmentFile`
     :param sam_file_2: Path to SAM/BAM file or :class:`~pysam.AlignmentFile`
     :param output_prefix: prefix str that will form the output files of the form
@@ -375,6 +541,18 @@ def split_sam_pairs(sam_file_1, sam_file_2, output_prefix,
     :param check_sorted: If True, will raise an Exception if SAM/BAM files are not
                          sorted by read name
     :param chunk_size: Number of
+    :param decompression_threads: Number of htslib threads used for decompressing
+                                  each input BAM file
+    :param sort: If True, input files do not need to be sorted by read name.
+                 Instead, reads are sorted on the fly using
+                 :func:`~natural_sorted_reads`. Requires file paths as input.
+    :param sort_threads: Number of processes used for sorting each input file.
+                         Files are sorted one after the other, and the sorting
+                         processes exit before the first chunk is returned
+    :param tmpdir: Temporary directory for sorting
+    :param skip_chunks: Optional set of chunk indexes (starting at 0) that are
+                        counted, but not written to disk. The output file
+                        path yielded for these chunks is None
     :return: iterator over tuples with path to chunk output file, valid read pairs,
              unmappable read pairs
     """
@@ -382,21 +560,39 @@ def split_sam_pairs(sam_file_1, sam_file_2, output_prefix,
     if isinstance(sam_file_1, pysam.AlignmentFile):
         sam1 = sam_file_1
     else:
-        sam1 = pysam.AlignmentFile(sam_file_1)
+        sam1 = pysam.AlignmentFile(sam_file_1, threads=decompression_threads)
 
     if isinstance(sam_file_2, pysam.AlignmentFile):
         sam2 = sam_file_2
     else:
-        sam2 = pysam.AlignmentFile(sam_file_2)
+        sam2 = pysam.AlignmentFile(sam_file_2, threads=decompression_threads)
+
+    # chunks use the header of the first file, so reads from
+    # the second file may need their reference IDs translated
+    reference_id_map = _reference_id_map(sam1, sam2)
+
+    if sort:
+        sam1_iter = natural_sorted_reads(sam_file_1, threads=sort_threads, tmpdir=tmpdir,
+                                         decompression_threads=decompression_threads)
+        sam2_iter = natural_sorted_reads(sam_file_2, threads=sort_threads, tmpdir=tmpdir,
+                                         decompression_threads=decompression_threads)
+    else:
+        sam1_iter = iter(sam1)
+        sam2_iter = iter(sam2)
 
-    sam1_iter = iter(sam1)
-    sam2_iter = iter(sam2)
+    if skip_chunks is None:
+        skip_chunks = set()
+
+    output_base = output_prefix + "_{}.bam"
+
+    def _chunk_output(counter):
+        if counter in skip_chunks:
+            return None, None
+        file_name = output_base.format(counter)
+        return file_name, pysam.AlignmentFile(file_name, 'wbu', template=sam1)
 
     output_counter = 0
-    output_base = output_prefix + "_{}.sam"
-    output_file_name = output_base.format(output_counter)
-    output_file = open(output_file_name, 'w')
-    output_file.write(str(sam1.header))
+    output_file_name, output_file = _chunk_output(output_counter)
 
     get_reads = reads_with_same_qname
     unmappable = 0
@@ -416,20 +612,25 @@ def split_sam_pairs(sam_file_1, sam_file_2, output_prefix,
                 read_counter = 0
                 if len(reads1) + len(reads2) > 1:
                     total += 1
+                    if reference_id_map is not None:
+                        for read in reads2:
+                            read.reference_id = reference_id_map[read.reference_id]
+                            read.next_reference_id = reference_id_map[read.next_reference_id]
+
                     for read in reads1 + reads2:
-                        output_file.write(read.to_string() + '\n')
+                        if output_file is not None:
+                            output_file.write(read)
                         read_counter += 1
 
                 if read_counter == 0:
                     unmappable += 1
 
                 if total >= chunk_size:
-                    output_file.close()
+                    if output_file is not None:
+                        output_file.close()
                     yield output_file_name, total, unmappable
                     output_counter += 1
-                    output_file_name = output_base.format(output_counter)
-                    output_file = open(output_file_name, 'w')
-                    output_file.write(str(sam1.header))
+                    output_file_name, output_file = _chunk_output(output_counter)
                     total = 0
                     unmappable = 0
 
@@ -457,7 +658,12 @@ def split_sam_pairs(sam_file_1, sam_file_2, output_prefix,
     except StopIteration:
         pass
     finally:
-        output_file.close()
+        if output_file is not None:
+            output_file.close()
+        if sort:
+            # clean up sorting processes and chunks before the last batch
+            sam1_iter.close()
+            sam2_iter.close()
         yield output_file_name, total, unmappable
 
 
@@ -549,7 +755,10 @@ def write_bigwig(file_name, regions, mode='w', score_field='score'):
     return file_name
 
 
-def sort_natural_sam(sam_file, output_file=None, sambamba=True, threads=1, _sambamba_path='sambamba'):
+def sort_natural_sam(sam_file, output_file=None, sambamba=True, threads=1, _sambamba_path='sambamba',
+                     builtin=False, chunk_size=1000000, tmpdir=None):
+    if builtin:
+        sambamba = False
     if which(_sambamba_path) is None and sambamba:
         logger.info('Cannot find {} on this machine, falling back to samtools sort. '
                     'This is not a problem, but if you want to speed up your SAM/BAM '
@@ -570,7 +779,16 @@ def sort_natural_sam(sam_file, output_file=None, sambamba=True, threads=1, _samb
         if ret != 0:
             sambamba = False
             logger.warning("{} failed, falling back to pysam/samtools".format(_sambamba_path))
-    if not sambamba:
+    if builtin:
+        with pysam.AlignmentFile(sam_file) as sam:
+            header = sam.header.to_dict()
+        header.setdefault('HD', {'VN': '1.6'})['SO'] = 'queryname'
+        with pysam.AlignmentFile(output_file, 'wb' if output_file.endswith('.bam') else 'w',
+                                 header=header) as o:
+            for read in natural_sorted_reads(sam_file, chunk_size=chunk_size,
+                                             threads=threads, tmpdir=tmpdir):
+                o.write(read)
+    elif not sambamba:
         pysam.sort('-n', '-o', output_file, sam_file)
 
     if replace_input: